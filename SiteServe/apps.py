@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class SiteserveConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'SiteServe'
+
+    def ready(self):
+        import SiteServe.signals
+
+        return super().ready()
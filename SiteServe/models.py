@@ -124,33 +124,43 @@ class ChatGPTPromptTemplate(models.Model):
             type=self.type, language=self.language
         ).upper()
 
-    @classmethod
-    def get_prompts(cls) -> dict:
-        DEFAULT_PROMPTS = {
-            'PRODUCT_DESCRIPTION_EN': 'write a brief about product {product_name}, using these keywords: {keywords}',
-            'PRODUCT_DESCRIPTION_AR': 'اكتب ملخصاً قصير عن منتج أسمه: {product_name}, باستخدام تلك الكلمات المفتاحية: {keywords}',
+    # the labels the templates may use
+    # the fields of the data the prompt is rendered with
+    LABELS = (
+        'product_id', 'product_name', 'product_description', 'product_seo_title',
+        'keywords', 'prompt_type',
+    )
 
-            'PRODUCT_TITLE_EN': 'write a title for product {product_name}, using these keywords: {keywords}',
-            'PRODUCT_TITLE_AR': 'اكتب عنواناً لمنتج أسمه: {product_name}, باستخدام تلك الكلمات المفتاحية: {keywords}',
+    DEFAULT_PROMPTS = {
+        'PRODUCT_DESCRIPTION_EN': 'write a brief about product {product_name}, using these keywords: {keywords}',
+        'PRODUCT_DESCRIPTION_AR': 'اكتب ملخصاً قصير عن منتج أسمه: {product_name}, باستخدام تلك الكلمات المفتاحية: {keywords}',
 
-            'PRODUCT_SEO_TITLE_EN': 'write a title good seo about product {product_name}, using these keywords: {keywords}',
-            'PRODUCT_SEO_TITLE_AR': 'اكتب عنواناً مناسب لمحركات البحث لمنتج أسمه: {product_name}, باستخدام تلك الكلمات المفتاحية: {keywords}',
+        'PRODUCT_TITLE_EN': 'write a title for product {product_name}, using these keywords: {keywords}',
+        'PRODUCT_TITLE_AR': 'اكتب عنواناً لمنتج أسمه: {product_name}, باستخدام تلك الكلمات المفتاحية: {keywords}',
 
-            'PRODUCT_SEO_DESCRIPTION_EN': 'write a SEO description about product {product_name}, using these keywords: {keywords}',
-            'PRODUCT_SEO_DESCRIPTION_AR': 'اكتب ملخصاً قصير مناسب لمحركات البحث عن منتج أسمه: {product_name}, باستخدام تلك الكلمات المفتاحية: {keywords}',
-        }
+        'PRODUCT_SEO_TITLE_EN': 'write a title good seo about product {product_name}, using these keywords: {keywords}',
+        'PRODUCT_SEO_TITLE_AR': 'اكتب عنواناً مناسب لمحركات البحث لمنتج أسمه: {product_name}, باستخدام تلك الكلمات المفتاحية: {keywords}',
+
+        'PRODUCT_SEO_DESCRIPTION_EN': 'write a SEO description about product {product_name}, using these keywords: {keywords}',
+        'PRODUCT_SEO_DESCRIPTION_AR': 'اكتب ملخصاً قصير مناسب لمحركات البحث عن منتج أسمه: {product_name}, باستخدام تلك الكلمات المفتاحية: {keywords}',
+    }
 
+    @classmethod
+    def get_prompts(cls) -> dict:
         db_prompts = {
             prompt.name: prompt.template
             for prompt in cls.objects.filter(is_active=True)
         }
         # This will override the default prompts with db ones
-        DEFAULT_PROMPTS.update(db_prompts)
-        return DEFAULT_PROMPTS
+        return {**cls.DEFAULT_PROMPTS, **db_prompts}
 
     @classmethod
     def get_template(cls, template_name: str) -> str:
-        return cls.get_prompts().get(template_name)
+        """the template from the registry of the process, without querying the db"""
+        from SiteServe import prompt_templates
+
+        template = prompt_templates.get_template(template_name)
+        return template.template if template else None
 
     def __str__(self):
         return self.name
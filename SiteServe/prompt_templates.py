@@ -0,0 +1,103 @@
+"""In process registry of the chatgpt prompt templates.
+
+The templates are loaded once, validated and parsed, and kept by their
+name (`PRODUCT_{TYPE}_{LANGUAGE}`), so generating a prompt doesn't query
+the database. Saving or deleting a template sets a new version in the
+shared cache, every process reloads its registry when the version changed.
+"""
+import uuid
+import string
+import logging
+import threading
+from typing import Optional
+
+from django.core.cache import cache
+
+logger = logging.getLogger('main')
+
+VERSION_KEY = 'prompt-templates:version'
+
+
+class CompiledTemplate:
+    def __init__(self, name: str, template: str) -> None:
+        self.name = name
+        self.template = template
+        # raises ValueError for a malformed template
+        self.labels = {
+            label for _, label, _, _ in string.Formatter().parse(template) if label is not None
+        }
+
+    def render(self, data: dict) -> str:
+        return self.template.format(**data)
+
+
+_lock = threading.Lock()
+_registry = {}
+_version = None
+_is_loaded = False
+
+
+def get_version():
+    try:
+        return cache.get(VERSION_KEY)
+    except Exception as e:
+        logger.error(f'[PROMPT_TEMPLATES] {e!r}')
+        return _version
+
+
+def invalidate() -> None:
+    """make every process reload its templates"""
+    try:
+        cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+    except Exception as e:
+        logger.error(f'[PROMPT_TEMPLATES] {e!r}')
+
+    global _is_loaded
+    with _lock:
+        _is_loaded = False
+
+
+def compile_templates(templates: dict, allowed_labels: set) -> dict:
+    compiled = {}
+    for name, template in templates.items():
+        try:
+            compiled_template = CompiledTemplate(name, template)
+        except ValueError as e:
+            logger.error(f'[PROMPT_TEMPLATES] {name} is malformed: {e!r}')
+            continue
+
+        not_allowed = compiled_template.labels - allowed_labels
+        if not_allowed:
+            logger.warning(
+                f'[PROMPT_TEMPLATES] {name} has labels not allowed: {not_allowed}, '
+                f'the default template is used instead'
+            )
+            continue
+        compiled[name] = compiled_template
+    return compiled
+
+
+def load() -> dict:
+    from SiteServe.models import ChatGPTPromptTemplate
+
+    allowed_labels = set(ChatGPTPromptTemplate.LABELS)
+    registry = compile_templates(ChatGPTPromptTemplate.DEFAULT_PROMPTS, allowed_labels)
+    # the active db templates override the defaults
+    db_templates = {
+        prompt.name: prompt.template
+        for prompt in ChatGPTPromptTemplate.objects.filter(is_active=True)
+    }
+    registry.update(compile_templates(db_templates, allowed_labels))
+    return registry
+
+
+def get_template(name: str) -> Optional[CompiledTemplate]:
+    global _registry, _version, _is_loaded
+
+    version = get_version()
+    with _lock:
+        if not _is_loaded or version != _version:
+            _registry = load()
+            _version = version
+            _is_loaded = True
+        return _registry.get(name)
@@ -0,0 +1,13 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from SiteServe import models
+from SiteServe import prompt_templates
+
+
+@receiver(post_save, sender=models.ChatGPTPromptTemplate)
+@receiver(post_delete, sender=models.ChatGPTPromptTemplate)
+def invalidate_prompt_templates(sender, instance, **kwargs):
+    # reloading before the commit would cache the old templates as the new version
+    transaction.on_commit(prompt_templates.invalidate)
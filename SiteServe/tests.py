@@ -1,3 +1,23 @@
 from django.test import TestCase
 
-# Create your tests here.
+from SiteServe import prompt_templates
+from SiteServe.models import ChatGPTPromptTemplate
+
+
+class CompileTemplatesTestCase(TestCase):
+    def compile(self, template: str) -> dict:
+        return prompt_templates.compile_templates(
+            {'PRODUCT_TITLE_EN': template}, set(ChatGPTPromptTemplate.LABELS)
+        )
+
+    def test_every_field_of_the_rendered_data_is_allowed(self):
+        compiled = self.compile('{prompt_type} for {product_id}: {product_name}')
+
+        prompt = compiled['PRODUCT_TITLE_EN'].render({
+            'product_id': '10', 'product_name': 'dress', 'prompt_type': 'title',
+        })
+        self.assertEqual(prompt, 'title for 10: dress')
+
+    def test_unknown_labels_are_rejected_with_a_warning(self):
+        with self.assertLogs('main', level='WARNING'):
+            self.assertEqual(self.compile('{brand_name}'), {})
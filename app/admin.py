@@ -9,4 +9,6 @@ admin.site.register(models.ChatGPTResponse)
 admin.site.register(models.UserPrompt)
 admin.site.register(models.SallaWebhookLog)
 admin.site.register(models.SallaUserSubscription)
-
+admin.site.register(models.SallaProduct)
+admin.site.register(models.SallaCatalogSync)
+admin.site.register(models.BulkGenerationJob)
@@ -1,18 +1,31 @@
+import asyncio
+import json
 import logging
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+from typing import Iterator, Tuple
 
+import aiohttp
 import requests
+from asgiref.sync import sync_to_async
 from rest_framework.exceptions import ValidationError
 from rest_framework.serializers import Serializer
 
-from app import utils
-from app.enums import WebhookEvents
+from app import http_pool, llm_cache, metrics, model_router, salla_cache, tokens, utils
+from app.enums import Priority, WebhookEvents
 from app.exceptions import (
     SallaEndpointFailureException,
     SallaOauthFailedException,
     SallaWebhookFailureException,
 )
+from app.limiters import SallaRateLimiter
+from app.openai_limits import OpenAIAdmission, Reservation
 from app.models import Account, ChatGPTResponse, SallaUser
+from app.resilience import CircuitBreaker, RetryPolicy
+from SiteServe import prompt_templates
 
 logger = logging.getLogger("main")
 
@@ -64,7 +77,7 @@ class SallaOAuth:
             }
         )
 
-        response = requests.post(url, data=body, headers=headers)
+        response = send_salla_request("POST", url, data=body, headers=headers)
 
         if response.status_code != 200:
             raise SallaOauthFailedException()
@@ -83,7 +96,7 @@ class SallaOAuth:
             }
         )
 
-        response = requests.post(url, data=body, headers=headers)
+        response = send_salla_request("POST", url, data=body, headers=headers)
 
         if response.status_code != 200:
             raise SallaOauthFailedException()
@@ -91,6 +104,49 @@ class SallaOAuth:
         return response.json()
 
 
+def send_salla_request(
+    method: str,
+    url: str,
+    limiter: SallaRateLimiter = None,
+    priority: Priority = Priority.INTERACTIVE,
+    idempotent: bool = None,
+    **kwargs,
+) -> requests.Response:
+    """send request to salla through the shared keep-alive session,
+    paced by the merchant rate limiter if given. Transient failures of
+    idempotent requests are retried, the endpoint circuit breaker fails
+    fast while salla is degraded"""
+    breaker = CircuitBreaker.for_request(method, url)
+    retry_policy = RetryPolicy.for_method(method, idempotent)
+
+    while True:
+        breaker.before_request()
+        if limiter is not None:
+            limiter.acquire(priority)
+
+        try:
+            response = http_pool.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            breaker.record_failure()
+            if retry_policy.should_retry():
+                time.sleep(retry_policy.next_delay())
+                continue
+
+            metrics.incr("salla_retry.exhausted")
+            logger.error(f"SallaError [{method}]: [{url}] {e}")
+            raise SallaEndpointFailureException()
+
+        breaker.record(response.status_code)
+        if limiter is not None:
+            limiter.observe(response.headers)
+
+        if retry_policy.should_retry(response.status_code):
+            time.sleep(retry_policy.next_delay())
+            continue
+
+        return response
+
+
 def handel_salla_response_status_code(response, instance):
     error_message = "SallaError [{classname}]: ({status_code}) [{url}] {text}".format(
         classname=instance.__class__.__name__,
@@ -101,9 +157,14 @@ def handel_salla_response_status_code(response, instance):
     if response.status_code < 300:
         pass  # success
     elif response.status_code == 401:
-        instance.account.access_token = None
-        instance.account.refresh_token = None
-        instance.account.save()
+        account = getattr(instance, "account", None)
+        # an account not saved yet (the oauth callback) has no tokens to revoke,
+        # saving it would pull the user again with the rejected token
+        if account is not None and account.pk is not None:
+            # the token columns aren't nullable
+            account.access_token = ""
+            account.refresh_token = ""
+            account.save(update_fields=["access_token", "refresh_token", "updated_at"])
         logger.error(error_message)
         raise SallaOauthFailedException()
     else:
@@ -118,9 +179,18 @@ class SallaBaseReader:
     others read about settings
     """
 
-    def __init__(self, account: Account) -> None:
+    def __init__(
+        self,
+        account: Account,
+        priority: Priority = Priority.INTERACTIVE,
+        use_cache: bool = True,
+    ) -> None:
+        self.account = account
         self.access_token = account.access_token
         self.base_url = os.getenv("SALLA_BASE_URL")
+        self.priority = priority
+        self.limiter = SallaRateLimiter(self.access_token)
+        self.use_cache = use_cache
 
     def get_headers(self) -> dict:
         return {"Authorization": f"Bearer {self.access_token}"}
@@ -136,15 +206,56 @@ class SallaBaseReader:
         """get data from response"""
         return response if type(response.get("data")) is list else response["data"]
 
-    def get(self, endpoint: str, params: dict = None) -> dict:
-        """send get request to api, handle errors and return data"""
+    def get(self, endpoint: str, params: dict = None, use_cache: bool = None) -> dict:
+        """return data of the endpoint, from the cache when it's possible"""
+        use_cache = self.use_cache if use_cache is None else use_cache
+        if not use_cache:
+            return self.fetch(endpoint, params, use_cache=False)
+
+        return salla_cache.get_or_load(
+            self.access_token,
+            endpoint,
+            params,
+            lambda: self.fetch(endpoint, params),
+            # the stale entries are refreshed without taking interactive tokens
+            lambda: self.fetch(endpoint, params, priority=Priority.BACKGROUND),
+        )
+
+    def fetch(
+        self,
+        endpoint: str,
+        params: dict = None,
+        priority: Priority = None,
+        use_cache: bool = True,
+    ) -> dict:
+        """send get request to api, handle errors and return data.
+        It revalidates the last response if salla sent validators for it,
+        without `use_cache` nothing is read from or kept in the cache"""
 
         headers = self.get_headers()
+        conditional = None
+        if use_cache:
+            conditional = salla_cache.get_conditional(self.access_token, endpoint, params)
+        if conditional is not None:
+            headers.update(conditional[0])
+
         url = f"{self.base_url}{endpoint}"
-        response = requests.get(url, headers=headers, params=params)
+        response = send_salla_request(
+            "GET", url, self.limiter, priority or self.priority, headers=headers, params=params
+        )
+
+        if response.status_code == 304 and conditional is not None:
+            metrics.incr("salla_cache.not_modified")
+            return conditional[1]
 
         handel_salla_response_status_code(response, self)
-        return self.__get_response_data(response.json())
+        data = self.__get_response_data(response.json())
+
+        if use_cache:
+            salla_cache.store_conditional(
+                self.access_token, endpoint, params, response.headers, data
+            )
+        return data
 
 
 class SallaMerchantReader(SallaBaseReader):
@@ -170,6 +281,50 @@ class SallaMerchantReader(SallaBaseReader):
         endpoint = f"/products/{product_id}"
         return self.get(endpoint)
 
+    def iter_product_pages(
+        self, params: dict = None, start_page: int = 1, prefetch: int = None
+    ) -> Iterator[Tuple[int, list]]:
+        """yield `(page, products)` across the whole catalog lazily.
+        While a page is consumed the next `prefetch` pages are fetched in the
+        background, so at most `prefetch + 1` pages are held in memory
+        """
+        prefetch = prefetch or int(os.getenv("SALLA_PRODUCTS_PREFETCH", 1))
+        params = params or {}
+
+        def fetch(page: int) -> dict:
+            return self.get_products({**params, "page": page})
+
+        executor = ThreadPoolExecutor(max_workers=prefetch)
+        pending = deque()
+        try:
+            page = start_page
+            response = fetch(page)
+            total_pages = response["pagination"]["totalPages"]
+            next_page = page + 1
+
+            while True:
+                while len(pending) < prefetch and next_page <= total_pages:
+                    pending.append((next_page, executor.submit(fetch, next_page)))
+                    next_page += 1
+
+                yield page, response["data"]
+
+                if not pending:
+                    break
+                page, future = pending.popleft()
+                response = future.result()
+        finally:
+            # the consumer may stop early, don't fetch pages nobody will read
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def iter_products(self, params: dict = None, **kwargs) -> Iterator[dict]:
+        """yield products across the whole catalog lazily,
+        see `iter_product_pages` for the prefetching"""
+        for _, products in self.iter_product_pages(params, **kwargs):
+            yield from products
+
 
 class SallaAppSettingsReader(SallaBaseReader):
     APP_ID = os.getenv("SALLA_APP_ID")
@@ -189,9 +344,14 @@ class SallaAppSettingsReader(SallaBaseReader):
 
 
 class SallaWriter:
-    def __init__(self, account: Account) -> None:
+    def __init__(
+        self, account: Account, priority: Priority = Priority.INTERACTIVE
+    ) -> None:
+        self.account = account
         self.access_token = account.access_token
         self.base_url = os.getenv("SALLA_BASE_URL")
+        self.priority = priority
+        self.limiter = SallaRateLimiter(self.access_token)
 
     def put(self, endpoint: str, body: dict) -> dict:
         headers = {
@@ -199,41 +359,285 @@ class SallaWriter:
             "Content-Type": "application/json",
         }
         url = f"{self.base_url}{endpoint}"
-        response = requests.put(url, headers=headers, json=body)
+        response = send_salla_request(
+            "PUT", url, self.limiter, self.priority, headers=headers, json=body
+        )
 
         handel_salla_response_status_code(response, self)
         return response.json()["data"]
 
-    def post(self, endpoint: str, body: dict) -> dict:
+    def post(self, endpoint: str, body: dict, idempotent: bool = False) -> dict:
         headers = {
             "Authorization": f"Bearer {self.access_token}",
             "Content-Type": "application/json",
         }
         url = f"{self.base_url}{endpoint}"
-        response = requests.post(url, headers=headers, json=body)
+        response = send_salla_request(
+            "POST",
+            url,
+            self.limiter,
+            self.priority,
+            idempotent=idempotent,
+            headers=headers,
+            json=body,
+        )
 
         handel_salla_response_status_code(response, self)
         return response.json()["data"]
 
     def product_update(self, id: str, body: dict) -> dict:
         endpoint = f"/products/{id}"
-        return self.put(endpoint, body)
+        response = self.put(endpoint, body)
+
+        salla_cache.invalidate_product(self.access_token, id)
+        return response
 
     def balance_update(self, body: dict) -> dict:
         endpoint = "/apps/balance"
-        return self.post(endpoint, body)
+        # the balance is set not incremented, safe to retry
+        return self.post(endpoint, body, idempotent=True)
+
+
+class AsyncSallaClient:
+    """Base class for the asyncio twins of the Salla readers and writer.
+    Use it as an async context manager so all the calls made inside
+    share one aiohttp session and can run concurrently on one event loop
+    """
+
+    def __init__(
+        self, account: Account, priority: Priority = Priority.INTERACTIVE
+    ) -> None:
+        self.account = account
+        self.access_token = account.access_token
+        self.base_url = os.getenv("SALLA_BASE_URL")
+        self.priority = priority
+        self.limiter = SallaRateLimiter(self.access_token)
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit_per_host=http_pool.POOL_SIZE)
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=http_pool.CONNECT_TIMEOUT, sock_read=http_pool.READ_TIMEOUT
+        )
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.session.close()
+
+    def get_headers(self) -> dict:
+        return {
+            "Authorization": f"Bearer {self.access_token}",
+            "Content-Type": "application/json",
+        }
+
+    async def request(self, method: str, endpoint: str, **kwargs) -> dict:
+        """send request to api, handle errors and return the json body"""
+        assert self.session is not None, "Use the client as `async with`."
+
+        url = f"{self.base_url}{endpoint}"
+        breaker = CircuitBreaker.for_request(method, url)
+        retry_policy = RetryPolicy.for_method(method, kwargs.pop("idempotent", None))
+
+        while True:
+            breaker.before_request()
+            await self.limiter.acquire_async(self.priority)
+
+            try:
+                async with self.session.request(
+                    method, url, headers=self.get_headers(), **kwargs
+                ) as response:
+                    text = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                breaker.record_failure()
+                if retry_policy.should_retry():
+                    await asyncio.sleep(retry_policy.next_delay())
+                    continue
+
+                metrics.incr("salla_retry.exhausted")
+                logger.error(f"SallaError [{self.__class__.__name__}]: [{url}] {e!r}")
+                raise SallaEndpointFailureException()
+
+            breaker.record(response.status)
+            await self.limiter.observe_async(response.headers)
+
+            if retry_policy.should_retry(response.status):
+                await asyncio.sleep(retry_policy.next_delay())
+                continue
+            break
+
+        # quacks like `requests.Response` for the shared error mapping
+        response = SimpleNamespace(
+            status_code=response.status,
+            text=text,
+            request=SimpleNamespace(url=str(response.url)),
+        )
+        if response.status_code == 401:
+            # invalidating the tokens hits the database
+            await sync_to_async(handel_salla_response_status_code)(response, self)
+        handel_salla_response_status_code(response, self)
+
+        return json.loads(text)
+
+
+class AsyncSallaBaseReader(AsyncSallaClient):
+    get_params = SallaBaseReader.get_params
+
+    def __get_response_data(self, response: dict) -> dict:
+        """get data from response"""
+        return response if type(response.get("data")) is list else response["data"]
+
+    async def get(self, endpoint: str, params: dict = None) -> dict:
+        response = await self.request("GET", endpoint, params=params)
+        return self.__get_response_data(response)
+
+
+class AsyncSallaMerchantReader(AsyncSallaBaseReader):
+    """Asyncio twin of `SallaMerchantReader`"""
+
+    async def get_user(self) -> dict:
+        endpoint = "/oauth2/user/info"
+        return await self.get(endpoint)
+
+    async def get_store(self) -> dict:
+        endpoint = "/store/info"
+        return await self.get(endpoint)
+
+    async def get_products(self, params: dict = None) -> dict:
+        from app.serializers import ProductEndpointParamsSerializer
+
+        endpoint = "/products"
+        params = self.get_params(ProductEndpointParamsSerializer, params)
+
+        return await self.get(endpoint, params)
+
+    async def get_product(self, product_id: str) -> dict:
+        endpoint = f"/products/{product_id}"
+        return await self.get(endpoint)
+
+    async def get_products_pages(self, pages: list, params: dict = None) -> list:
+        """fetch several product pages concurrently, keeps the pages order"""
+        params = dict(params or {})
+        calls = [self.get_products({**params, "page": page}) for page in pages]
+
+        return await asyncio.gather(*calls)
+
+
+class AsyncSallaAppSettingsReader(AsyncSallaBaseReader):
+    """Asyncio twin of `SallaAppSettingsReader`"""
+
+    APP_ID = SallaAppSettingsReader.APP_ID
+
+    async def get_subscription(self) -> dict:
+        endpoint = f"/apps/{self.APP_ID}/subscriptions"
+        return await self.get(endpoint)
+
+    async def get_settings(self) -> dict:
+        endpoint = f"/apps/{self.APP_ID}/settings"
+        return await self.get(endpoint)
+
+
+class AsyncSallaWriter(AsyncSallaClient):
+    """Asyncio twin of `SallaWriter`"""
+
+    async def put(self, endpoint: str, body: dict) -> dict:
+        response = await self.request("PUT", endpoint, json=body)
+        return response["data"]
+
+    async def post(self, endpoint: str, body: dict, idempotent: bool = False) -> dict:
+        response = await self.request(
+            "POST", endpoint, json=body, idempotent=idempotent
+        )
+        return response["data"]
+
+    async def product_update(self, id: str, body: dict) -> dict:
+        endpoint = f"/products/{id}"
+        response = await self.put(endpoint, body)
+
+        salla_cache.invalidate_product(self.access_token, id)
+        return response
+
+    async def balance_update(self, body: dict) -> dict:
+        endpoint = "/apps/balance"
+        # the balance is set not incremented, safe to retry
+        return await self.post(endpoint, body, idempotent=True)
+
+    async def products_update(self, bodies: dict) -> dict:
+        """push several product updates concurrently,
+        `bodies` maps product id to its body. The result maps product id
+        to the updated product or to the exception raised while updating it
+        """
+        ids = list(bodies.keys())
+        calls = [self.product_update(id, bodies[id]) for id in ids]
+        results = await asyncio.gather(*calls, return_exceptions=True)
+
+        return dict(zip(ids, results))
 
 
 class ChatGPT:
-    def __init__(self, max_tokens: int = None) -> None:
+    def __init__(
+        self,
+        max_tokens: int = None,
+        priority: Priority = Priority.INTERACTIVE,
+        model: str = None,
+    ) -> None:
         import openai
 
         openai.api_key = os.getenv("OPENAI_API_KEY")
 
         self.openai = openai
         self.max_tokens = max_tokens or int(os.getenv("OPENAI_MAX_TOKEN", 512))
-
-    def __log_to_db(self, prompt: str, response: dict) -> ChatGPTResponse:
+        self.priority = priority
+        self.model = model or model_router.DEFAULT_MODEL
+
+    def __admit(self, model: str, prompt: str) -> Reservation:
+        """wait for the account budget of the prompt and the completion"""
+        estimate = tokens.count_tokens(prompt, model) + self.max_tokens
+        return OpenAIAdmission(model).acquire(estimate, self.priority)
+
+    def __create(self, prompt: str, **kwargs):
+        """completion of the prompt by the model, through the chat endpoint
+        for the chat models. The latency until openai answers (the first
+        chunk of a stream) and the errors are tracked by the router"""
+        started_at = time.monotonic()
+        try:
+            if model_router.is_chat_model(self.model):
+                response = self.openai.ChatCompletion.create(
+                    model=self.model,
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=0,
+                    max_tokens=self.max_tokens,
+                    **kwargs,
+                )
+            else:
+                response = self.openai.Completion.create(
+                    model=self.model,
+                    prompt=prompt,
+                    temperature=0,
+                    max_tokens=self.max_tokens,
+                    top_p=1,
+                    frequency_penalty=0,
+                    presence_penalty=0,
+                    **kwargs,
+                )
+        except Exception:
+            model_router.record(self.model, time.monotonic() - started_at, is_error=True)
+            raise
+
+        model_router.record(self.model, time.monotonic() - started_at)
+        return response
+
+    @staticmethod
+    def __get_text(choice: dict) -> str:
+        """text of a completion or a chat completion choice, or of a chunk"""
+        if "message" in choice:
+            return choice["message"]["content"]
+        if "delta" in choice:
+            return choice["delta"].get("content") or ""
+        return choice.get("text") or ""
+
+    @staticmethod
+    def log_to_db(prompt: str, response: dict) -> ChatGPTResponse:
         from app.serializers import ChatGPTResponseSerializer
 
         response.update({"prompt": prompt})
@@ -244,21 +648,311 @@ class ChatGPT:
         return serializer.save()
 
     def ask(self, prompt: str) -> ChatGPTResponse:
-        openai_model = os.getenv("OPENAI_MODEL", "text-davinci-003")
-
-        response = self.openai.Completion.create(
-            model=openai_model,
-            prompt=prompt,
-            temperature=0,
-            max_tokens=self.max_tokens,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-        ).to_dict_recursive()
-
-        instance = self.__log_to_db(prompt, response)
+        response = self.complete(prompt)
+
+        instance = self.log_to_db(prompt, response)
         return instance
 
+    def complete(self, prompt: str) -> dict:
+        """ask openai without touching the database, safe to run in threads"""
+        # the completions are deterministic (temperature=0)
+        cache_key = llm_cache.get_key(self.model, prompt, self.max_tokens)
+        response = llm_cache.get(cache_key)
+        if response is not None:
+            return llm_cache.as_hit(response)
+
+        reservation = self.__admit(self.model, prompt)
+        used_tokens = 0
+        try:
+            response = self.__create(prompt).to_dict_recursive()
+            used_tokens = response["usage"]["total_tokens"]
+        finally:
+            reservation.settle(used_tokens)
+
+        llm_cache.store(cache_key, response)
+        return response
+
+    def stream(self, prompt: str) -> Iterator[Tuple[str, dict]]:
+        """yield `(text, None)` as openai generates the answer, then
+        `("", response)` with the whole response once it's done.
+        Streamed completions carry no usage, the tokens are estimated"""
+        cache_key = llm_cache.get_key(self.model, prompt, self.max_tokens)
+        response = llm_cache.get(cache_key)
+        if response is not None:
+            yield self.__get_text(response["choices"][0]), None
+            yield "", llm_cache.as_hit(response)
+            return
+
+        reservation = self.__admit(self.model, prompt)
+        texts, chunk = [], {}
+        try:
+            for chunk in self.__create(prompt, stream=True):
+                chunk = chunk.to_dict_recursive()
+                text = self.__get_text(chunk["choices"][0])
+                if text:
+                    texts.append(text)
+                    yield text, None
+        finally:
+            # also when the client went away in the middle of the stream
+            answer = "".join(texts)
+            used_tokens = tokens.count_tokens(prompt, self.model)
+            used_tokens += tokens.count_tokens(answer, self.model)
+            reservation.settle(used_tokens)
+
+        response = {
+            "id": chunk.get("id"),
+            "object": chunk.get("object"),
+            "created": chunk.get("created"),
+            "model": chunk.get("model"),
+            "usage": {
+                "total_tokens": used_tokens,
+                "is_estimated": True,
+            },
+            "choices": [
+                {
+                    "index": 0,
+                    "text": answer,
+                    "finish_reason": chunk.get("choices", [{}])[0].get("finish_reason"),
+                }
+            ],
+        }
+
+        llm_cache.store(cache_key, response)
+        yield "", response
+
+    def complete_chat(self, messages: list) -> dict:
+        openai_model = os.getenv("OPENAI_CHAT_MODEL", "gpt-3.5-turbo")
+
+        prompt = "".join(message["content"] for message in messages)
+        reservation = self.__admit(openai_model, prompt)
+        used_tokens = 0
+        try:
+            response = self.openai.ChatCompletion.create(
+                model=openai_model,
+                messages=messages,
+                temperature=0,
+                max_tokens=self.max_tokens,
+            ).to_dict_recursive()
+            used_tokens = response["usage"]["total_tokens"]
+        finally:
+            reservation.settle(used_tokens)
+
+        return response
+
+    @classmethod
+    def complete_concurrently(
+        cls,
+        requests: dict,
+        max_workers: int = None,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> Iterator[Tuple[str, dict]]:
+        """`requests` maps a key to `(prompt, constraints)`, yield
+        `(key, response)` as they finish, the response is the exception
+        raised for the failed ones"""
+        max_workers = max_workers or int(os.getenv("OPENAI_MAX_CONCURRENCY", 4))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(cls(priority=priority, **constraints).complete, prompt): key
+                for key, (prompt, constraints) in requests.items()
+            }
+            for future in as_completed(futures):
+                try:
+                    response = future.result()
+                except Exception as e:
+                    logger.error(f"ChatGPTError: {e!r}")
+                    response = e
+                yield futures[future], response
+
+
+class ChatGPTBatch:
+    """Answer many prompts with few chat requests, each request packs a
+    batch of prompts and asks for a json array of the answers"""
+
+    INSTRUCTIONS = (
+        "You will receive a JSON array of tasks, each one has an `id` and a `task`. "
+        "Do every task independently and keep each answer within its `max_tokens`. "
+        'Reply with a JSON array only, one `{"id": ..., "answer": ...}` per task.'
+    )
+    # room for the json syntax around every answer
+    ANSWER_OVERHEAD_TOKENS = 20
+
+    def __init__(self, requests: dict, priority: Priority = Priority.INTERACTIVE) -> None:
+        """`requests` maps a key to `(prompt, constraints)`"""
+        self.requests = requests
+        self.priority = priority
+        self.model = os.getenv("OPENAI_CHAT_MODEL", "gpt-3.5-turbo")
+        self.batch_size = int(os.getenv("OPENAI_BATCH_SIZE", 10))
+        self.context_tokens = int(
+            os.getenv("OPENAI_BATCH_CONTEXT_TOKENS", tokens.get_context_tokens(self.model))
+        )
+        self.max_retries = int(os.getenv("OPENAI_BATCH_MAX_RETRIES", 2))
+
+    def __get_max_tokens(self, key) -> int:
+        _, constraints = self.requests[key]
+        return constraints.get("max_tokens") or int(os.getenv("OPENAI_MAX_TOKEN", 512))
+
+    def __get_cache_key(self, key) -> str:
+        prompt, _ = self.requests[key]
+        return llm_cache.get_key(f"{self.model}:batch", prompt, self.__get_max_tokens(key))
+
+    def __pack(self, keys: list) -> list:
+        """split the keys into batches fitting the context of the model"""
+        budget = (
+            self.context_tokens
+            - tokens.count_tokens(self.INSTRUCTIONS, self.model)
+            - tokens.SAFETY_MARGIN
+        )
+
+        batches, batch, used = [], [], 0
+        for key in keys:
+            prompt, _ = self.requests[key]
+            needed = (
+                tokens.count_tokens(prompt, self.model)
+                + self.__get_max_tokens(key)
+                + self.ANSWER_OVERHEAD_TOKENS
+            )
+            if batch and (len(batch) >= self.batch_size or used + needed > budget):
+                batches.append(batch)
+                batch, used = [], 0
+            batch.append(key)
+            used += needed
+
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @staticmethod
+    def __parse_answers(content: str) -> dict:
+        """map the ids to their answers, the invalid items are left out"""
+        content = content.strip()
+        if content.startswith("```"):
+            content = content.strip("`").removeprefix("json").strip()
+
+        try:
+            items = json.loads(content)
+        except ValueError:
+            return {}
+        if isinstance(items, dict):
+            items = items.get("answers") or items.get("results") or []
+        if not isinstance(items, list):
+            return {}
+
+        return {
+            str(item.get("id")): item["answer"].strip()
+            for item in items
+            if isinstance(item, dict)
+            and isinstance(item.get("answer"), str)
+            and item["answer"].strip()
+        }
+
+    def __split_response(self, response: dict, key, answer: str, prompts_length: int) -> dict:
+        """the response of one prompt, shaped like a single chat response.
+        It takes a share of the batch tokens by the length of its prompt"""
+        prompt, _ = self.requests[key]
+        total_tokens = response.get("usage", {}).get("total_tokens", 0)
+
+        return {
+            "id": response.get("id"),
+            "object": response.get("object"),
+            "created": response.get("created"),
+            "model": response.get("model"),
+            "usage": {
+                "total_tokens": round(total_tokens * len(prompt) / max(prompts_length, 1))
+            },
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop",
+                }
+            ],
+        }
+
+    def __complete_batch(self, keys: list) -> Tuple[dict, bool]:
+        """Return the responses of the keys, an exception for the failed
+        ones, and whether the reply was cut by the max tokens"""
+        ids = {str(index): key for index, key in enumerate(keys)}
+        tasks = [
+            {
+                "id": id,
+                "task": self.requests[key][0],
+                "max_tokens": self.__get_max_tokens(key),
+            }
+            for id, key in ids.items()
+        ]
+        messages = [
+            {"role": "system", "content": self.INSTRUCTIONS},
+            {"role": "user", "content": json.dumps(tasks, ensure_ascii=False)},
+        ]
+        max_tokens = sum(
+            self.__get_max_tokens(key) + self.ANSWER_OVERHEAD_TOKENS for key in keys
+        )
+
+        try:
+            response = ChatGPT(max_tokens=max_tokens, priority=self.priority).complete_chat(
+                messages
+            )
+        except Exception as e:
+            logger.error(f"ChatGPTError: {e!r}")
+            return {key: e for key in keys}, False
+
+        choice = response["choices"][0]
+        answers = self.__parse_answers(choice["message"]["content"])
+        is_truncated = choice.get("finish_reason") == "length"
+        prompts_length = sum(len(self.requests[key][0]) for key in keys)
+
+        results = {}
+        for id, key in ids.items():
+            if id not in answers:
+                results[key] = ValueError(f"No valid answer for the task {id} of the batch.")
+                continue
+            results[key] = self.__split_response(response, key, answers[id], prompts_length)
+            llm_cache.store(self.__get_cache_key(key), results[key])
+
+        metrics.incr("openai_batch.requests")
+        metrics.incr("openai_batch.failed_items", len(keys) - len(answers))
+        return results, is_truncated
+
+    def complete(self, max_workers: int = None) -> Iterator[Tuple[str, dict]]:
+        """yield `(key, response)` like `ChatGPT.complete_concurrently`,
+        the items that failed are retried alone in the next round"""
+        max_workers = max_workers or int(os.getenv("OPENAI_MAX_CONCURRENCY", 4))
+
+        pending = {}
+        for key in self.requests:
+            cached = llm_cache.get(self.__get_cache_key(key))
+            if cached is not None:
+                yield key, llm_cache.as_hit(cached)
+            else:
+                pending[key] = None
+
+        for _ in range(self.max_retries + 1):
+            if not pending:
+                return
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(self.__complete_batch, batch)
+                    for batch in self.__pack(list(pending))
+                ]
+                is_truncated = False
+                for future in as_completed(futures):
+                    results, batch_is_truncated = future.result()
+                    is_truncated = is_truncated or batch_is_truncated
+                    for key, response in results.items():
+                        pending[key] = response
+                        if not isinstance(response, Exception):
+                            del pending[key]
+                            yield key, response
+
+            # smaller batches for the retries of a reply that didn't fit
+            if is_truncated:
+                self.batch_size = max(self.batch_size // 2, 1)
+
+        for key, error in pending.items():
+            yield key, error
+
 
 class ChatGPTProductPromptGenerator:
     """Class to generate chatgpt valid prompt from the product data"""
@@ -272,29 +966,49 @@ class ChatGPTProductPromptGenerator:
         self.template_name_format = self.model.NAME_FORMAT
         self.data = data
         self._type = data["prompt_type"]
+        self.openai_model = model_router.choose_model(self._type, self.language)
+        self.__prompt = None
 
-    def __get_template(self) -> str:
+    def __get_template(self) -> prompt_templates.CompiledTemplate:
         template_name = self.template_name_format.format(
             type=self._type, language=self.language
         ).upper()
-        template = self.model.get_template(template_name)
+        template = prompt_templates.get_template(template_name)
 
         assert template is not None, f"Template with name `{template_name}` not found."
         return template
 
+    def __get_budgeted_data(self) -> dict:
+        """the product data with the long fields trimmed to their token budget"""
+        budgets = {
+            "product_name": int(os.getenv("OPENAI_NAME_TOKENS", 128)),
+            "keywords": int(os.getenv("OPENAI_KEYWORDS_TOKENS", 128)),
+            "product_description": int(os.getenv("OPENAI_DESCRIPTION_TOKENS", 256)),
+            "product_seo_title": int(os.getenv("OPENAI_SEO_TITLE_TOKENS", 64)),
+        }
+
+        data = {**self.data}
+        for field, budget in budgets.items():
+            if data.get(field):
+                data[field] = tokens.trim_to_budget(data[field], budget, self.openai_model)
+        return data
+
     def get_prompt(self) -> str:
-        template = self.__get_template().format(**self.data)
-        return template
+        # rendered once, `get_constraints` measures the same prompt
+        if self.__prompt is None:
+            self.__prompt = self.__get_template().render(self.__get_budgeted_data())
+        return self.__prompt
 
     def get_constraints(self):
-        return {
-            self.Types.SEO_TITLE: {
-                "max_tokens": 70,
-            },
-            self.Types.SEO_DESCRIPTION: {
-                "max_tokens": 140,
-            },
-        }.get(self._type, {})
+        """the model routed for the type and language, and the completion
+        tokens of the type within what the prompt leaves of its context"""
+        desired = {
+            self.Types.SEO_TITLE: 70,
+            self.Types.SEO_DESCRIPTION: 140,
+        }.get(self._type, int(os.getenv("OPENAI_MAX_TOKEN", 512)))
+        max_tokens = tokens.get_max_tokens(self.get_prompt(), self.openai_model, desired)
+
+        return {"max_tokens": max_tokens, "model": self.openai_model}
 
     @classmethod
     def get_prompt_types(cls) -> list:
@@ -330,14 +1044,19 @@ class SallaWebhook:
             WebhookEvents.SUBSCRIPTION_EXPIRED.value: self.__subscription_expired,
             WebhookEvents.SUBSCRIPTION_CANCELLED.value: self.__subscription_cancelled,
             WebhookEvents.APP_UNINSTALLED.value: self.__subscription_cancelled,
+            WebhookEvents.PRODUCT_CREATED.value: self.__product_updated,
+            WebhookEvents.PRODUCT_UPDATED.value: self.__product_updated,
+            WebhookEvents.PRODUCT_DELETED.value: self.__product_deleted,
         }.get(self.event)
 
         if self.event_handler is None:
             raise SallaWebhookFailureException(f"Event {self.event} not found.")
 
     def __get_salla_user(self) -> Account:
-        # return SallaUser.objects.filter(merchant__id=self.merchant_id).first()
         user = SallaUser.objects.filter(store__salla_id=self.merchant_id).first()
+        if user is None:
+            # the store of a new account is pulled in the background
+            user = SallaUser.objects.filter(merchant__id=self.merchant_id).first()
         if user is None and self.event != WebhookEvents.AUTHORIZED.value:
             raise SallaWebhookFailureException("User not found")
         return user
@@ -412,6 +1131,23 @@ class SallaWebhook:
         self.__stop_subscriptions()
         return {"status": "success"}
 
+    def __evict_product_cache(self) -> None:
+        account = getattr(self.salla_user, "account", None)
+        if account is not None:
+            salla_cache.invalidate_product(account.access_token, self.data["id"])
+
+    def __product_updated(self) -> dict:
+        from app.models import SallaProduct
+
+        SallaProduct.upsert(self.salla_user, self.data)
+        self.__evict_product_cache()
+        return {"status": "success"}
+
+    def __product_deleted(self) -> dict:
+        self.salla_user.products.filter(salla_id=str(self.data["id"])).delete()
+        self.__evict_product_cache()
+        return {"status": "success"}
+
     def __log_to_db(self, response: dict) -> None:
         from app.serializers import SallaWebhookLogSerializer
 
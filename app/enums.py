@@ -19,3 +19,13 @@ class WebhookEvents(Enum):
 
     APP_UNINSTALLED = 'app.uninstalled'
 
+    PRODUCT_CREATED = 'product.created'
+    PRODUCT_UPDATED = 'product.updated'
+    PRODUCT_DELETED = 'product.deleted'
+
+
+
+class Priority(Enum):
+    # interactive requests may use the tokens background traffic leaves
+    INTERACTIVE = 'interactive'
+    BACKGROUND = 'background'
@@ -19,3 +19,27 @@ class SallaWebhookFailureException(APIException):
     default_detail = 'Webhook Failure.'
     default_code = 'error'
     status_code = status.HTTP_400_BAD_REQUEST
+
+
+class SallaRateLimitedException(SallaEndpointFailureException):
+    default_detail = 'Too many requests to Salla, try again shortly.'
+    default_code = 'error'
+    status_code = status.HTTP_429_TOO_MANY_REQUESTS
+
+
+class SallaCircuitOpenException(SallaEndpointFailureException):
+    default_detail = 'Salla is not responding right now, try again later.'
+    default_code = 'error'
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+
+class PromptTooLongException(APIException):
+    default_detail = 'The product data is too long to ask about, shorten it and try again.'
+    default_code = 'error'
+    status_code = status.HTTP_400_BAD_REQUEST
+
+
+class OpenAIRateLimitedException(APIException):
+    default_detail = 'The AI service is busy right now, try again shortly.'
+    default_code = 'error'
+    status_code = status.HTTP_429_TOO_MANY_REQUESTS
@@ -0,0 +1,100 @@
+"""Shared keep-alive HTTP sessions used to talk to Salla.
+
+One `requests.Session` is kept per process, so the TCP+TLS handshake to the
+Salla API is paid once per pooled connection instead of once per call.
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from app import metrics
+
+# connections kept alive per host
+POOL_SIZE = int(os.getenv('SALLA_HTTP_POOL_SIZE', 10))
+# number of hosts (salla api, salla accounts, ...) kept in the pool manager
+POOL_HOSTS = int(os.getenv('SALLA_HTTP_POOL_HOSTS', 4))
+# wait for a free connection instead of opening extra ones
+POOL_BLOCK = os.getenv('SALLA_HTTP_POOL_BLOCK', 'True') == 'True'
+
+CONNECT_TIMEOUT = float(os.getenv('SALLA_HTTP_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.getenv('SALLA_HTTP_READ_TIMEOUT', 20))
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        metrics.incr('salla_http.new_connections')
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        metrics.incr('salla_http.new_connections')
+        return super()._new_conn()
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that counts requests and newly opened connections,
+    the difference between them is the number of reused connections"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        metrics.incr('salla_http.requests')
+        return super().send(request, **kwargs)
+
+
+_lock = threading.Lock()
+_state = {'pid': None, 'session': None}
+
+
+def _create_session() -> requests.Session:
+    adapter = PooledHTTPAdapter(
+        pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE, pool_block=POOL_BLOCK
+    )
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+def get_session() -> requests.Session:
+    """Return the session of the current process,
+    a forked worker must not reuse the sockets of its parent"""
+    pid = os.getpid()
+
+    with _lock:
+        if _state['pid'] != pid:
+            _state['session'] = _create_session()
+            _state['pid'] = pid
+
+        return _state['session']
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault('timeout', TIMEOUT)
+    return get_session().request(method, url, **kwargs)
+
+
+def get_connection_stats() -> dict:
+    requests_count = metrics.get('salla_http.requests')
+    new_connections = metrics.get('salla_http.new_connections')
+
+    return {
+        'requests': requests_count,
+        'new_connections': new_connections,
+        'reused_connections': max(requests_count - new_connections, 0),
+    }
+
+
+metrics.register_state('http_pool', get_connection_stats)
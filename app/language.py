@@ -0,0 +1,76 @@
+"""Language detection of the product names, arabic or english.
+
+The letters of the text are counted by their unicode script, the text is
+of the dominant script when it has enough of the letters. Only the
+ambiguous texts, mixed or without letters, are left to langdetect.
+"""
+import os
+import re
+import string
+import logging
+from functools import lru_cache
+
+import langdetect
+
+logger = logging.getLogger('main')
+
+LANGUAGES = ('en', 'ar')
+# ratio of the letters the dominant script must have
+THRESHOLD = float(os.getenv('LANGUAGE_DETECTION_THRESHOLD', 0.8))
+
+ARABIC_LETTERS = re.compile(r'[\u0621-\u064A\u066E-\u06D3\u06FA-\u06FF\u0750-\u077F\u08A0-\u08FF\uFB50-\uFDFF\uFE70-\uFEFF]')
+LATIN_LETTERS = re.compile(r'[A-Za-z\u00C0-\u024F]')
+
+# langdetect is random unless seeded
+langdetect.DetectorFactory.seed = 0
+
+
+def normalize(text: str) -> str:
+    return re.sub(r'\s+', ' ', text or '').strip().lower()
+
+
+def classify(text: str) -> tuple:
+    """Return `(language, confidence)` by the scripts of the letters,
+    `(None, 0)` when the text has no letters"""
+    arabic = len(ARABIC_LETTERS.findall(text))
+    latin = len(LATIN_LETTERS.findall(text))
+
+    if not arabic + latin:
+        return None, 0
+    if arabic >= latin:
+        return 'ar', arabic / (arabic + latin)
+    return 'en', latin / (arabic + latin)
+
+
+def _detect_slow(text: str) -> str:
+    try:
+        language = langdetect.detect(text)
+    except langdetect.LangDetectException:
+        language = None
+
+    if language not in LANGUAGES:
+        # determine the language by the first character
+        garbage = string.whitespace + string.punctuation + string.digits
+        cleaned_text = text.strip(garbage) or 'Empty text'
+
+        language = 'en' if cleaned_text[0] in string.ascii_letters else 'ar'
+    return language
+
+
+@lru_cache(maxsize=int(os.getenv('LANGUAGE_DETECTION_CACHE_SIZE', 8192)))
+def _detect(normalized: str) -> str:
+    language, confidence = classify(normalized)
+    if language is not None and confidence >= THRESHOLD:
+        return language
+    return _detect_slow(normalized)
+
+
+def detect(text: str) -> str:
+    """Return the language of the text"""
+    return _detect(normalize(text))
+
+
+def detect_many(texts: list) -> list:
+    """the languages of the texts, each distinct text is detected once"""
+    languages = {normalized: _detect(normalized) for normalized in set(map(normalize, texts))}
+    return [languages[normalize(text)] for text in texts]
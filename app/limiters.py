@@ -0,0 +1,248 @@
+"""Per merchant rate limiting of the calls made to Salla.
+
+Every merchant access token has a token bucket shared by all the processes
+(in redis, or in memory when running locally). The bucket is refilled at
+the rate Salla allows and corrected by the rate-limit headers Salla returns,
+so requests are paced before Salla starts rejecting them.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+from asgiref.sync import sync_to_async
+
+from app import metrics, shared
+from app.enums import Priority
+from app.exceptions import SallaRateLimitedException
+from app.salla_cache import get_merchant_key
+
+logger = logging.getLogger('main')
+
+# used until Salla tells us the real limit through the headers
+DEFAULT_LIMIT = int(os.getenv('SALLA_RATE_LIMIT', 120))
+# seconds the limit applies to
+WINDOW = int(os.getenv('SALLA_RATE_LIMIT_WINDOW', 60))
+# ratio of the bucket background traffic must leave for interactive requests
+INTERACTIVE_RESERVE = float(os.getenv('SALLA_RATE_LIMIT_INTERACTIVE_RESERVE', 0.2))
+# seconds a request may wait for a token before giving up
+MAX_WAIT = {
+    Priority.INTERACTIVE: float(os.getenv('SALLA_RATE_LIMIT_MAX_WAIT', 10)),
+    Priority.BACKGROUND: float(os.getenv('SALLA_RATE_LIMIT_BACKGROUND_MAX_WAIT', 300)),
+}
+
+RESERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local floor = tonumber(ARGV[2])
+local window = tonumber(ARGV[4])
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at', 'blocked_until', 'capacity')
+local capacity = tonumber(state[4]) or tonumber(ARGV[3])
+local rate = capacity / window
+local tokens = tonumber(state[1]) or capacity
+local updated_at = tonumber(state[2]) or now
+local blocked_until = tonumber(state[3]) or 0
+
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+
+local wait = 0
+if blocked_until > now then
+    wait = blocked_until - now
+else
+    local needed = 1 + floor * capacity
+    if tokens >= needed then
+        tokens = tokens - 1
+    else
+        wait = (needed - tokens) / rate
+    end
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now), 'capacity', tostring(capacity))
+redis.call('EXPIRE', KEYS[1], window * 10)
+return tostring(wait)
+"""
+
+OBSERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local remaining = tonumber(ARGV[3])
+local blocked_until = tonumber(ARGV[4])
+local window = tonumber(ARGV[5])
+
+if limit then
+    redis.call('HSET', KEYS[1], 'capacity', tostring(limit))
+end
+if remaining then
+    local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+    if tokens == nil or remaining < tokens then
+        redis.call('HSET', KEYS[1], 'tokens', tostring(remaining), 'updated_at', tostring(now))
+    end
+end
+if blocked_until then
+    local current = tonumber(redis.call('HGET', KEYS[1], 'blocked_until')) or 0
+    if blocked_until > current then
+        redis.call('HSET', KEYS[1], 'blocked_until', tostring(blocked_until))
+    end
+end
+
+redis.call('EXPIRE', KEYS[1], window * 10)
+return 1
+"""
+
+
+class RedisBucketStore:
+    def __init__(self, client) -> None:
+        self.reserve_script = client.register_script(RESERVE_SCRIPT)
+        self.observe_script = client.register_script(OBSERVE_SCRIPT)
+
+    def reserve(self, key: str, now: float, floor: float) -> float:
+        """take a token, or return how many seconds to wait for one"""
+        wait = self.reserve_script(keys=[key], args=[now, floor, DEFAULT_LIMIT, WINDOW])
+        return float(wait)
+
+    def observe(self, key: str, now: float, limit, remaining, blocked_until) -> None:
+        args = [now, limit, remaining, blocked_until, WINDOW]
+        args = ['' if arg is None else arg for arg in args]
+        self.observe_script(keys=[key], args=args)
+
+
+class LocalBucketStore:
+    """Process local stand-in of `RedisBucketStore`"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def __get_bucket(self, key: str, now: float) -> dict:
+        bucket = self.buckets.setdefault(key, {
+            'tokens': DEFAULT_LIMIT, 'updated_at': now,
+            'blocked_until': 0, 'capacity': DEFAULT_LIMIT,
+        })
+        rate = bucket['capacity'] / WINDOW
+        elapsed = max(0, now - bucket['updated_at'])
+
+        bucket['tokens'] = min(bucket['capacity'], bucket['tokens'] + elapsed * rate)
+        bucket['updated_at'] = now
+        return bucket
+
+    def reserve(self, key: str, now: float, floor: float) -> float:
+        with self.lock:
+            bucket = self.__get_bucket(key, now)
+            if bucket['blocked_until'] > now:
+                return bucket['blocked_until'] - now
+
+            needed = 1 + floor * bucket['capacity']
+            if bucket['tokens'] >= needed:
+                bucket['tokens'] -= 1
+                return 0
+            return (needed - bucket['tokens']) / (bucket['capacity'] / WINDOW)
+
+    def observe(self, key: str, now: float, limit, remaining, blocked_until) -> None:
+        with self.lock:
+            bucket = self.__get_bucket(key, now)
+            if limit is not None:
+                bucket['capacity'] = limit
+            if remaining is not None:
+                bucket['tokens'] = min(bucket['tokens'], remaining)
+            if blocked_until is not None:
+                bucket['blocked_until'] = max(bucket['blocked_until'], blocked_until)
+
+
+_local_store = LocalBucketStore()
+
+
+def get_bucket_store():
+    client = shared.get_redis()
+    if client is None:
+        return _local_store
+    return RedisBucketStore(client)
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_rate_limit_headers(headers, now: float) -> tuple:
+    """Return `(limit, remaining, blocked_until)` from salla response headers"""
+    limit = _to_number(headers.get('X-RateLimit-Limit'))
+    remaining = _to_number(headers.get('X-RateLimit-Remaining'))
+    blocked_until = None
+
+    reset = _to_number(headers.get('X-RateLimit-Reset'))
+    if remaining is not None and remaining <= 0 and reset is not None:
+        # reset is either a timestamp or seconds from now
+        blocked_until = reset if reset > now else now + reset
+
+    retry_after = headers.get('Retry-After')
+    if retry_after is not None:
+        seconds = _to_number(retry_after)
+        if seconds is None:
+            try:
+                seconds = parsedate_to_datetime(retry_after).timestamp() - now
+            except (TypeError, ValueError):
+                seconds = None
+        if seconds is not None:
+            blocked_until = max(blocked_until or 0, now + seconds)
+
+    return limit, remaining, blocked_until
+
+
+class SallaRateLimiter:
+    """Token bucket of a merchant, shared by all the processes"""
+
+    def __init__(self, access_token: str) -> None:
+        self.key = f'salla:ratelimit:{get_merchant_key(access_token)}'
+        self.store = get_bucket_store()
+
+    def __reserve(self, priority: Priority) -> float:
+        floor = 0 if priority == Priority.INTERACTIVE else INTERACTIVE_RESERVE
+        try:
+            return self.store.reserve(self.key, time.time(), floor)
+        except Exception as e:
+            # never block salla calls because the limiter is down
+            logger.error(f'[RATE_LIMIT] {e!r}')
+            return 0
+
+    def __check_wait(self, waited: float, wait: float, priority: Priority) -> None:
+        if waited + wait > MAX_WAIT[priority]:
+            metrics.incr('salla_rate_limit.rejected')
+            raise SallaRateLimitedException()
+        metrics.incr('salla_rate_limit.waits')
+
+    def acquire(self, priority: Priority = Priority.INTERACTIVE) -> None:
+        """block until a token of the bucket is taken"""
+        waited = 0
+        while wait := self.__reserve(priority):
+            self.__check_wait(waited, wait, priority)
+            time.sleep(wait)
+            waited += wait
+
+    async def acquire_async(self, priority: Priority = Priority.INTERACTIVE) -> None:
+        # the store calls redis synchronously, keep them off the event loop
+        reserve = sync_to_async(self.__reserve, thread_sensitive=False)
+
+        waited = 0
+        while wait := await reserve(priority):
+            self.__check_wait(waited, wait, priority)
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def observe(self, headers) -> None:
+        """correct the bucket by the rate-limit headers salla returned"""
+        now = time.time()
+        limit, remaining, blocked_until = parse_rate_limit_headers(headers, now)
+        if limit is None and remaining is None and blocked_until is None:
+            return
+
+        try:
+            self.store.observe(self.key, now, limit, remaining, blocked_until)
+        except Exception as e:
+            logger.error(f'[RATE_LIMIT] {e!r}')
+
+    async def observe_async(self, headers) -> None:
+        await sync_to_async(self.observe, thread_sensitive=False)(headers)
@@ -0,0 +1,156 @@
+"""Exact-match cache of the OpenAI completions.
+
+Completions are asked with `temperature=0`, so the same prompt to the same
+model with the same `max_tokens` gives the same answer. Entries are kept in
+a redis hash indexed by a sorted set of their store time (in memory when
+running locally), entries older than the ttl are misses and the oldest
+entries are evicted once the cache holds more than its max size.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from app import metrics, shared
+
+logger = logging.getLogger('main')
+
+IS_ENABLED = os.getenv('OPENAI_CACHE_ENABLED', 'True') == 'True'
+TTL = int(os.getenv('OPENAI_CACHE_TTL', 60 * 60 * 24 * 7))
+MAX_ENTRIES = int(os.getenv('OPENAI_CACHE_MAX_ENTRIES', 10000))
+
+ENTRIES_KEY = 'llm:cache:entries'
+INDEX_KEY = 'llm:cache:index'
+
+GET_SCRIPT = """
+local stored_at = tonumber(redis.call('ZSCORE', KEYS[2], ARGV[1]))
+if stored_at == nil then
+    return false
+end
+if stored_at < tonumber(ARGV[2]) then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    return false
+end
+return redis.call('HGET', KEYS[1], ARGV[1])
+"""
+
+SET_SCRIPT = """
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+
+local extra = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if extra > 0 then
+    local evicted = redis.call('ZRANGE', KEYS[2], 0, extra - 1)
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, extra - 1)
+    redis.call('HDEL', KEYS[1], unpack(evicted))
+end
+return 1
+"""
+
+
+class RedisCacheStore:
+    def __init__(self, client) -> None:
+        self.get_script = client.register_script(GET_SCRIPT)
+        self.set_script = client.register_script(SET_SCRIPT)
+
+    def get(self, key: str, now: float):
+        value = self.get_script(keys=[ENTRIES_KEY, INDEX_KEY], args=[key, now - TTL])
+        return value.decode() if value is not None else None
+
+    def set(self, key: str, value: str, now: float) -> None:
+        self.set_script(keys=[ENTRIES_KEY, INDEX_KEY], args=[key, value, now, MAX_ENTRIES])
+
+
+class LocalCacheStore:
+    """Process local stand-in of `RedisCacheStore`, least recently stored first"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key: str, now: float):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            value, stored_at = entry
+            if stored_at < now - TTL:
+                del self.entries[key]
+                return None
+            return value
+
+    def set(self, key: str, value: str, now: float) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, now)
+            while len(self.entries) > MAX_ENTRIES:
+                self.entries.popitem(last=False)
+
+
+_local_store = LocalCacheStore()
+
+
+def get_store():
+    client = shared.get_redis()
+    if client is None:
+        return _local_store
+    return RedisCacheStore(client)
+
+
+def normalize_prompt(prompt: str) -> str:
+    return re.sub(r'\s+', ' ', prompt).strip()
+
+
+def get_key(model: str, prompt: str, max_tokens: int) -> str:
+    content = json.dumps([model, normalize_prompt(prompt), max_tokens])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def get(key: str):
+    """Return the cached openai response, None on a miss"""
+    if not IS_ENABLED:
+        return None
+
+    try:
+        value = get_store().get(key, time.time())
+    except Exception as e:
+        # never let the cache take down the completions
+        logger.error(f'[LLM_CACHE] {e!r}')
+        return None
+
+    metrics.incr('llm_cache.hit' if value is not None else 'llm_cache.miss')
+    return json.loads(value) if value is not None else None
+
+
+def as_hit(response: dict) -> dict:
+    """the cached response as served again, it spent no tokens this time"""
+    usage = response.get('usage') or {}
+    return {
+        **response,
+        'usage': {**usage, 'total_tokens': 0, 'cached_total_tokens': usage.get('total_tokens', 0)},
+        'is_cache_hit': True,
+    }
+
+
+def store(key: str, response: dict) -> None:
+    if not IS_ENABLED:
+        return
+
+    try:
+        get_store().set(key, json.dumps(response), time.time())
+    except Exception as e:
+        logger.error(f'[LLM_CACHE] {e!r}')
+
+
+def get_hit_rate() -> float:
+    hits, misses = metrics.get('llm_cache.hit'), metrics.get('llm_cache.miss')
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+metrics.register_state('llm_cache_hit_rate', get_hit_rate)
@@ -0,0 +1,85 @@
+import random
+import timeit
+
+import langdetect
+from django.core.management.base import BaseCommand
+
+from app import language
+
+SAMPLES = [
+    'Red cotton dress',
+    'Wireless bluetooth headphones with noise cancelling',
+    'فستان قطن أحمر',
+    'سماعات لاسلكية بلوتوث',
+    'iPhone 14 Pro Max 256GB',
+    'عطر Dior Sauvage 100ml',
+    'Café crème 500g',
+    'حذاء رياضي Nike Air',
+]
+
+
+class Command(BaseCommand):
+    help = 'Compare the script based language detection with langdetect'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--names', type=int, default=1000, help='product names to detect')
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        names = [f'{rng.choice(SAMPLES)} {index}' for index in range(options['names'])]
+
+        def run_langdetect():
+            for name in names:
+                try:
+                    langdetect.detect(name)
+                except langdetect.LangDetectException:
+                    pass
+
+        def run_classifier():
+            language._detect.cache_clear()
+            for name in names:
+                language.detect(name)
+
+        def run_memoized():
+            for name in names:
+                language.detect(name)
+
+        def run_batch():
+            language._detect.cache_clear()
+            language.detect_many(names)
+
+        # load the langdetect profiles before timing it
+        run_langdetect()
+        run_memoized()
+
+        timings = {
+            'langdetect': run_langdetect,
+            'script classifier': run_classifier,
+            'script classifier, memoized': run_memoized,
+            'script classifier, batch': run_batch,
+        }
+        for name, function in timings.items():
+            seconds = min(timeit.repeat(function, number=1, repeat=options['repeat']))
+            self.stdout.write(
+                f'{name:<30} {seconds * 1000:9.2f} ms  {seconds * 1e6 / len(names):8.2f} us/name'
+            )
+
+        ambiguous = 0
+        agreement = compared = 0
+        for name in names:
+            detected, confidence = language.classify(language.normalize(name))
+            if detected is None or confidence < language.THRESHOLD:
+                ambiguous += 1
+
+            try:
+                expected = langdetect.detect(name)
+            except langdetect.LangDetectException:
+                continue
+            if expected in language.LANGUAGES:
+                compared += 1
+                agreement += language.detect(name) == expected
+
+        self.stdout.write(f'left to langdetect: {ambiguous / len(names):.1%}')
+        if compared:
+            self.stdout.write(f'agreement where langdetect says en or ar: {agreement / compared:.1%}')
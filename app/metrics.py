@@ -0,0 +1,67 @@
+import os
+import time
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger('main')
+
+# How often (seconds) the counters of this process are written to the log
+LOG_INTERVAL = int(os.getenv('METRICS_LOG_INTERVAL', 300))
+
+_lock = threading.Lock()
+_counters = Counter()
+_last_logged_at = time.monotonic()
+# name to callable returning the current state of a component, see `register_state`
+_states = {}
+
+
+def incr(name: str, value: int = 1) -> None:
+    """Increment a process-local counter"""
+    with _lock:
+        _counters[name] += value
+
+    _maybe_log()
+
+
+def get(name: str) -> int:
+    with _lock:
+        return _counters[name]
+
+
+def snapshot() -> dict:
+    """Return a copy of all counters of the current process"""
+    with _lock:
+        return dict(_counters)
+
+
+def register_state(name: str, get_state) -> None:
+    """Log `get_state()` with the counters, for the states that aren't counters"""
+    with _lock:
+        _states[name] = get_state
+
+
+def get_states() -> dict:
+    with _lock:
+        states = dict(_states)
+
+    result = {}
+    for name, get_state in states.items():
+        try:
+            result[name] = get_state()
+        except Exception as e:
+            logger.error(f'[METRICS] {name}: {e!r}')
+    return result
+
+
+def _maybe_log() -> None:
+    global _last_logged_at
+
+    now = time.monotonic()
+    with _lock:
+        if now - _last_logged_at < LOG_INTERVAL:
+            return
+        _last_logged_at = now
+        counters = dict(_counters)
+
+    logger.info(f'[METRICS] pid={os.getpid()} {counters} {get_states()}')
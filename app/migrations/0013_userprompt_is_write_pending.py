@@ -0,0 +1,18 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_sallausersubscription_price'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprompt',
+            name='is_write_pending',
+            field=models.BooleanField(default=False),
+        ),
+    ]
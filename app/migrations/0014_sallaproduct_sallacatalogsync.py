@@ -0,0 +1,53 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_userprompt_is_write_pending'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SallaCatalogSync',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('running', 'running'), ('completed', 'completed'), ('failed', 'failed')], default='running', max_length=16)),
+                ('next_page', models.PositiveIntegerField(default=1)),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='catalog_sync', to='app.sallauser')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SallaProduct',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('salla_id', models.CharField(db_index=True, max_length=64)),
+                ('name', models.CharField(blank=True, max_length=512, null=True)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('metadata_title', models.CharField(blank=True, max_length=512, null=True)),
+                ('metadata_description', models.TextField(blank=True, null=True)),
+                ('main_image', models.URLField(blank=True, max_length=1024, null=True)),
+                ('images', models.JSONField(default=list)),
+                ('status', models.CharField(blank=True, max_length=32, null=True)),
+                ('price', models.JSONField(default=dict)),
+                ('payload', models.JSONField(default=dict)),
+                ('position', models.IntegerField(default=0)),
+                ('synced_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='products', to='app.sallauser')),
+            ],
+            options={
+                'ordering': ('position', 'id'),
+                'unique_together': {('user', 'salla_id')},
+            },
+        ),
+    ]
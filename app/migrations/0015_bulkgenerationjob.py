@@ -0,0 +1,34 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_sallaproduct_sallacatalogsync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkGenerationJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prompt_types', models.JSONField(default=list)),
+                ('keywords', models.CharField(blank=True, max_length=256, null=True)),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('completed', 'completed'), ('quota_exceeded', 'quota_exceeded'), ('failed', 'failed')], default='pending', max_length=16)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('next_page', models.PositiveIntegerField(default=1)),
+                ('total_products', models.PositiveIntegerField(default=0)),
+                ('processed_products', models.PositiveIntegerField(default=0)),
+                ('generated_prompts', models.PositiveIntegerField(default=0)),
+                ('failed_prompts', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bulk_generation_jobs', to='app.sallauser')),
+            ],
+        ),
+    ]
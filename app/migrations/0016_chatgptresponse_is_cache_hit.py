@@ -0,0 +1,18 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_bulkgenerationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatgptresponse',
+            name='is_cache_hit',
+            field=models.BooleanField(default=False),
+        ),
+    ]
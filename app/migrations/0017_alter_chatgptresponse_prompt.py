@@ -0,0 +1,18 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_chatgptresponse_is_cache_hit'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatgptresponse',
+            name='prompt',
+            field=models.TextField(),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1.7 on 2026-10-18 09:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_alter_chatgptresponse_prompt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatgptresponse',
+            name='reused_from',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reuses', to='app.chatgptresponse'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.1.7 on 2026-10-18 09:10
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def count_used_prompts(apps, schema_editor):
+    SallaUserSubscription = apps.get_model('app', 'SallaUserSubscription')
+    UserPrompt = apps.get_model('app', 'UserPrompt')
+
+    for subscription in SallaUserSubscription.objects.filter(is_active=True):
+        ends_at = subscription.created_at + (subscription.plan_period or timedelta(days=1000))
+        subscription.used_prompts = UserPrompt.objects.filter(
+            user_id=subscription.user_id,
+            created_at__gte=subscription.created_at,
+            created_at__lte=ends_at,
+            chat_gpt_response__isnull=False,
+            # the reused and the cached answers aren't charged, like `UserPrompt.count_for_user`
+            chat_gpt_response__reused_from__isnull=True,
+            chat_gpt_response__is_cache_hit=False,
+        ).count()
+        subscription.save(update_fields=['used_prompts'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0018_chatgptresponse_reused_from'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sallausersubscription',
+            name='used_prompts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_used_prompts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.7 on 2026-10-18 09:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_sallausersubscription_used_prompts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sallausersubscription',
+            name='reserved_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='sallausersubscription',
+            name='reserved_prompts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
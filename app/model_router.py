@@ -0,0 +1,129 @@
+"""Choice of the OpenAI model of a prompt.
+
+Every prompt type and language is routed to a model and a fallback model by
+the `OPENAI_MODEL_ROUTES` table, a json object like
+`{"seo_title:*": {"model": "gpt-3.5-turbo"}, "*:ar": {"model": "gpt-4",
+"fallback": "gpt-3.5-turbo"}}`. The latency and the errors of every model
+are tracked over a rolling window, the traffic shifts to the fallback while
+the p95 latency or the error rate of the model cross their thresholds.
+"""
+import os
+import json
+import math
+import time
+import logging
+import threading
+from collections import deque
+
+from app import metrics
+
+logger = logging.getLogger('main')
+
+DEFAULT_MODEL = os.getenv('OPENAI_MODEL', 'text-davinci-003')
+DEFAULT_FALLBACK_MODEL = os.getenv('OPENAI_FALLBACK_MODEL', 'gpt-3.5-turbo')
+ROUTES = json.loads(os.getenv('OPENAI_MODEL_ROUTES', '{}'))
+
+WINDOW = float(os.getenv('OPENAI_ROUTER_WINDOW_SECONDS', 300))
+# fewer calls than that in the window are not enough to judge a model
+MIN_SAMPLES = int(os.getenv('OPENAI_ROUTER_MIN_SAMPLES', 20))
+MAX_P95_LATENCY = float(os.getenv('OPENAI_ROUTER_MAX_P95_SECONDS', 15))
+MAX_ERROR_RATE = float(os.getenv('OPENAI_ROUTER_MAX_ERROR_RATE', 0.2))
+
+CHAT_MODEL_PREFIXES = ('gpt-3.5-turbo', 'gpt-4')
+
+
+def is_chat_model(model: str) -> bool:
+    """chat models are only served by the chat completions endpoint"""
+    return model.startswith(CHAT_MODEL_PREFIXES)
+
+
+class ModelStats:
+    """Latency and errors of the calls to a model in this process"""
+
+    def __init__(self, model: str) -> None:
+        self.model = model
+        self.lock = threading.Lock()
+        self.samples = deque()
+
+    def __prune(self, now: float) -> None:
+        while self.samples and self.samples[0][0] < now - WINDOW:
+            self.samples.popleft()
+
+    def record(self, latency: float, is_error: bool = False) -> None:
+        now = time.monotonic()
+        with self.lock:
+            self.samples.append((now, latency, is_error))
+            self.__prune(now)
+
+    def get_summary(self) -> dict:
+        with self.lock:
+            self.__prune(time.monotonic())
+            latencies = sorted(latency for _, latency, is_error in self.samples if not is_error)
+            errors = sum(1 for _, _, is_error in self.samples if is_error)
+            count = len(self.samples)
+
+        p95 = latencies[math.ceil(len(latencies) * 0.95) - 1] if latencies else None
+        return {
+            'count': count,
+            'p95_latency': p95,
+            'error_rate': errors / count if count else 0.0,
+        }
+
+    @property
+    def is_healthy(self) -> bool:
+        summary = self.get_summary()
+        if summary['count'] < MIN_SAMPLES:
+            return True
+
+        is_slow = summary['p95_latency'] is not None and summary['p95_latency'] > MAX_P95_LATENCY
+        return not is_slow and summary['error_rate'] <= MAX_ERROR_RATE
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_stats(model: str) -> ModelStats:
+    with _stats_lock:
+        if model not in _stats:
+            _stats[model] = ModelStats(model)
+        return _stats[model]
+
+
+def record(model: str, latency: float, is_error: bool = False) -> None:
+    get_stats(model).record(latency, is_error)
+
+
+def get_route(prompt_type: str, language: str) -> tuple:
+    """Return `(model, fallback)` of the most specific route"""
+    for key in (f'{prompt_type}:{language}', f'{prompt_type}:*', f'*:{language}', '*:*'):
+        if key in ROUTES:
+            route = ROUTES[key]
+            return route.get('model', DEFAULT_MODEL), route.get('fallback', DEFAULT_FALLBACK_MODEL)
+
+    return DEFAULT_MODEL, DEFAULT_FALLBACK_MODEL
+
+
+def choose_model(prompt_type: str, language: str) -> str:
+    model, fallback = get_route(prompt_type, language)
+    if not fallback or fallback == model or get_stats(model).is_healthy:
+        return model
+
+    if not get_stats(fallback).is_healthy:
+        # both are struggling, the fallback has no reason to be better
+        return model
+
+    metrics.incr('openai_router.fallback')
+    logger.info(f'[MODEL_ROUTER] {prompt_type}:{language} routed from {model} to {fallback}')
+    return fallback
+
+
+def get_states() -> dict:
+    """stats of every model of this process, for monitoring"""
+    with _stats_lock:
+        stats = list(_stats.values())
+
+    return {model_stats.model: model_stats.get_summary() for model_stats in stats}
+
+
+metrics.register_state('model_router', get_states)
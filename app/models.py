@@ -1,15 +1,22 @@
 import os
 import time
+import random
+import string
 import math
+import logging
+from datetime import timedelta
 from typing import List, Tuple
 
 from django.db import models
+from django.db.models.functions import Greatest
 from django.contrib.auth.models import AbstractBaseUser
 from django.utils import timezone
 
 from app import utils
 from app import managers
 
+logger = logging.getLogger('main')
+
 
 def CHATGPT_PROMPT_TYPES():
     from app.controllers import ChatGPTProductPromptGenerator
@@ -49,6 +56,53 @@ class SallaUser(AbstractBaseUser):
 
         return super().save(*args, **kwargs)
 
+    @classmethod
+    def upsert(cls, user_data: dict) -> 'SallaUser':
+        """create or update the user from its salla payload"""
+        from app.serializers import SallaUserSerializer
+
+        user_data = {**user_data, 'salla_id': user_data['id']}
+        user_data.pop('id')
+
+        user = cls.objects.filter(salla_id=user_data['salla_id']).first()
+        if user:
+            s = SallaUserSerializer(user, data=user_data)
+        else:
+            s = SallaUserSerializer(data=user_data)
+
+        s.is_valid(raise_exception=True)
+        return s.save()
+
+    def send_welcome_email(self) -> None:
+        """set a new password and send it with the welcome email"""
+        from django.conf import settings
+        from django.core.mail import send_mail
+
+        self.password = ''.join(random.choices(
+            string.ascii_letters+string.digits, k=16))
+        self.save()
+
+        subject = 'مرحبا بك في تفاصيل'
+        message = (
+            f'مرحبًا {self.name},\n\n'
+
+            'مرحبًا في تطبيق "تفاصيل"! إليك تسجيل الدخول:\n'
+            f'- اسم المستخدم: {self.email}\n'
+            f'- كلمة المرور: {self.password}\n\n'
+
+            'استخدمهما للوصول إلى تطبيق "تفاصيل".\n'
+            'للمساعدة، اتصل بفريق الدعم.\n\n'
+
+            'نتمنى لك تجربة ممتعة!\n\n'
+
+            'https://tafaseel.io/\n\n'
+
+            'مع أطيب التحيات،\n'
+            '"تفاصيل"\n'
+            '---'
+        )
+        send_mail(subject, message, settings.EMAIL_HOST_USER, [self.email, ])
+
     @classmethod
     def authenticate(cls, email, password):
         try:
@@ -119,6 +173,8 @@ class Account(models.Model):
                 scope=data.get('scope'),
                 token_type=data.get('token_type'),
             )
+            # the user is already fetched, the pre_save signal doesn't fetch it again
+            instance.user = SallaUser.upsert(user_data)
 
         instance.save()
         return instance
@@ -127,6 +183,33 @@ class Account(models.Model):
     def is_alive(self) -> bool:
         return self.expires_in > int(time.time())
 
+    def onboard(self) -> None:
+        """pull the store and the subscription of the new account at the
+        same time, then welcome the user by email"""
+        import asyncio
+        from asgiref.sync import async_to_sync
+        from django.db import transaction
+        from app.controllers import AsyncSallaMerchantReader, AsyncSallaAppSettingsReader
+        from app.tasks import send_welcome_email
+
+        async def pull():
+            async with AsyncSallaMerchantReader(self) as merchant_reader, \
+                    AsyncSallaAppSettingsReader(self) as settings_reader:
+                return await asyncio.gather(
+                    merchant_reader.get_store(), settings_reader.get_subscription()
+                )
+
+        store_data, subscription_response = async_to_sync(pull)()
+
+        with transaction.atomic():
+            SallaStore.upsert(self.user, store_data)
+            # a subscription or trial webhook may have arrived first, it knows better
+            active = self.user.subscriptions.select_for_update().filter(is_active=True)
+            if not active.exists():
+                SallaUserSubscription.create_from_response(self.user, subscription_response)
+            user_id = self.user_id
+            transaction.on_commit(lambda: send_welcome_email.delay(user_id))
+
     def refresh_access_token(self) -> bool:
         from app.controllers import SallaOAuth
 
@@ -135,8 +218,18 @@ class Account(models.Model):
 
         return True
 
-    def get_homepage_context(self, params: dict ={}) -> dict:
+    def get_products(self, params: dict = None) -> dict:
+        """products page from the local mirror, or from salla while it's cold"""
         from app.controllers import SallaMerchantReader
+
+        products = SallaProduct.get_products_page(self.user, params)
+        if products is None:
+            SallaCatalogSync.schedule(self.user)
+            products = SallaMerchantReader(self).get_products(params)
+
+        return products
+
+    def get_homepage_context(self, params: dict ={}) -> dict:
         from SiteServe.models import StaticPage
 
         context = {
@@ -149,7 +242,7 @@ class Account(models.Model):
             from app.utils import get_static_products
             context.update(get_static_products())
         else:
-            products = SallaMerchantReader(self).get_products(params)
+            products = self.get_products(params)
             context.update({
                 'products': products['data'],
                 'pagination': products['pagination'],
@@ -195,14 +288,38 @@ class SallaStore(models.Model):
     def __str__(self):
         return self.salla_id
 
+    @classmethod
+    def upsert(cls, user: SallaUser, store_data: dict) -> 'SallaStore':
+        """create or update the store of the user from its salla payload"""
+        from app.serializers import SallaStoreSerializer
+
+        store_data = {**store_data, 'salla_id': store_data['id'], 'user': user.pk}
+        store_data.pop('id')
+
+        store = cls.objects.filter(salla_id=store_data['salla_id']).first()
+        if store:
+            s = SallaStoreSerializer(store, data=store_data)
+        else:
+            s = SallaStoreSerializer(data=store_data)
+
+        s.is_valid(raise_exception=True)
+        return s.save()
+
 
 class ChatGPTResponse(models.Model):
     # Rename to ChatGPTResponse
-    prompt = models.CharField(max_length=512)
+    # long product descriptions are trimmed by tokens, not characters
+    prompt = models.TextField()
     total_tokens = models.PositiveSmallIntegerField(default=0)
     answer = models.TextField()
 
     full_response = models.JSONField(default=dict)
+    # answered from the cache of an identical earlier prompt, no tokens spent
+    is_cache_hit = models.BooleanField(default=False)
+    # the accepted answer of a near duplicate product, see `near_duplicates`
+    reused_from = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, related_name='reuses', blank=True, null=True
+    )
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -210,8 +327,27 @@ class ChatGPTResponse(models.Model):
     def __str__(self):
         return self.prompt
 
+    @classmethod
+    def reuse(cls, prompt: str, source: 'ChatGPTResponse') -> 'ChatGPTResponse':
+        """the answer of `source` for the prompt, no tokens spent"""
+        return cls.objects.create(
+            prompt=prompt,
+            answer=source.answer,
+            full_response=source.full_response,
+            reused_from=source,
+        )
+
+    @property
+    def is_charged(self) -> bool:
+        """the answers that cost no tokens, reused from a near duplicate or
+        served from the llm cache, don't count in the plan limits"""
+        return self.reused_from_id is None and not self.is_cache_hit
+
 
 class UserPrompt(models.Model):
+    # seconds a deferred write waits for the other fields of its product
+    WRITE_COALESCE_WINDOW = float(os.getenv('SALLA_WRITE_COALESCE_WINDOW', 2))
+
     user = models.ForeignKey(
         SallaUser, on_delete=models.CASCADE, related_name='prompts'
     )
@@ -228,6 +364,8 @@ class UserPrompt(models.Model):
     prompt_type = models.CharField(max_length=32, choices=CHATGPT_PROMPT_TYPES())
 
     is_accepted = models.BooleanField(blank=True, null=True)
+    # accepted but not written to salla yet, see `flush_writes`
+    is_write_pending = models.BooleanField(default=False)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -259,7 +397,12 @@ class UserPrompt(models.Model):
             'user': user, 'created_at__gte': start_date, 'created_at__lte': end_date
         }
         if gpt:
-            lookup.update({'chat_gpt_response__isnull': False})
+            # the reused and the cached answers aren't charged, see `ChatGPTResponse.is_charged`
+            lookup.update({
+                'chat_gpt_response__isnull': False,
+                'chat_gpt_response__reused_from__isnull': True,
+                'chat_gpt_response__is_cache_hit': False,
+            })
         qs = cls.objects.filter(**lookup)
         return qs.count()
 
@@ -268,23 +411,175 @@ class UserPrompt(models.Model):
             return f'[ Manually ] {self.user }: ({self.acceptance_emoji})'
         return f'{self.user }: {self.chat_gpt_response.prompt} ({self.acceptance_emoji})'
 
+    @property
+    def salla_value(self) -> str:
+        if self.chat_gpt_response:
+            return self.chat_gpt_response.answer
+        return self.meta.get('new_value')
+
     def write_to_salla(self):
+        self.queue_write()
+        return self.flush_writes(self.user, self.product_id)
+
+    def queue_write(self) -> None:
+        """mark the prompt to be written with the next flush of its product"""
+        self.is_write_pending = True
+        if self.is_accepted is False:
+            # accepting a declined prompt takes the decline back
+            self.is_accepted = None
+        self.save()
+
+    @classmethod
+    def __get_pending_writes(cls, user, product_ids: List[str]) -> dict:
+        """map every product to its prompts waiting to be written, oldest first"""
+        prompts = (
+            cls.objects
+                .filter(user=user, product_id__in=product_ids, is_write_pending=True)
+                .exclude(is_accepted=False)
+                .select_related('chat_gpt_response')
+                .order_by('id')
+        )
+
+        pending = {}
+        for prompt in prompts:
+            pending.setdefault(prompt.product_id, []).append(prompt)
+        return pending
+
+    @staticmethod
+    def __get_salla_payload(prompts: List['UserPrompt']) -> dict:
+        # later prompts override the earlier ones of the same field
+        return {
+            prompt.salla_understandable_key: prompt.salla_value
+            for prompt in prompts
+        }
+
+    @classmethod
+    def __settle_writes(cls, prompts: List['UserPrompt']) -> None:
+        """mark the written prompts accepted, the failed ones are left
+        pending for the next flush of their product"""
+        cls.objects.filter(pk__in=[prompt.pk for prompt in prompts]).update(
+            is_write_pending=False, is_accepted=True, updated_at=timezone.now()
+        )
+
+    @staticmethod
+    def get_flush_key(user_id: int, product_id: str) -> str:
+        return f'salla-write-flush:{user_id}:{product_id}'
+
+    @classmethod
+    def schedule_flush(cls, user_id: int, product_id: str) -> bool:
+        """flush the pending writes of the product after the window, the
+        fields deferred meanwhile share the flush. Return False when it
+        couldn't be scheduled"""
+        from django.core.cache import cache
+        from app.tasks import flush_product_writes
+
+        key = cls.get_flush_key(user_id, product_id)
+        try:
+            if not cache.add(key, 1, timeout=cls.WRITE_COALESCE_WINDOW + 60):
+                return True
+            flush_product_writes.apply_async(
+                (user_id, product_id), countdown=cls.WRITE_COALESCE_WINDOW, retry=False
+            )
+        except Exception as e:
+            logger.error(f'[SALLA_WRITE] scheduling {user_id} {product_id} failed: {e!r}')
+            try:
+                cache.delete(key)
+            except Exception as e:
+                logger.error(f'[SALLA_WRITE] {e!r}')
+            return False
+        return True
+
+    @classmethod
+    def flush_writes(cls, user, product_id: str):
+        """write all the pending prompts of the product to salla in one PUT,
+        the newest prompt of each field wins. On failure they're kept
+        pending for the next flush of the product"""
         from app.controllers import SallaWriter
 
-        if self.chat_gpt_response:
-            answer = self.chat_gpt_response.answer
-        else:
-            answer = self.meta.get('new_value')
+        prompts = cls.__get_pending_writes(user, [product_id]).get(product_id)
+        if not prompts:
+            return None
 
-        payload = { self.salla_understandable_key: answer }
-        salla_writer = SallaWriter(self.user.account)
-        response = salla_writer.product_update(self.product_id, payload)
+        payload = cls.__get_salla_payload(prompts)
+        try:
+            response = SallaWriter(user.account).product_update(product_id, payload)
+        except Exception as e:
+            logger.error(f'[SALLA_WRITE] {user.pk} {product_id}: {e!r}')
+            raise
 
-        self.accepted()
+        cls.__settle_writes(prompts)
+        SallaProduct.upsert(user, response)
         return response
 
+    @classmethod
+    def flush_writes_concurrently(cls, user, product_ids: List[str]) -> dict:
+        """like `flush_writes` for many products, their PUTs run concurrently.
+        Return the pending prompts of every product with the salla response
+        or the exception raised while writing them, the failed ones are
+        kept pending"""
+        from asgiref.sync import async_to_sync
+        from app.controllers import AsyncSallaWriter
+
+        pending = cls.__get_pending_writes(user, product_ids)
+        bodies = {
+            product_id: cls.__get_salla_payload(prompts)
+            for product_id, prompts in pending.items()
+        }
+
+        async def write():
+            async with AsyncSallaWriter(user.account) as writer:
+                return await writer.products_update(bodies)
+
+        results = async_to_sync(write)() if bodies else {}
+
+        report = {}
+        for product_id, result in results.items():
+            prompts = pending[product_id]
+            if isinstance(result, Exception):
+                logger.error(f'[SALLA_WRITE] {user.pk} {product_id}: {result!r}')
+            else:
+                cls.__settle_writes(prompts)
+                SallaProduct.upsert(user, result)
+            report[product_id] = (prompts, result)
+
+        return report
+
+    @classmethod
+    def bulk_accept(cls, user, prompts: List['UserPrompt']) -> dict:
+        """write the prompts to salla, grouped per product. Return the
+        status of every prompt id"""
+        ids = [prompt.pk for prompt in prompts]
+        accepted = cls.objects.filter(pk__in=ids)
+        # accepting a declined prompt takes the decline back
+        accepted.filter(is_accepted=False).update(is_accepted=None)
+        accepted.update(is_write_pending=True)
+
+        product_ids = {prompt.product_id for prompt in prompts}
+        report = cls.flush_writes_concurrently(user, list(product_ids))
+
+        statuses = {}
+        for product_prompts, result in report.values():
+            for prompt in product_prompts:
+                if isinstance(result, Exception):
+                    statuses[prompt.pk] = {'status': 'failed', 'error': str(result)}
+                else:
+                    statuses[prompt.pk] = {'status': 'accepted'}
+        # a prompt missing here was taken by a concurrent deferred flush
+        return {pk: statuses.get(pk, {'status': 'queued'}) for pk in ids}
+
+    @classmethod
+    def bulk_decline(cls, user, prompts: List['UserPrompt']) -> dict:
+        ids = [prompt.pk for prompt in prompts]
+        # a declined prompt isn't written by the next flush of its product
+        cls.objects.filter(user=user, pk__in=ids).update(
+            is_accepted=False, is_write_pending=False, updated_at=timezone.now()
+        )
+        return {pk: {'status': 'declined'} for pk in ids}
+
     def decline(self) -> None:
+        # a declined prompt isn't written by the next flush of its product
         self.is_accepted = False
+        self.is_write_pending = False
         self.save()
 
     def accepted(self) -> None:
@@ -337,8 +632,18 @@ class SallaUserSubscription(models.Model):
     is_active = models.BooleanField(default=True)
     is_trial = models.BooleanField(default=False)
 
+    # open reservations older than that are considered abandoned
+    RESERVATION_TTL = timedelta(hours=1)
+    # seconds the balance pushes to salla of a user are coalesced
+    BALANCE_PUSH_WINDOW = float(os.getenv('SALLA_BALANCE_PUSH_WINDOW', 5))
+
     # permissions
     gpt_prompts_limit = models.PositiveSmallIntegerField(default=0)
+    # prompts taken from the limit, reserved before asking chatgpt
+    used_prompts = models.PositiveIntegerField(default=0)
+    # prompts of the open reservations, their prompts aren't saved yet
+    reserved_prompts = models.PositiveIntegerField(default=0)
+    reserved_at = models.DateTimeField(blank=True, null=True)
 
     # PRODUCT_TOTAL_PROMPTS = len(CHATGPT_PROMPT_TYPES())
     # PLANS_LIMITS = {
@@ -366,6 +671,25 @@ class SallaUserSubscription(models.Model):
     def __str__(self):
         return f'{self.user}'
 
+    @classmethod
+    def create_from_response(cls, user: SallaUser, subscription_response: dict) -> 'SallaUserSubscription':
+        """create the subscription the user chose from the salla response"""
+        from rest_framework.exceptions import ValidationError
+        from app.serializers import SallaUserSubscriptionPayloadSerializer
+
+        payload = subscription_response.get('data')
+        if payload and type(payload) is list:
+            payload = payload[0]
+        else:
+            raise ValidationError('Invalid subscripion')
+
+        payload_data = SallaUserSubscriptionPayloadSerializer(data=payload)
+        payload_data.is_valid(raise_exception=True)
+
+        subscription = cls(user=user, payload=payload, **payload_data.data)
+        subscription.save()
+        return subscription
+
     def calculate_limits(self):
         prompt_price_ratio = 100/120
         default_trial = 10
@@ -385,4 +709,622 @@ class SallaUserSubscription(models.Model):
             self.created_at + self.plan_period > timezone.now()
         )
 
+    @property
+    def ends_at(self):
+        return self.created_at + (self.plan_period or timedelta(days=1000))
+
+    @property
+    def remaining_prompts(self) -> int:
+        return self.gpt_prompts_limit - self.used_prompts
+
+    def reserve_prompts(self, count: int = 1) -> bool:
+        """take `count` prompts of the limit, False when not enough are left.
+        The check and the increment are one conditional update, so
+        concurrent requests can't take the same prompts."""
+        qs = SallaUserSubscription.objects.filter(
+            pk=self.pk, used_prompts__lte=models.F('gpt_prompts_limit') - count
+        )
+        is_reserved = qs.update(
+            used_prompts=models.F('used_prompts') + count,
+            reserved_prompts=models.F('reserved_prompts') + count,
+            reserved_at=timezone.now(),
+        ) == 1
+        if is_reserved:
+            self.refresh_from_db(fields=['used_prompts', 'reserved_prompts', 'reserved_at'])
+        return is_reserved
+
+    def release_prompts(self, reserved: int, unused: int = 0) -> None:
+        """close a reservation of `reserved` prompts, giving back the
+        `unused` ones"""
+        SallaUserSubscription.objects.filter(pk=self.pk).update(
+            used_prompts=Greatest(models.F('used_prompts') - unused, 0),
+            reserved_prompts=Greatest(models.F('reserved_prompts') - reserved, 0),
+        )
+        self.refresh_from_db(fields=['used_prompts', 'reserved_prompts'])
+        if unused:
+            # a push made meanwhile sent the balance without them
+            SallaUserSubscription.schedule_balance_push(self.user_id)
+
+    @staticmethod
+    def get_balance_push_key(user_id: int) -> str:
+        return f'balance-push:{user_id}'
+
+    @classmethod
+    def schedule_balance_push(cls, user_id: int) -> None:
+        """push the balance of the user to salla in the background after
+        the window, the changes made meanwhile share the push"""
+        from django.core.cache import cache
+        from app.tasks import push_plan_balance
+
+        key = cls.get_balance_push_key(user_id)
+        try:
+            if not cache.add(key, 1, timeout=cls.BALANCE_PUSH_WINDOW + 60):
+                return
+            # fail fast instead of retrying in the request while the broker is down
+            push_plan_balance.apply_async(
+                (user_id,), countdown=cls.BALANCE_PUSH_WINDOW, retry=False
+            )
+        except Exception as e:
+            logger.error(f'[BALANCE_PUSH] scheduling {user_id} failed: {e!r}')
+            try:
+                # the next change schedules it again
+                cache.delete(key)
+            except Exception as e:
+                logger.error(f'[BALANCE_PUSH] {e!r}')
+
+    @classmethod
+    def push_balance(cls, user) -> None:
+        """send the remaining prompts of the active subscription to salla"""
+        from django.core.cache import cache
+        from app.controllers import SallaWriter
+        from app.enums import Priority
+
+        # the changes from now on schedule the next push
+        cache.delete(cls.get_balance_push_key(user.pk))
+
+        subscription = user.subscriptions.filter(is_active=True).last()
+        if subscription is None:
+            return
+
+        writer = SallaWriter(user.account, priority=Priority.BACKGROUND)
+        writer.balance_update({'balance': subscription.remaining_prompts})
+
+    def reconcile_used_prompts(self) -> None:
+        """Correct the counter by the prompts saved in the subscription
+        period. The row is locked meanwhile, so no reservation opens. While
+        reservations are open their prompts aren't saved yet, then the
+        counter is only raised."""
+        from django.db import transaction
+
+        with transaction.atomic():
+            subscription = SallaUserSubscription.objects.select_for_update().get(pk=self.pk)
+            saved_prompts = UserPrompt.count_for_user(self.user, self.created_at, self.ends_at, gpt=True)
+
+            is_reserving = subscription.reserved_prompts and (
+                subscription.reserved_at is None
+                or subscription.reserved_at > timezone.now() - self.RESERVATION_TTL
+            )
+            if is_reserving:
+                used_prompts = max(subscription.used_prompts, saved_prompts)
+                reserved_prompts = subscription.reserved_prompts
+            else:
+                # the reservations older than the ttl were left by dead processes
+                used_prompts = saved_prompts
+                reserved_prompts = 0
+
+            if (used_prompts, reserved_prompts) != (subscription.used_prompts, subscription.reserved_prompts):
+                logger.info(
+                    f'[PROMPTS_USAGE] {self.pk} reconciled from {subscription.used_prompts} to {used_prompts}'
+                )
+                SallaUserSubscription.objects.filter(pk=self.pk).update(
+                    used_prompts=used_prompts, reserved_prompts=reserved_prompts
+                )
+            self.used_prompts = used_prompts
+            self.reserved_prompts = reserved_prompts
+
+
+class SallaProduct(models.Model):
+    """Local mirror of the merchant products in salla"""
+    user = models.ForeignKey(
+        SallaUser, on_delete=models.CASCADE, related_name='products'
+    )
+    salla_id = models.CharField(max_length=64, db_index=True)
 
+    name = models.CharField(max_length=512, blank=True, null=True)
+    description = models.TextField(blank=True, null=True)
+    metadata_title = models.CharField(max_length=512, blank=True, null=True)
+    metadata_description = models.TextField(blank=True, null=True)
+    main_image = models.URLField(max_length=1024, blank=True, null=True)
+    images = models.JSONField(default=list)
+    status = models.CharField(max_length=32, blank=True, null=True)
+    price = models.JSONField(default=dict)
+
+    # the product as salla returns it
+    payload = models.JSONField(default=dict)
+    # order of the product in the salla products list
+    position = models.IntegerField(default=0)
+
+    synced_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'salla_id')
+        ordering = ('position', 'id')
+
+    def __str__(self):
+        return f'{self.user}: {self.name}'
+
+    @staticmethod
+    def __get_fields(data: dict) -> dict:
+        metadata = data.get('metadata') or {}
+        return {
+            'name': data.get('name'),
+            'description': data.get('description'),
+            'metadata_title': metadata.get('title'),
+            'metadata_description': metadata.get('description'),
+            'main_image': data.get('main_image'),
+            'images': data.get('images') or [],
+            'status': data.get('status'),
+            'price': data.get('price') or {},
+            'payload': data,
+        }
+
+    @classmethod
+    def upsert_many(cls, user, products: List[dict], first_position: int = None) -> int:
+        """mirror the salla products and mark them as seen by this sync.
+        Return how many products were created or changed"""
+        now = timezone.now()
+        existing = {
+            product.salla_id: product
+            for product in cls.objects.filter(
+                user=user, salla_id__in=[str(data['id']) for data in products]
+            )
+        }
+
+        to_create, to_update, changed = [], [], 0
+        for index, data in enumerate(products):
+            fields = cls.__get_fields(data)
+            if first_position is not None:
+                fields['position'] = first_position + index
+
+            product = existing.get(str(data['id']))
+            if product is None:
+                to_create.append(cls(user=user, salla_id=str(data['id']), synced_at=now, **fields))
+                continue
+
+            product.synced_at = now
+            is_changed = any(getattr(product, key) != value for key, value in fields.items())
+            if is_changed:
+                for key, value in fields.items():
+                    setattr(product, key, value)
+                product.updated_at = now
+                changed += 1
+            to_update.append(product)
+
+        cls.objects.bulk_create(to_create)
+        update_fields = ['synced_at', 'updated_at', 'position', *cls.__get_fields({}).keys()]
+        cls.objects.bulk_update(to_update, update_fields)
+
+        return len(to_create) + changed
+
+    @classmethod
+    def upsert(cls, user, data: dict) -> None:
+        """mirror one product, keeps the position of an existing product"""
+        if not cls.objects.filter(user=user, salla_id=str(data['id'])).exists():
+            # new products show first in salla
+            first = cls.objects.filter(user=user).aggregate(models.Min('position'))
+            cls.upsert_many(user, [data], first_position=(first['position__min'] or 0) - 1)
+        else:
+            cls.upsert_many(user, [data])
+
+    @classmethod
+    def get_products_page(cls, user, params: dict = None):
+        """page of products shaped like the salla products endpoint,
+        None when the mirror can't answer it"""
+        from app.serializers import ProductEndpointParamsSerializer
+
+        if user is None or not SallaCatalogSync.is_warm(user):
+            return None
+
+        params = utils.serialize_data_recursively(
+            ProductEndpointParamsSerializer, params or {}, default={}
+        )
+        # categories are not mirrored
+        if params.get('category'):
+            return None
+
+        qs = cls.objects.filter(user=user)
+        if params.get('keyword'):
+            qs = qs.filter(name__icontains=params['keyword'])
+        if params.get('status'):
+            qs = qs.filter(status=params['status'])
+
+        page, per_page = max(params['page'], 1), max(params['per_page'], 1)
+        total = qs.count()
+        products = qs[(page - 1) * per_page: page * per_page]
+
+        return {
+            'data': [product.payload for product in products],
+            'pagination': {
+                'count': len(products),
+                'total': total,
+                'perPage': per_page,
+                'currentPage': page,
+                'totalPages': max(math.ceil(total / per_page), 1),
+                'links': {},
+            },
+        }
+
+
+class SallaCatalogSync(models.Model):
+    """Progress of mirroring the merchant products, so the sync can resume"""
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETED = 'completed'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = utils.list_to_choices([STATUS_RUNNING, STATUS_COMPLETED, STATUS_FAILED])
+
+    PER_PAGE = int(os.getenv('SALLA_CATALOG_SYNC_PER_PAGE', 50))
+    # a running sync not updated for that long is considered dead
+    STALE_AFTER = timedelta(minutes=int(os.getenv('SALLA_CATALOG_SYNC_STALE_MINUTES', 10)))
+    # the product webhooks keep a completed mirror fresh, a full walk every
+    # that long reconciles the events that were missed
+    REFRESH_EVERY = timedelta(minutes=int(os.getenv('SALLA_CATALOG_REFRESH_MINUTES', 60 * 24)))
+
+    user = models.OneToOneField(
+        SallaUser, on_delete=models.CASCADE, related_name='catalog_sync'
+    )
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_RUNNING)
+    next_page = models.PositiveIntegerField(default=1)
+    started_at = models.DateTimeField(default=timezone.now)
+    # set once the first full sync is done, from then the mirror is warm
+    completed_at = models.DateTimeField(blank=True, null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.user}: {self.status} (page {self.next_page})'
+
+    @classmethod
+    def is_warm(cls, user) -> bool:
+        return cls.objects.filter(user=user, completed_at__isnull=False).exists()
+
+    @property
+    def is_stale(self) -> bool:
+        return self.updated_at + self.STALE_AFTER < timezone.now()
+
+    @property
+    def should_refresh(self) -> bool:
+        if self.status == self.STATUS_RUNNING:
+            return self.is_stale
+        if self.status == self.STATUS_FAILED:
+            return True
+        return self.updated_at + self.REFRESH_EVERY < timezone.now()
+
+    @classmethod
+    def schedule(cls, user) -> None:
+        """start mirroring the user products in the background, if needed.
+        The sync is marked running before it's queued, so the views meanwhile
+        don't queue it again"""
+        from app.tasks import sync_catalog
+
+        if user is None:
+            return
+
+        sync, created = cls.objects.get_or_create(user=user)
+        if not created:
+            if sync.status == cls.STATUS_COMPLETED:
+                # refreshed by `refresh_catalogs`
+                return
+
+            now = timezone.now()
+            is_dead = models.Q(status=cls.STATUS_FAILED) | models.Q(
+                status=cls.STATUS_RUNNING, updated_at__lt=now - cls.STALE_AFTER
+            )
+            # only one of the concurrent views claims it
+            if not cls.objects.filter(is_dead, pk=sync.pk).update(
+                status=cls.STATUS_RUNNING, updated_at=now
+            ):
+                return
+
+        try:
+            # fail fast instead of retrying in the request while the broker is down
+            sync_catalog.apply_async((user.pk,), retry=False)
+        except Exception as e:
+            logger.error(f'[CATALOG_SYNC] scheduling {user} failed: {e!r}')
+            # the next view schedules it again
+            cls.objects.filter(pk=sync.pk).update(status=cls.STATUS_FAILED)
+
+    def restart(self) -> None:
+        self.status = self.STATUS_RUNNING
+        self.next_page = 1
+        self.started_at = timezone.now()
+        self.save()
+
+    def __prune(self, reader) -> None:
+        """delete the products not seen during this walk, they're deleted in
+        salla. The pages are offsets, a product deleted during the walk
+        shifts the next pages and a live product may be skipped, nothing
+        is pruned when the products seen don't add up to the catalog"""
+        total = reader.get_products({'per_page': 1})['pagination']['total']
+        seen = SallaProduct.objects.filter(user=self.user, synced_at__gte=self.started_at)
+        if seen.count() != total:
+            logger.info(
+                f'[CATALOG_SYNC] {self.user}: saw {seen.count()} of {total} products, not pruning'
+            )
+            return
+
+        SallaProduct.objects.filter(user=self.user, synced_at__lt=self.started_at).delete()
+
+    def run(self) -> None:
+        """walk the salla catalog from the checkpoint and mirror it"""
+        from app.controllers import SallaMerchantReader
+        from app.enums import Priority
+
+        if self.status == self.STATUS_COMPLETED:
+            self.restart()
+        elif self.status == self.STATUS_FAILED:
+            # resume from the checkpoint
+            self.status = self.STATUS_RUNNING
+            self.save(update_fields=['status', 'updated_at'])
+
+        reader = SallaMerchantReader(
+            self.user.account, priority=Priority.BACKGROUND, use_cache=False
+        )
+        pages = reader.iter_product_pages(
+            {'per_page': self.PER_PAGE}, start_page=self.next_page
+        )
+        try:
+            for page, products in pages:
+                first_position = (page - 1) * self.PER_PAGE
+                SallaProduct.upsert_many(self.user, products, first_position)
+
+                self.next_page = page + 1
+                self.save(update_fields=['next_page', 'updated_at'])
+        except Exception:
+            self.status = self.STATUS_FAILED
+            self.save(update_fields=['status', 'updated_at'])
+            raise
+
+        self.__prune(reader)
+
+        self.status = self.STATUS_COMPLETED
+        self.completed_at = timezone.now()
+        self.save()
+
+
+
+class BulkGenerationJob(models.Model):
+    """Generate prompts for the whole catalog of a merchant in the background.
+    The answers are saved as pending prompts for the merchant to review"""
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETED = 'completed'
+    STATUS_QUOTA_EXCEEDED = 'quota_exceeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = utils.list_to_choices([
+        STATUS_PENDING, STATUS_RUNNING, STATUS_COMPLETED, STATUS_QUOTA_EXCEEDED, STATUS_FAILED
+    ])
+    ACTIVE_STATUSES = (STATUS_PENDING, STATUS_RUNNING)
+
+    PER_PAGE = int(os.getenv('BULK_GENERATION_PER_PAGE', 20))
+    # chatgpt requests running at the same time for one job
+    CONCURRENCY = int(os.getenv('BULK_GENERATION_CONCURRENCY', 4))
+    # pack many prompts per chat request, see `ChatGPTBatch`
+    IS_BATCHED = os.getenv('BULK_GENERATION_BATCHED', 'False') == 'True'
+    # an active job not updated for that long is considered dead
+    STALE_AFTER = timedelta(minutes=int(os.getenv('BULK_GENERATION_STALE_MINUTES', 10)))
+
+    user = models.ForeignKey(
+        SallaUser, on_delete=models.CASCADE, related_name='bulk_generation_jobs'
+    )
+    prompt_types = models.JSONField(default=list)
+    # used for every product, the product name when empty
+    keywords = models.CharField(max_length=256, blank=True, null=True)
+
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    error = models.TextField(blank=True, null=True)
+    # checkpoint, the page of the catalog to resume from
+    next_page = models.PositiveIntegerField(default=1)
+
+    total_products = models.PositiveIntegerField(default=0)
+    processed_products = models.PositiveIntegerField(default=0)
+    generated_prompts = models.PositiveIntegerField(default=0)
+    failed_prompts = models.PositiveIntegerField(default=0)
+
+    started_at = models.DateTimeField(blank=True, null=True)
+    completed_at = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'({self.id}) {self.user}: {self.status} ({self.processed_products}/{self.total_products})'
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in self.ACTIVE_STATUSES
+
+    @property
+    def is_stale(self) -> bool:
+        return self.updated_at + self.STALE_AFTER < timezone.now()
+
+    @property
+    def progress(self) -> float:
+        if not self.total_products:
+            return 1.0 if self.status == self.STATUS_COMPLETED else 0.0
+        return min(self.processed_products / self.total_products, 1.0)
+
+    def schedule(self) -> None:
+        from app.tasks import run_bulk_generation
+
+        run_bulk_generation.delay(self.pk)
+
+    def __save_progress(self, *fields) -> None:
+        self.save(update_fields=[*fields, 'updated_at'])
+
+    def __finish(self, status: str, error: str = None) -> None:
+        self.status = status
+        self.error = error
+        self.completed_at = timezone.now()
+        self.__save_progress('status', 'error', 'completed_at')
+
+    def __iter_pages(self):
+        """yield `(page, products)` from the checkpoint, from the mirror
+        when it's warm, otherwise from salla"""
+        from app.controllers import SallaMerchantReader
+        from app.enums import Priority
+
+        if SallaCatalogSync.is_warm(self.user):
+            page = self.next_page
+            while products := SallaProduct.get_products_page(
+                self.user, {'page': page, 'per_page': self.PER_PAGE}
+            )['data']:
+                yield page, products
+                page += 1
+            return
+
+        reader = SallaMerchantReader(self.user.account, priority=Priority.BACKGROUND)
+        yield from reader.iter_product_pages(
+            {'per_page': self.PER_PAGE}, start_page=self.next_page
+        )
+
+    def __count_products(self) -> int:
+        from app.controllers import SallaMerchantReader
+        from app.enums import Priority
+
+        if SallaCatalogSync.is_warm(self.user):
+            return SallaProduct.objects.filter(user=self.user).count()
+
+        reader = SallaMerchantReader(self.user.account, priority=Priority.BACKGROUND)
+        return reader.get_products({'per_page': 1})['pagination']['total']
+
+    def __get_done_prompts(self, product_ids: List[str]) -> set:
+        """`(product_id, prompt_type)` already answered and not declined,
+        this also makes a resumed page skip what it generated before"""
+        prompts = UserPrompt.objects.filter(
+            user=self.user, product_id__in=product_ids, chat_gpt_response__isnull=False
+        ).exclude(is_accepted=False)
+        return set(prompts.values_list('product_id', 'prompt_type'))
+
+    def __get_requests(self, products: List[dict], limit: int) -> Tuple[dict, bool]:
+        """prompts to ask for the page keyed by `(product_id, prompt_type)`,
+        and whether some were left out because of the limit"""
+        from app import language
+        from app.controllers import ChatGPTProductPromptGenerator
+        from app.exceptions import PromptTooLongException
+
+        done = self.__get_done_prompts([str(product['id']) for product in products])
+        # detect the languages of the page at once, the generators find them memoized
+        language.detect_many([product.get('name') or '' for product in products])
+        requests = {}
+        for product in products:
+            product_id = str(product['id'])
+            data = {
+                'product_id': product_id,
+                'product_name': product.get('name') or '',
+                'product_description': product.get('description'),
+                'product_seo_title': (product.get('metadata') or {}).get('title'),
+                'keywords': self.keywords or product.get('name') or '',
+            }
+            for prompt_type in self.prompt_types:
+                key = (product_id, prompt_type)
+                if key in done:
+                    continue
+                if len(requests) >= limit:
+                    return requests, True
+
+                generator = ChatGPTProductPromptGenerator({**data, 'prompt_type': prompt_type})
+                try:
+                    requests[key] = (generator.get_prompt(), generator.get_constraints(), data)
+                except PromptTooLongException as e:
+                    logger.error(f'[BULK_GENERATION] {self.pk} {key}: {e!r}')
+                    self.failed_prompts += 1
+        return requests, False
+
+    def __save_prompt(self, key: tuple, data: dict, chat_gpt_response: ChatGPTResponse, reservation) -> None:
+        product_id, prompt_type = key
+        UserPrompt.objects.create(
+            user=self.user,
+            chat_gpt_response=chat_gpt_response,
+            meta={**data, 'prompt_type': prompt_type, 'bulk_generation_job': self.pk},
+            product_id=product_id,
+            prompt_type=prompt_type,
+        )
+        if chat_gpt_response.is_charged:
+            reservation.use()
+        self.generated_prompts += 1
+
+    def __generate(self, requests: dict, reservation) -> None:
+        from app import near_duplicates
+        from app.controllers import ChatGPT, ChatGPTBatch
+        from app.enums import Priority
+
+        # near duplicates of accepted prompts don't need openai
+        prompts = {}
+        for key, (prompt, constraints, data) in requests.items():
+            reusable = near_duplicates.find_reusable(self.user, {**data, 'prompt_type': key[1]})
+            if reusable is None:
+                prompts[key] = (prompt, constraints)
+            else:
+                self.__save_prompt(key, data, ChatGPTResponse.reuse(prompt, reusable), reservation)
+        self.__save_progress('generated_prompts')
+
+        if self.IS_BATCHED:
+            batch = ChatGPTBatch(prompts, priority=Priority.BACKGROUND)
+            responses = batch.complete(max_workers=self.CONCURRENCY)
+        else:
+            responses = ChatGPT.complete_concurrently(
+                prompts, max_workers=self.CONCURRENCY, priority=Priority.BACKGROUND
+            )
+        for key, response in responses:
+            prompt, _, data = requests[key]
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                self.__save_prompt(key, data, ChatGPT.log_to_db(prompt, response), reservation)
+            except Exception as e:
+                logger.error(f'[BULK_GENERATION] {self.pk} {key}: {e!r}')
+                self.failed_prompts += 1
+            # also the heartbeat telling the job is alive
+            self.__save_progress('generated_prompts', 'failed_prompts')
+
+    def run(self) -> None:
+        """walk the catalog from the checkpoint and generate the prompts
+        of every product within the remaining quota"""
+        from rest_framework.exceptions import PermissionDenied
+        from app.permissions import SallaPlanLimits, PromptsReservation
+
+        if not self.is_active:
+            return
+
+        if self.status == self.STATUS_PENDING:
+            self.status = self.STATUS_RUNNING
+            self.started_at = timezone.now()
+            self.total_products = self.__count_products()
+            self.__save_progress('status', 'started_at', 'total_products')
+
+        try:
+            for page, products in self.__iter_pages():
+                remaining = SallaPlanLimits.get_remaining_prompts(self.user)
+                requests, is_quota_exceeded = self.__get_requests(products, limit=max(remaining, 0))
+                if requests:
+                    try:
+                        with PromptsReservation(self.user, len(requests)) as reservation:
+                            self.__generate(requests, reservation)
+                    except PermissionDenied:
+                        # the merchant used the prompts meanwhile
+                        return self.__finish(self.STATUS_QUOTA_EXCEEDED)
+
+                # a later job skips the prompts generated so far
+                if is_quota_exceeded:
+                    return self.__finish(self.STATUS_QUOTA_EXCEEDED)
+
+                self.processed_products = (page - 1) * self.PER_PAGE + len(products)
+                self.next_page = page + 1
+                self.__save_progress('processed_products', 'next_page')
+        except Exception as e:
+            self.__finish(self.STATUS_FAILED, error=repr(e))
+            raise
+
+        self.__finish(self.STATUS_COMPLETED)
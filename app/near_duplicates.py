@@ -0,0 +1,221 @@
+"""Reuse of accepted answers for near duplicate products.
+
+Variants of a product ("Red dress size M", "Red dress size L") get the same
+text, so before asking openai the inputs of the prompt are compared with
+the earlier prompts of the merchant. Every answered prompt is indexed by a
+MinHash signature of its normalized inputs, split in LSH bands kept in
+redis (in memory when running locally). Prompts sharing a band are the
+candidates, the accepted one most similar above the threshold is reused.
+The product names must be similar too, products of a store often share the
+same boilerplate description.
+"""
+import os
+import re
+import json
+import random
+import hashlib
+import logging
+import threading
+from typing import Optional
+
+from app import metrics, shared, utils
+
+logger = logging.getLogger('main')
+
+IS_ENABLED = os.getenv('NEAR_DUPLICATE_ENABLED', 'True') == 'True'
+# estimated jaccard similarity of the inputs from which an answer is reused
+THRESHOLD = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', 0.8))
+TTL = int(os.getenv('NEAR_DUPLICATE_TTL', 60 * 60 * 24 * 30))
+
+# characters of the inputs compared, the start of a long description is enough
+MAX_CHARS = int(os.getenv('NEAR_DUPLICATE_MAX_CHARS', 1000))
+
+SHINGLE_SIZE = 4
+BANDS = 16
+ROWS = 4
+NUM_PERM = BANDS * ROWS
+MERSENNE_PRIME = (1 << 61) - 1
+
+# the permutations must be the same in every process
+_random = random.Random(1)
+PERMUTATIONS = [
+    (_random.randrange(1, MERSENNE_PRIME), _random.randrange(0, MERSENNE_PRIME))
+    for _ in range(NUM_PERM)
+]
+
+
+def normalize(text: str) -> str:
+    text = re.sub(r'<[^>]+>', ' ', text or '')
+    text = re.sub(r'[^\w\s]', ' ', text.lower())
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def get_shingles(text: str) -> set:
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[index:index + SHINGLE_SIZE] for index in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def get_signature(text: str) -> list:
+    hashes = [
+        int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), 'big')
+        for shingle in get_shingles(text)
+    ]
+    return [
+        min((a * value + b) % MERSENNE_PRIME for value in hashes)
+        for a, b in PERMUTATIONS
+    ]
+
+
+def get_similarity(signature: list, other: list) -> float:
+    return sum(1 for a, b in zip(signature, other) if a == b) / NUM_PERM
+
+
+def get_bands(signature: list) -> list:
+    return [
+        hashlib.sha1(json.dumps(signature[band * ROWS:(band + 1) * ROWS]).encode()).hexdigest()[:16]
+        for band in range(BANDS)
+    ]
+
+
+class RedisIndexStore:
+    def __init__(self, client) -> None:
+        self.client = client
+
+    def add(self, scope: str, prompt_id: int, signatures: dict) -> None:
+        pipeline = self.client.pipeline()
+        for index, band in enumerate(get_bands(signatures['inputs'])):
+            key = f'ndup:{scope}:{index}:{band}'
+            pipeline.sadd(key, prompt_id)
+            pipeline.expire(key, TTL)
+        pipeline.hset(f'ndup:{scope}:signatures', prompt_id, json.dumps(signatures))
+        pipeline.expire(f'ndup:{scope}:signatures', TTL)
+        pipeline.execute()
+
+    def get_candidates(self, scope: str, signatures: dict) -> dict:
+        """map the prompts sharing a band with the inputs to their signatures"""
+        pipeline = self.client.pipeline()
+        for index, band in enumerate(get_bands(signatures['inputs'])):
+            pipeline.smembers(f'ndup:{scope}:{index}:{band}')
+        prompt_ids = sorted({int(prompt_id) for members in pipeline.execute() for prompt_id in members})
+        if not prompt_ids:
+            return {}
+
+        signatures = self.client.hmget(f'ndup:{scope}:signatures', prompt_ids)
+        return {
+            prompt_id: json.loads(value)
+            for prompt_id, value in zip(prompt_ids, signatures)
+            if value is not None
+        }
+
+
+class LocalIndexStore:
+    """Process local stand-in of `RedisIndexStore`"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.bands = {}
+        self.signatures = {}
+
+    def add(self, scope: str, prompt_id: int, signatures: dict) -> None:
+        with self.lock:
+            for index, band in enumerate(get_bands(signatures['inputs'])):
+                self.bands.setdefault((scope, index, band), set()).add(prompt_id)
+            self.signatures[(scope, prompt_id)] = signatures
+
+    def get_candidates(self, scope: str, signatures: dict) -> dict:
+        with self.lock:
+            prompt_ids = set()
+            for index, band in enumerate(get_bands(signatures['inputs'])):
+                prompt_ids |= self.bands.get((scope, index, band), set())
+            return {prompt_id: self.signatures[(scope, prompt_id)] for prompt_id in prompt_ids}
+
+
+_local_store = LocalIndexStore()
+
+
+def get_store():
+    client = shared.get_redis()
+    if client is None:
+        return _local_store
+    return RedisIndexStore(client)
+
+
+def get_scope(user, data: dict) -> str:
+    """answers are reused within the same merchant, prompt type and language"""
+    language = utils.get_language(data['product_name'])
+    return f'{user.pk}:{data["prompt_type"]}:{language}'
+
+
+def get_signatures(data: dict) -> dict:
+    fields = ('product_name', 'product_description', 'keywords')
+    # the untrimmed description may be long, html included
+    inputs = ' | '.join(
+        normalize((data.get(field) or '')[:MAX_CHARS * 4])[:MAX_CHARS] for field in fields
+    )
+
+    return {
+        'inputs': get_signature(inputs),
+        'name': get_signature(normalize(data.get('product_name'))[:MAX_CHARS]),
+    }
+
+
+def get_similarity_of(signatures: dict, other: dict) -> float:
+    return min(
+        get_similarity(signatures['inputs'], other['inputs']),
+        get_similarity(signatures['name'], other['name']),
+    )
+
+
+def index(user_prompt) -> None:
+    """make the answered prompt a candidate for the next near duplicates"""
+    data = user_prompt.meta
+    if not IS_ENABLED or not data.get('product_name'):
+        return
+
+    try:
+        signatures = get_signatures(data)
+        get_store().add(get_scope(user_prompt.user, data), user_prompt.pk, signatures)
+    except Exception as e:
+        logger.error(f'[NEAR_DUPLICATE] {e!r}')
+
+
+def find_reusable(user, data: dict) -> Optional['ChatGPTResponse']:
+    """Return the accepted answer of the most similar earlier prompt,
+    None when there's none above the threshold"""
+    from app.models import UserPrompt
+
+    if not IS_ENABLED:
+        return None
+
+    # the merchant declined a reused answer for this product, ask openai
+    is_declined = UserPrompt.objects.filter(
+        user=user, product_id=data['product_id'], prompt_type=data['prompt_type'],
+        is_accepted=False, chat_gpt_response__reused_from__isnull=False,
+    ).exists()
+    if is_declined:
+        return None
+
+    try:
+        signatures = get_signatures(data)
+        candidates = get_store().get_candidates(get_scope(user, data), signatures)
+    except Exception as e:
+        logger.error(f'[NEAR_DUPLICATE] {e!r}')
+        return None
+
+    similarities = {
+        prompt_id: get_similarity_of(signatures, other)
+        for prompt_id, other in candidates.items()
+    }
+    similar_ids = [prompt_id for prompt_id, similarity in similarities.items() if similarity >= THRESHOLD]
+    accepted = (
+        UserPrompt.objects
+            .filter(user=user, pk__in=similar_ids, is_accepted=True, chat_gpt_response__isnull=False)
+            # a re-ask about the same product wants a new answer
+            .exclude(product_id=data['product_id'])
+            .select_related('chat_gpt_response')
+    )
+
+    best = max(accepted, key=lambda prompt: similarities[prompt.pk], default=None)
+    metrics.incr('near_duplicate.reused' if best else 'near_duplicate.missed')
+    return best.chat_gpt_response if best else None
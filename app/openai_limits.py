@@ -0,0 +1,191 @@
+"""Admission control of the calls made to OpenAI.
+
+OpenAI limits the requests and the tokens per minute of the whole account,
+so every process takes from the same two buckets (in redis, or in memory
+when running locally) before calling it. The tokens of a call are reserved
+from an estimate and settled with the real usage once it's done.
+"""
+import os
+import time
+import logging
+import threading
+
+from app import metrics, shared
+from app.enums import Priority
+from app.exceptions import OpenAIRateLimitedException
+
+logger = logging.getLogger('main')
+
+RPM_LIMIT = int(os.getenv('OPENAI_RPM_LIMIT', 3000))
+TPM_LIMIT = int(os.getenv('OPENAI_TPM_LIMIT', 250000))
+WINDOW = 60
+# ratio of the buckets background calls must leave for interactive ones
+INTERACTIVE_RESERVE = float(os.getenv('OPENAI_RATE_LIMIT_INTERACTIVE_RESERVE', 0.2))
+# seconds a call may queue for its budget before giving up
+MAX_WAIT = {
+    Priority.INTERACTIVE: float(os.getenv('OPENAI_RATE_LIMIT_MAX_WAIT', 5)),
+    Priority.BACKGROUND: float(os.getenv('OPENAI_RATE_LIMIT_BACKGROUND_MAX_WAIT', 120)),
+}
+
+REFILL_SCRIPT = """
+local function refill(key, now, rpm, tpm)
+    local state = redis.call('HMGET', key, 'requests', 'tokens', 'updated_at')
+    local requests = tonumber(state[1]) or rpm
+    local tokens = tonumber(state[2]) or tpm
+    local elapsed = math.max(0, now - (tonumber(state[3]) or now))
+
+    requests = math.min(rpm, requests + elapsed * rpm / 60)
+    tokens = math.min(tpm, tokens + elapsed * tpm / 60)
+    return requests, tokens
+end
+"""
+
+RESERVE_SCRIPT = REFILL_SCRIPT + """
+local now, rpm, tpm = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local needed, floor = tonumber(ARGV[4]), tonumber(ARGV[5])
+local requests, tokens = refill(KEYS[1], now, rpm, tpm)
+
+-- a call bigger than the whole bucket waits for a full one
+local needed_requests = 1 + floor * rpm
+local needed_tokens = math.min(needed + floor * tpm, tpm)
+
+local wait = 0
+if requests >= needed_requests and tokens >= needed_tokens then
+    requests = requests - 1
+    tokens = tokens - needed
+else
+    wait = math.max(
+        (needed_requests - requests) / (rpm / 60),
+        (needed_tokens - tokens) / (tpm / 60)
+    )
+end
+
+redis.call('HSET', KEYS[1], 'requests', tostring(requests), 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], 600)
+return tostring(wait)
+"""
+
+SETTLE_SCRIPT = REFILL_SCRIPT + """
+local now, rpm, tpm = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local requests, tokens = refill(KEYS[1], now, rpm, tpm)
+
+tokens = math.min(tpm, tokens + tonumber(ARGV[4]))
+
+redis.call('HSET', KEYS[1], 'requests', tostring(requests), 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], 600)
+return 1
+"""
+
+
+class RedisBudgetStore:
+    def __init__(self, client) -> None:
+        self.reserve_script = client.register_script(RESERVE_SCRIPT)
+        self.settle_script = client.register_script(SETTLE_SCRIPT)
+
+    def reserve(self, key: str, now: float, tokens: int, floor: float) -> float:
+        """take a request and the tokens, or return how many seconds to wait"""
+        wait = self.reserve_script(keys=[key], args=[now, RPM_LIMIT, TPM_LIMIT, tokens, floor])
+        return float(wait)
+
+    def settle(self, key: str, now: float, delta: int) -> None:
+        """give back the tokens reserved but not used, or take the extra"""
+        self.settle_script(keys=[key], args=[now, RPM_LIMIT, TPM_LIMIT, delta])
+
+
+class LocalBudgetStore:
+    """Process local stand-in of `RedisBudgetStore`"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.budgets = {}
+
+    def __get_budget(self, key: str, now: float) -> dict:
+        budget = self.budgets.setdefault(key, {
+            'requests': RPM_LIMIT, 'tokens': TPM_LIMIT, 'updated_at': now,
+        })
+        elapsed = max(0, now - budget['updated_at'])
+
+        budget['requests'] = min(RPM_LIMIT, budget['requests'] + elapsed * RPM_LIMIT / WINDOW)
+        budget['tokens'] = min(TPM_LIMIT, budget['tokens'] + elapsed * TPM_LIMIT / WINDOW)
+        budget['updated_at'] = now
+        return budget
+
+    def reserve(self, key: str, now: float, tokens: int, floor: float) -> float:
+        with self.lock:
+            budget = self.__get_budget(key, now)
+            needed_requests = 1 + floor * RPM_LIMIT
+            needed_tokens = min(tokens + floor * TPM_LIMIT, TPM_LIMIT)
+
+            if budget['requests'] >= needed_requests and budget['tokens'] >= needed_tokens:
+                budget['requests'] -= 1
+                budget['tokens'] -= tokens
+                return 0
+            return max(
+                (needed_requests - budget['requests']) / (RPM_LIMIT / WINDOW),
+                (needed_tokens - budget['tokens']) / (TPM_LIMIT / WINDOW),
+            )
+
+    def settle(self, key: str, now: float, delta: int) -> None:
+        with self.lock:
+            budget = self.__get_budget(key, now)
+            budget['tokens'] = min(TPM_LIMIT, budget['tokens'] + delta)
+
+
+_local_store = LocalBudgetStore()
+
+
+def get_budget_store():
+    client = shared.get_redis()
+    if client is None:
+        return _local_store
+    return RedisBudgetStore(client)
+
+
+class Reservation:
+    def __init__(self, admission: 'OpenAIAdmission', tokens: int) -> None:
+        self.admission = admission
+        self.tokens = tokens
+        self.is_settled = False
+
+    def settle(self, used_tokens: int) -> None:
+        """correct the reservation by the tokens the call really used"""
+        if self.is_settled:
+            return
+        self.is_settled = True
+
+        try:
+            self.admission.store.settle(self.admission.key, time.time(), self.tokens - used_tokens)
+        except Exception as e:
+            logger.error(f'[OPENAI_RATE_LIMIT] {e!r}')
+
+
+class OpenAIAdmission:
+    """Requests and tokens per minute budget of a model, shared by all the
+    processes, web workers and celery alike"""
+
+    def __init__(self, model: str) -> None:
+        self.key = f'openai:admission:{model}'
+        self.store = get_budget_store()
+
+    def __reserve(self, tokens: int, priority: Priority) -> float:
+        floor = 0 if priority == Priority.INTERACTIVE else INTERACTIVE_RESERVE
+        try:
+            return self.store.reserve(self.key, time.time(), tokens, floor)
+        except Exception as e:
+            # never block openai calls because the limiter is down
+            logger.error(f'[OPENAI_RATE_LIMIT] {e!r}')
+            return 0
+
+    def acquire(self, tokens: int, priority: Priority = Priority.INTERACTIVE) -> Reservation:
+        """block until the call is admitted, raise when it would wait too long"""
+        waited = 0
+        while wait := self.__reserve(tokens, priority):
+            if waited + wait > MAX_WAIT[priority]:
+                metrics.incr('openai_rate_limit.rejected')
+                raise OpenAIRateLimitedException()
+
+            metrics.incr('openai_rate_limit.waits')
+            time.sleep(wait)
+            waited += wait
+
+        return Reservation(self, tokens)
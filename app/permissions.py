@@ -1,21 +1,64 @@
 from rest_framework import permissions
-from datetime import timedelta
+from rest_framework.exceptions import PermissionDenied
 
 class SallaPlanLimits(permissions.BasePermission):
     message = 'You have reached your plan limits'
 
-    def has_permission(self, request, view):
-        from app.models import UserPrompt
+    @staticmethod
+    def get_subscription(user):
+        subscription = user.subscriptions.filter(is_active=True).last()
+        if subscription and subscription.is_alive:
+            return subscription
+        return None
+
+    @classmethod
+    def get_remaining_prompts(cls, user) -> int:
+        subscription = cls.get_subscription(user)
+        if subscription:
+            return subscription.remaining_prompts
+        return 0
 
+    def has_permission(self, request, view):
         if request.user.is_authenticated:
-            subscription = request.user.subscriptions.filter(is_active=True).last()
-            if subscription and subscription.is_alive:
-                start_date = subscription.created_at
-                end_date = subscription.created_at + (subscription.plan_period or timedelta(days=1000)) 
-                # get prompts count during the subscription month
-                prompts_count = UserPrompt.count_for_user(request.user, start_date, end_date, gpt=True)
-                # request.user.prompts.filter(
-                #     created_at__gte=start_date, created_at__lte=end_date
-                # ).count()
-                return prompts_count < subscription.gpt_prompts_limit
+            return self.get_remaining_prompts(request.user) > 0
         return False
+
+
+class PromptsReservation:
+    """Prompts reserved from the plan of the user before asking chatgpt,
+    the ones not marked as used are given back on release"""
+
+    def __init__(self, user, count: int = 1) -> None:
+        self.user = user
+        self.count = count
+        self.used = 0
+        self.subscription = None
+
+    def acquire(self) -> 'PromptsReservation':
+        """raise `PermissionDenied` when the plan hasn't enough prompts left"""
+        subscription = SallaPlanLimits.get_subscription(self.user)
+        if subscription is None or not subscription.reserve_prompts(self.count):
+            raise PermissionDenied(SallaPlanLimits.message)
+
+        self.subscription = subscription
+        return self
+
+    def use(self, count: int = 1) -> None:
+        self.used += count
+
+    def release(self) -> None:
+        if self.subscription is None:
+            return
+
+        unused = max(self.count - self.used, 0)
+        self.subscription.release_prompts(self.count, unused)
+        self.subscription = None
+
+    def __enter__(self) -> 'PromptsReservation':
+        # a reservation acquired beforehand isn't taken twice
+        if self.subscription is None:
+            return self.acquire()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
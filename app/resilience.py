@@ -0,0 +1,139 @@
+"""Retries and circuit breaking of the calls made to Salla.
+
+Transient failures (connection errors, 429 and 5xx) of idempotent calls are
+retried with jittered exponential backoff. Every endpoint has a circuit
+breaker that opens after consecutive server failures and fails fast until
+Salla had time to recover.
+"""
+import os
+import re
+import time
+import random
+import logging
+import threading
+from urllib.parse import urlparse
+
+from app import metrics
+from app.exceptions import SallaCircuitOpenException
+
+logger = logging.getLogger('main')
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+MAX_RETRIES = int(os.getenv('SALLA_RETRY_MAX_RETRIES', 3))
+BACKOFF_BASE = float(os.getenv('SALLA_RETRY_BACKOFF_BASE', 0.5))
+BACKOFF_MAX = float(os.getenv('SALLA_RETRY_BACKOFF_MAX', 8))
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('SALLA_BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv('SALLA_BREAKER_RESET_TIMEOUT', 30))
+
+
+class RetryPolicy:
+    def __init__(self, is_idempotent: bool) -> None:
+        self.max_retries = MAX_RETRIES if is_idempotent else 0
+        self.attempt = 0
+
+    @classmethod
+    def for_method(cls, method: str, idempotent: bool = None) -> 'RetryPolicy':
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        return cls(idempotent)
+
+    def should_retry(self, status_code: int = None) -> bool:
+        """`status_code` is None when the request failed before any response"""
+        is_transient = status_code is None or status_code in RETRY_STATUS_CODES
+        return is_transient and self.attempt < self.max_retries
+
+    def next_delay(self) -> float:
+        """full jitter: random delay up to the exponential backoff"""
+        backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** self.attempt)
+        self.attempt += 1
+        metrics.incr('salla_retry.attempts')
+        return random.uniform(0, backoff)
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    _breakers = {}
+    _breakers_lock = threading.Lock()
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    @classmethod
+    def get(cls, name: str) -> 'CircuitBreaker':
+        with cls._breakers_lock:
+            if name not in cls._breakers:
+                cls._breakers[name] = cls(name)
+            return cls._breakers[name]
+
+    @classmethod
+    def for_request(cls, method: str, url: str) -> 'CircuitBreaker':
+        """one breaker per endpoint, ids in the path are collapsed"""
+        url = urlparse(url)
+        path = re.sub(r'/\d+(?=/|$)', '/{id}', url.path)
+        return cls.get(f'{method.upper()} {url.netloc}{path}')
+
+    @classmethod
+    def get_states(cls) -> dict:
+        """state of every breaker of this process, for monitoring"""
+        with cls._breakers_lock:
+            breakers = list(cls._breakers.values())
+
+        return {
+            breaker.name: {'state': breaker.state, 'failures': breaker.failures}
+            for breaker in breakers
+        }
+
+    def before_request(self) -> None:
+        """raise while the breaker is open,
+        after the reset timeout one trial request is let through"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+
+            # a trial that never reported back is retried after another timeout
+            if time.monotonic() - self.opened_at >= BREAKER_RESET_TIMEOUT:
+                self.state = self.HALF_OPEN
+                self.opened_at = time.monotonic()
+                return
+
+        metrics.incr('salla_breaker.rejected')
+        raise SallaCircuitOpenException()
+
+    def record_success(self) -> None:
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info(f'[CIRCUIT_BREAKER] {self.name} closed')
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            should_open = (
+                self.state == self.HALF_OPEN
+                or self.failures >= BREAKER_FAILURE_THRESHOLD
+            )
+            if should_open and self.state != self.OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                metrics.incr('salla_breaker.opened')
+                logger.error(f'[CIRCUIT_BREAKER] {self.name} opened after {self.failures} failures')
+
+    def record(self, status_code: int) -> None:
+        if status_code >= 500:
+            self.record_failure()
+        else:
+            self.record_success()
+
+
+metrics.register_state('circuit_breakers', CircuitBreaker.get_states)
@@ -0,0 +1,229 @@
+"""Read-through cache for Salla GET responses.
+
+Entries are keyed by merchant (a hash of the access token), endpoint and the
+normalized params. A fresh entry is served directly, a stale one is served
+while a small pool of background threads refreshes it, writers evict what
+they changed.
+
+Responses carrying validators (ETag / Last-Modified) are kept longer so the
+next fetch can be a conditional request answered by a bodiless 304.
+"""
+import os
+import re
+import time
+import json
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from app import metrics
+
+logger = logging.getLogger('main')
+
+IS_ENABLED = os.getenv('SALLA_CACHE_ENABLED', 'True') == 'True'
+# seconds a stale entry can still be served while it is being refreshed
+STALE_TTL = int(os.getenv('SALLA_CACHE_STALE_TTL', 300))
+REFRESH_LOCK_TTL = 30
+REFRESH_WORKERS = int(os.getenv('SALLA_CACHE_REFRESH_WORKERS', 4))
+# refreshes waiting for a worker, the stale entries beyond it are served as is
+REFRESH_QUEUE_SIZE = int(os.getenv('SALLA_CACHE_REFRESH_QUEUE_SIZE', 32))
+# seconds the validators and the body they validate are kept
+VALIDATORS_TTL = int(os.getenv('SALLA_CACHE_VALIDATORS_TTL', 60 * 60 * 24))
+
+# (name, endpoint pattern, default ttl in seconds)
+# the ttl can be overridden by `SALLA_CACHE_TTL_<NAME>` env var, 0 disables it
+ENDPOINTS = (
+    ('user', r'^/oauth2/user/info$', 300),
+    ('store', r'^/store/info$', 300),
+    ('products', r'^/products$', 60),
+    ('product', r'^/products/[^/]+$', 60),
+    ('subscriptions', r'^/apps/[^/]+/subscriptions$', 60),
+    ('settings', r'^/apps/[^/]+/settings$', 60),
+)
+
+
+def get_ttl(endpoint: str) -> int:
+    """Return the ttl of the endpoint, 0 means not cached"""
+    for name, pattern, ttl in ENDPOINTS:
+        if re.match(pattern, endpoint):
+            return int(os.getenv(f'SALLA_CACHE_TTL_{name.upper()}', ttl))
+    return 0
+
+
+def get_merchant_key(access_token: str) -> str:
+    return hashlib.sha1(str(access_token).encode()).hexdigest()[:16]
+
+
+def normalize_params(params: dict = None) -> str:
+    params = {
+        str(key): str(value)
+        for key, value in {**(params or {})}.items()
+        if value is not None
+    }
+    return json.dumps(params, sort_keys=True)
+
+
+def _get_products_version_key(merchant: str) -> str:
+    return f'salla:{merchant}:products:version'
+
+
+def _get_products_version(merchant: str) -> int:
+    return cache.get(_get_products_version_key(merchant), 0)
+
+
+def get_key(access_token: str, endpoint: str, params: dict = None) -> str:
+    merchant = get_merchant_key(access_token)
+    params_hash = hashlib.sha1(normalize_params(params).encode()).hexdigest()
+
+    # list pages carry the version of the products list,
+    # bumping it evicts all of them at once
+    version = _get_products_version(merchant) if endpoint == '/products' else 0
+
+    return f'salla:{merchant}:{endpoint}:{version}:{params_hash}'
+
+
+def _store(key: str, data, ttl: int) -> None:
+    entry = {'data': data, 'fetched_at': time.time()}
+    try:
+        cache.set(key, entry, timeout=ttl + STALE_TTL)
+    except Exception as e:
+        logger.error(f'[SALLA_CACHE] {e!r}')
+
+
+_refresh_executor = ThreadPoolExecutor(
+    max_workers=REFRESH_WORKERS, thread_name_prefix='salla-cache-refresh'
+)
+_refresh_slots = threading.BoundedSemaphore(REFRESH_WORKERS + REFRESH_QUEUE_SIZE)
+
+
+def _refresh(key: str, ttl: int, loader: Callable) -> None:
+    try:
+        _store(key, loader(), ttl)
+    except Exception as e:
+        logger.error(f'[SALLA_CACHE] refreshing {key} failed: {e!r}')
+    finally:
+        _refresh_slots.release()
+        try:
+            cache.delete(f'{key}:refreshing')
+        except Exception as e:
+            logger.error(f'[SALLA_CACHE] {e!r}')
+        # the thread outlives the request, don't leak its db connection
+        close_old_connections()
+
+
+def _refresh_in_background(key: str, ttl: int, loader: Callable) -> None:
+    if not _refresh_slots.acquire(blocking=False):
+        metrics.incr('salla_cache.refresh_skipped')
+        return
+
+    # only one worker refreshes an entry at a time
+    try:
+        is_locked = cache.add(f'{key}:refreshing', 1, timeout=REFRESH_LOCK_TTL)
+    except Exception as e:
+        logger.error(f'[SALLA_CACHE] {e!r}')
+        is_locked = False
+
+    if not is_locked:
+        _refresh_slots.release()
+        return
+
+    try:
+        _refresh_executor.submit(_refresh, key, ttl, loader)
+    except RuntimeError as e:
+        # shutting down, the lock expires by itself
+        _refresh_slots.release()
+        logger.error(f'[SALLA_CACHE] {e!r}')
+
+
+def get_or_load(
+    access_token: str, endpoint: str, params: dict, loader: Callable, refresh_loader: Callable = None
+):
+    """Return the cached response of the endpoint or load and cache it.
+    A stale entry is refreshed by `refresh_loader` when given, nobody waits for it"""
+    ttl = get_ttl(endpoint)
+    if not IS_ENABLED or not ttl:
+        return loader()
+
+    try:
+        key = get_key(access_token, endpoint, params)
+        entry = cache.get(key)
+    except Exception as e:
+        # never let the cache take down the read path
+        logger.error(f'[SALLA_CACHE] {e!r}')
+        return loader()
+
+    if entry is None:
+        metrics.incr('salla_cache.miss')
+        data = loader()
+        _store(key, data, ttl)
+        return data
+
+    if time.time() - entry['fetched_at'] > ttl:
+        metrics.incr('salla_cache.stale')
+        _refresh_in_background(key, ttl, refresh_loader or loader)
+    else:
+        metrics.incr('salla_cache.hit')
+
+    return entry['data']
+
+
+def get_conditional(access_token: str, endpoint: str, params: dict = None):
+    """Return `(headers, data)`, the conditional request headers and the data
+    to use when salla answers 304, or None when there are no validators"""
+    try:
+        entry = cache.get(f'{get_key(access_token, endpoint, params)}:validators')
+    except Exception as e:
+        logger.error(f'[SALLA_CACHE] {e!r}')
+        return None
+
+    if entry is None:
+        return None
+
+    headers = {}
+    if entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    return headers, entry['data']
+
+
+def store_conditional(access_token: str, endpoint: str, params: dict, response_headers, data) -> None:
+    """Keep the validators of the response, if salla sent any"""
+    etag = response_headers.get('ETag')
+    last_modified = response_headers.get('Last-Modified')
+    if not etag and not last_modified:
+        return
+
+    entry = {'etag': etag, 'last_modified': last_modified, 'data': data}
+    try:
+        key = f'{get_key(access_token, endpoint, params)}:validators'
+        cache.set(key, entry, timeout=VALIDATORS_TTL)
+    except Exception as e:
+        logger.error(f'[SALLA_CACHE] {e!r}')
+
+
+def invalidate(access_token: str, endpoint: str, params: dict = None) -> None:
+    try:
+        key = get_key(access_token, endpoint, params)
+        cache.delete_many([key, f'{key}:validators'])
+    except Exception as e:
+        logger.error(f'[SALLA_CACHE] {e!r}')
+
+
+def invalidate_product(access_token: str, product_id: str) -> None:
+    """Evict the product and every cached products list page"""
+    merchant = get_merchant_key(access_token)
+    version_key = _get_products_version_key(merchant)
+
+    invalidate(access_token, f'/products/{product_id}')
+    try:
+        if not cache.add(version_key, 1, timeout=None):
+            cache.incr(version_key)
+    except Exception as e:
+        logger.error(f'[SALLA_CACHE] {e!r}')
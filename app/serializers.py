@@ -96,13 +96,17 @@ class ChatGPTResponseSerializer(serializers.Serializer):
     choices = serializers.ListField(write_only=True, child=serializers.DictField())
 
     prompt = serializers.CharField()
+    is_cache_hit = serializers.BooleanField(required=False, default=False)
 
     total_tokens = serializers.IntegerField(source='usage.total_tokens', read_only=True)
     answer = serializers.SerializerMethodField(read_only=True)
     full_response = serializers.DictField(source='*', read_only=True)
 
     def get_answer(self, obj):
-        return obj['choices'][0]['text'].strip().strip('"')
+        choice = obj['choices'][0]
+        # chat completions carry the answer in a message
+        text = choice['message']['content'] if 'message' in choice else choice['text']
+        return text.strip().strip('"')
 
     def save(self, **kwargs):
         return models.ChatGPTResponse.objects.create(**self.data)
@@ -117,7 +121,19 @@ class ProductGetDescriptionPOSTBodySerializer(serializers.Serializer):
     # brand_name = serializers.CharField(required=False, allow_null=True)
     keywords = serializers.CharField(required=True)
 
-    prompt_type = serializers.ChoiceField(required=True, choices=PROMPT_TYPES())
+    prompt_type = serializers.ChoiceField(required=False, choices=PROMPT_TYPES())
+    # ask about all of them concurrently instead of one `prompt_type`
+    prompt_types = serializers.ListField(
+        child=serializers.ChoiceField(choices=PROMPT_TYPES()), required=False, allow_empty=False
+    )
+    # stream the answer tokens as server-sent events, with `prompt_types`
+    # the answers are sent as they finish, one json per line
+    stream = serializers.BooleanField(required=False, default=False)
+
+    def validate(self, attrs):
+        if not attrs.get('prompt_type') and not attrs.get('prompt_types'):
+            raise serializers.ValidationError('Either prompt_type or prompt_types is required.')
+        return super().validate(attrs)
 
 
 class ProductListHistoryPOSTBodySerializer(serializers.Serializer):
@@ -130,6 +146,43 @@ class ProductUpdatePOSTBodySerializer(serializers.Serializer):
     # prompt_type = serializers.ChoiceField(required=True, choices=PROMPT_TYPES())
     # new_value = serializers.CharField(required=True)
     prompt_id = serializers.CharField(required=True)
+    # queue the write so it's merged with the other fields of the product
+    defer = serializers.BooleanField(required=False, default=False)
+
+
+class PromptBulkActionPOSTBodySerializer(serializers.Serializer):
+    ACTIONS = ('accept', 'decline')
+    MAX_ITEMS = 500
+
+    action = serializers.ChoiceField(required=True, choices=ACTIONS)
+    prompt_ids = serializers.ListField(
+        child=serializers.IntegerField(), required=False, max_length=MAX_ITEMS
+    )
+    # all the pending prompts of these products
+    product_ids = serializers.ListField(
+        child=serializers.CharField(), required=False, max_length=MAX_ITEMS
+    )
+
+    def validate(self, attrs):
+        if not attrs.get('prompt_ids') and not attrs.get('product_ids'):
+            raise serializers.ValidationError('Either prompt_ids or product_ids is required.')
+        return super().validate(attrs)
+
+
+class BulkGenerationJobPOSTBodySerializer(serializers.Serializer):
+    prompt_types = serializers.ListField(
+        child=serializers.ChoiceField(choices=PROMPT_TYPES()), required=False, allow_empty=False
+    )
+    # the same keywords for all the products, the product name when missing
+    keywords = serializers.CharField(required=False, allow_null=True, allow_blank=True, max_length=256)
+
+
+class BulkGenerationJobSerializer(serializers.ModelSerializer):
+    progress = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = models.BulkGenerationJob
+        exclude = ('user', 'next_page')
 
 
 class ProductUpdateManuallyPOSTBodySerializer(serializers.Serializer):
@@ -0,0 +1,28 @@
+"""Access to the redis shared by the web workers and celery.
+
+Running locally there is no redis, callers fall back to process local
+stand-ins when `get_redis` returns None.
+"""
+import threading
+
+from django.conf import settings
+
+_lock = threading.Lock()
+_client = None
+
+
+def get_redis():
+    """Return the redis client of the cache, None when running locally"""
+    global _client
+
+    if settings.IS_LOCAL:
+        return None
+
+    with _lock:
+        if _client is None:
+            import redis
+
+            location = settings.CACHES['default']['LOCATION']
+            _client = redis.Redis.from_url(location)
+
+    return _client
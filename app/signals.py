@@ -1,17 +1,13 @@
-import random
-import string
+import logging
 
+from django.db import transaction
 from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
-from django.conf import settings
-from django.core.mail import send_mail
-
-from rest_framework.exceptions import ValidationError
 
 from app import models
-from app import utils
-from app.controllers import SallaMerchantReader, SallaAppSettingsReader
-from app.serializers import SallaUserSerializer, SallaStoreSerializer, SallaUserSubscriptionPayloadSerializer
+from app.controllers import SallaMerchantReader
+
+logger = logging.getLogger('main')
 
 
 @receiver(pre_save, sender=models.Account)
@@ -21,107 +17,53 @@ def pull_user(sender, instance, **kwargs):
 
     if created and user_not_exists:
         user_data = SallaMerchantReader(instance).get_user()
-        user_data['salla_id'] = user_data.pop('id')
-
-        # user = utils.create_by_serializer(SallaUserSerializer, user_data)
-        # instance.user = user
-        
-        user = models.SallaUser.objects.filter(salla_id=user_data['salla_id']).first()
-        if user:
-            s = SallaUserSerializer(user, data=user_data)
-        else:
-            s = SallaUserSerializer(data=user_data)
-
-        s.is_valid(raise_exception=True)
-        user = s.save()
-
-        instance.user = user
+        instance.user = models.SallaUser.upsert(user_data)
 
 
 @receiver(post_save, sender=models.Account)
-def pull_store(sender, instance, created, **kwargs):
-    if created:
-        store_data = SallaMerchantReader(instance).get_store()
-        store_data['salla_id'] = store_data.pop('id')
-        store_data['user'] = instance.user.pk
-
-        store = models.SallaStore.objects.filter(salla_id=store_data['salla_id']).first()
-        if store:
-            s = SallaStoreSerializer(store, data=store_data)
-        else:
-            s = SallaStoreSerializer(data=store_data)
+def schedule_onboarding(sender, instance, created, **kwargs):
+    """pull the store and the subscription, and send the password by
+    email, in the background once the account is committed"""
+    from app.tasks import onboard_account
 
-        s.is_valid(raise_exception=True)
-        instance = s.save()
+    if created:
+        account_id = instance.pk
 
+        def schedule():
+            # fail fast instead of retrying in the oauth callback while the broker is down
+            try:
+                onboard_account.apply_async((account_id,), retry=False)
+            except Exception as e:
+                logger.error(f'[ONBOARDING] scheduling {account_id} failed: {e!r}')
 
-@receiver(post_save, sender=models.Account)
-def send_password_via_email(sender, instance, created, **kwargs):
-    if created:
-        user = instance.user
-        password = ''.join(random.choices(
-            string.ascii_letters+string.digits, k=16))
-
-        user.password = password
-        user.save()
-
-        subject = 'مرحبا بك في تفاصيل'
-        message = (
-            f'مرحبًا {user.name},\n\n'
-
-            'مرحبًا في تطبيق "تفاصيل"! إليك تسجيل الدخول:\n'
-            f'- اسم المستخدم: {user.email}\n'
-            f'- كلمة المرور: {user.password}\n\n'
-            
-            'استخدمهما للوصول إلى تطبيق "تفاصيل".\n'
-            'للمساعدة، اتصل بفريق الدعم.\n\n'
-            
-            'نتمنى لك تجربة ممتعة!\n\n'
-            
-            'https://tafaseel.io/\n\n'
-            
-            'مع أطيب التحيات،\n'
-            '"تفاصيل"\n'
-            '---'
-        )
-        send_mail(subject, message, settings.EMAIL_HOST_USER, [user.email, ])
+        transaction.on_commit(schedule)
 
 
 @receiver(post_save, sender=models.Account)
-def pull_subscription_plan(sender, instance, created, **kwargs):
+def schedule_catalog_sync(sender, instance, created, **kwargs):
     if created:
-        account = instance
-
-        subscription_response = SallaAppSettingsReader(account).get_subscription()
-        payload = subscription_response.get('data')
+        models.SallaCatalogSync.schedule(instance.user)
 
-        if payload and type(payload) is list:
-            payload = payload[0]
-        else:
-            raise ValidationError('Invalid subscripion')
 
-        payload_data = SallaUserSubscriptionPayloadSerializer(data=payload)
-        payload_data.is_valid(raise_exception=True)
+@receiver(post_save, sender=models.UserPrompt)
+def update_plan_balance_is_salla(sender, instance, created, **kwargs):
+    if created and instance.chat_gpt_response is not None and instance.chat_gpt_response.is_charged:
+        # the prompt was counted when it was reserved, push the new balance
+        models.SallaUserSubscription.schedule_balance_push(instance.user_id)
 
-        subscription = models.SallaUserSubscription(
-            user=account.user, payload=payload, **payload_data.data,
-        )
-        subscription.save()
 
 @receiver(post_save, sender=models.UserPrompt)
-def update_plan_balance_is_salla(sender, instance, created, **kwargs):
-    from .controllers import SallaWriter
-    from datetime import timedelta
+def index_near_duplicate(sender, instance, created, **kwargs):
+    from app import tasks
 
     if created and instance.chat_gpt_response is not None:
-        subscription = instance.user.subscriptions.filter(is_active=True).last()
-        start_date = subscription.created_at
-        end_date = subscription.created_at + (subscription.plan_period or timedelta(days=1000)) 
+        prompt_id = instance.pk
 
-        used_prompts = models.UserPrompt.count_for_user(instance.user, start_date, end_date, gpt=True)
-        balance = subscription.gpt_prompts_limit - used_prompts
-        
-        account = instance.user.account
-        SallaWriter(account).balance_update({'balance': balance})
+        def schedule():
+            # the signature is computed by a worker, not in the request
+            try:
+                tasks.index_near_duplicate.apply_async((prompt_id,), retry=False)
+            except Exception as e:
+                logger.error(f'[NEAR_DUPLICATE] scheduling {prompt_id} failed: {e!r}')
 
-        
\ No newline at end of file
+        transaction.on_commit(schedule)
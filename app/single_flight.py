@@ -0,0 +1,113 @@
+"""Coalescing of identical requests running at the same time.
+
+The first request of a key takes a lock in the cache shared by the workers
+and does the work, the identical requests arriving meanwhile wait for its
+result instead of repeating the work. The result is kept shortly after, so
+a retry right after the first request finished gets it too.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+from typing import Callable
+
+from django.core.cache import cache
+
+from app import metrics
+
+logger = logging.getLogger('main')
+
+# seconds the work may take before the lock expires
+LOCK_TTL = int(os.getenv('SINGLE_FLIGHT_LOCK_TTL', 90))
+RESULT_TTL = int(os.getenv('SINGLE_FLIGHT_RESULT_TTL', 15))
+POLL_INTERVAL = 0.2
+
+
+def get_key(*parts) -> str:
+    content = json.dumps([str(part) for part in parts])
+    return f'single-flight:{hashlib.sha1(content.encode()).hexdigest()}'
+
+
+def normalize_keywords(keywords: str) -> str:
+    return re.sub(r'\s+', ' ', keywords or '').strip().lower()
+
+
+def get_result(key: str):
+    try:
+        return cache.get(f'{key}:result')
+    except Exception as e:
+        logger.error(f'[SINGLE_FLIGHT] {e!r}')
+        return None
+
+
+def acquire(key: str) -> bool:
+    """take the lock of the key, False when a request already has it"""
+    try:
+        return cache.add(f'{key}:lock', 1, timeout=LOCK_TTL)
+    except Exception as e:
+        # without the cache every request does its own work
+        logger.error(f'[SINGLE_FLIGHT] {e!r}')
+        return True
+
+
+def release(key: str, result=None) -> None:
+    """share the result, if any, and let the next request in"""
+    try:
+        if result is not None:
+            cache.set(f'{key}:result', result, timeout=RESULT_TTL)
+        cache.delete(f'{key}:lock')
+    except Exception as e:
+        logger.error(f'[SINGLE_FLIGHT] {e!r}')
+
+
+def wait(key: str):
+    """Return the result of the request holding the lock, None when it
+    failed or didn't finish in time"""
+    deadline = time.monotonic() + LOCK_TTL
+    while time.monotonic() < deadline:
+        result = get_result(key)
+        if result is not None:
+            metrics.incr('single_flight.coalesced')
+            return result
+
+        try:
+            is_locked = cache.get(f'{key}:lock') is not None
+        except Exception:
+            is_locked = False
+        if not is_locked:
+            # a result stored right before the lock was released
+            return get_result(key)
+
+        time.sleep(POLL_INTERVAL)
+    return None
+
+
+def join(key: str) -> tuple:
+    """Return `(is_leader, result)`, the leader does the work and releases
+    the key, the others get its result, None when the leader failed"""
+    result = get_result(key)
+    if result is not None:
+        metrics.incr('single_flight.coalesced')
+        return False, result
+
+    if acquire(key):
+        return True, None
+    return False, wait(key)
+
+
+def run(key: str, work: Callable):
+    """Return the result of `work`, or of the identical request in flight"""
+    is_leader, result = join(key)
+    if result is not None:
+        return result
+    if not is_leader:
+        # the leader failed, do the work without coalescing
+        return work()
+
+    try:
+        result = work()
+        return result
+    finally:
+        release(key, result)
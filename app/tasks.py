@@ -15,4 +15,147 @@ def refresh_tokens():
         account.refresh_access_token()
         
     print('REFRESH DONE')
-    
\ No newline at end of file
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=5, ignore_result=True)
+def flush_product_writes(self, user_id, product_id):
+    """write the deferred accepted prompts of a product to salla in one PUT"""
+    from django.core.cache import cache
+    from app.exceptions import SallaEndpointFailureException
+    from app.models import SallaUser, UserPrompt
+
+    if not self.request.retries:
+        # the fields deferred from now on schedule the next flush
+        cache.delete(UserPrompt.get_flush_key(user_id, product_id))
+
+    user = SallaUser.objects.get(pk=user_id)
+    try:
+        UserPrompt.flush_writes(user, product_id)
+    except SallaEndpointFailureException as e:
+        # the prompts stay pending, the next flush of the product retries them
+        if self.request.retries >= self.max_retries:
+            raise
+        raise self.retry(exc=e)
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=5, ignore_result=True)
+def onboard_account(self, account_id):
+    """pull the store and the subscription of a new account"""
+    from app.exceptions import SallaEndpointFailureException
+    from app.models import Account
+
+    account = Account.objects.select_related('user').get(pk=account_id)
+    try:
+        account.onboard()
+    except SallaEndpointFailureException as e:
+        # nothing is saved until both are pulled, safe to retry
+        if self.request.retries >= self.max_retries:
+            raise
+        raise self.retry(exc=e)
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=30)
+def send_welcome_email(self, user_id):
+    from app.models import SallaUser
+
+    user = SallaUser.objects.get(pk=user_id)
+    try:
+        user.send_welcome_email()
+    except Exception as e:
+        if self.request.retries >= self.max_retries:
+            raise
+        raise self.retry(exc=e)
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=5, ignore_result=True)
+def push_plan_balance(self, user_id):
+    """send the latest plan balance of the user to salla"""
+    from app.models import SallaUser, SallaUserSubscription
+
+    user = SallaUser.objects.select_related('account').get(pk=user_id)
+    try:
+        SallaUserSubscription.push_balance(user)
+    except Exception as e:
+        if self.request.retries >= self.max_retries:
+            raise
+        raise self.retry(exc=e)
+
+
+@shared_task(ignore_result=True)
+def sync_catalog(user_id):
+    """mirror the salla products of the user, resumes from its checkpoint"""
+    from django.core.cache import cache
+    from app.models import SallaCatalogSync, SallaUser
+
+    # one sync per user at a time
+    lock_key = f'catalog-sync:{user_id}'
+    if not cache.add(lock_key, 1, timeout=SallaCatalogSync.STALE_AFTER.total_seconds()):
+        return
+
+    try:
+        user = SallaUser.objects.get(pk=user_id)
+        sync, _ = SallaCatalogSync.objects.get_or_create(user=user)
+        sync.run()
+    finally:
+        cache.delete(lock_key)
+
+
+@shared_task
+def refresh_catalogs():
+    """resume the dead syncs and refresh the old mirrors"""
+    from app.models import SallaCatalogSync
+
+    for sync in SallaCatalogSync.objects.select_related('user'):
+        if sync.should_refresh:
+            sync_catalog.delay(sync.user_id)
+
+
+
+@shared_task
+def run_bulk_generation(job_id):
+    """generate the prompts of a bulk job, resumes from its checkpoint"""
+    from django.core.cache import cache
+    from app.models import BulkGenerationJob
+
+    # one worker per job at a time
+    lock_key = f'bulk-generation:{job_id}'
+    if not cache.add(lock_key, 1, timeout=BulkGenerationJob.STALE_AFTER.total_seconds()):
+        return
+
+    try:
+        job = BulkGenerationJob.objects.select_related('user__account').get(pk=job_id)
+        job.run()
+    finally:
+        cache.delete(lock_key)
+
+
+@shared_task
+def resume_bulk_generations():
+    """resume the jobs a restarted worker left behind"""
+    from app.models import BulkGenerationJob
+
+    jobs = BulkGenerationJob.objects.filter(status__in=BulkGenerationJob.ACTIVE_STATUSES)
+    for job in jobs:
+        if job.is_stale:
+            run_bulk_generation.delay(job.pk)
+
+
+@shared_task
+def reconcile_prompts_usage():
+    """correct the used prompts counters of the active subscriptions"""
+    from app.models import SallaUserSubscription
+
+    subscriptions = SallaUserSubscription.objects.filter(is_active=True).select_related('user')
+    for subscription in subscriptions.iterator():
+        subscription.reconcile_used_prompts()
+
+
+@shared_task(ignore_result=True)
+def index_near_duplicate(prompt_id):
+    """make the answered prompt a candidate for the next near duplicates"""
+    from app import near_duplicates
+    from app.models import UserPrompt
+
+    user_prompt = UserPrompt.objects.select_related('user').filter(pk=prompt_id).first()
+    if user_prompt is not None:
+        near_duplicates.index(user_prompt)
@@ -1,3 +1,490 @@
-from django.test import TestCase
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+from rest_framework.exceptions import PermissionDenied
+
+from app.exceptions import (
+    SallaEndpointFailureException, SallaOauthFailedException, SallaRateLimitedException,
+)
+from app.models import (
+    Account, ChatGPTResponse, SallaCatalogSync, SallaProduct, SallaUser,
+    SallaUserSubscription, UserPrompt,
+)
+from app.permissions import PromptsReservation
+
+
+def create_user(salla_id: str = '1') -> SallaUser:
+    user = SallaUser.objects.create(salla_id=salla_id, name='merchant')
+    # bulk_create skips the signals pulling the merchant from salla
+    Account.objects.bulk_create([Account(
+        user=user, access_token='access', refresh_token='refresh',
+        scope='offline_access', token_type='bearer',
+    )])
+    return user
+
+
+class PendingWritesTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = create_user()
+
+    def create_prompt(self, prompt_type: str, value: str) -> UserPrompt:
+        return UserPrompt.objects.create(
+            user=self.user, product_id='10', prompt_type=prompt_type,
+            meta={'new_value': value},
+        )
+
+    def test_failed_write_is_kept_pending(self):
+        prompt = self.create_prompt('title', 'TITLE')
+
+        with mock.patch('app.controllers.SallaWriter.product_update') as product_update:
+            product_update.side_effect = SallaEndpointFailureException()
+            with self.assertRaises(SallaEndpointFailureException):
+                prompt.write_to_salla()
+
+        prompt.refresh_from_db()
+        self.assertTrue(prompt.is_write_pending)
+        self.assertIsNone(prompt.is_accepted)
+
+    def test_declined_prompt_is_not_written_with_the_next_flush(self):
+        title = self.create_prompt('title', 'BAD TITLE')
+        with mock.patch('app.controllers.SallaWriter.product_update') as product_update:
+            product_update.side_effect = SallaEndpointFailureException()
+            with self.assertRaises(SallaEndpointFailureException):
+                title.write_to_salla()
+        title.refresh_from_db()
+        title.decline()
+
+        description = self.create_prompt('description', 'DESCRIPTION')
+        with mock.patch('app.controllers.SallaWriter.product_update') as product_update:
+            product_update.return_value = {'id': '10', 'description': 'DESCRIPTION'}
+            description.write_to_salla()
+
+        product_update.assert_called_once_with('10', {'description': 'DESCRIPTION'})
+        title.refresh_from_db()
+        description.refresh_from_db()
+        self.assertIs(title.is_accepted, False)
+        self.assertFalse(title.is_write_pending)
+        self.assertTrue(description.is_accepted)
+        self.assertFalse(description.is_write_pending)
+
+    def test_bulk_decline_clears_the_pending_writes(self):
+        title = self.create_prompt('title', 'TITLE')
+        title.queue_write()
+
+        UserPrompt.bulk_decline(self.user, [title])
+
+        title.refresh_from_db()
+        self.assertFalse(title.is_write_pending)
+        self.assertIsNone(UserPrompt.flush_writes(self.user, '10'))
+
+    def test_deferred_fields_are_written_in_one_put(self):
+        title = self.create_prompt('title', 'TITLE')
+        description = self.create_prompt('description', 'DESCRIPTION')
+        title.queue_write()
+        description.queue_write()
+
+        with mock.patch('app.controllers.SallaWriter.product_update') as product_update:
+            product_update.return_value = {'id': '10', 'name': 'TITLE'}
+            UserPrompt.flush_writes(self.user, '10')
+
+        product_update.assert_called_once_with(
+            '10', {'name': 'TITLE', 'description': 'DESCRIPTION'}
+        )
+        self.assertFalse(UserPrompt.objects.filter(is_write_pending=True).exists())
+
+    def test_flush_is_scheduled_once_per_product(self):
+        with mock.patch('app.tasks.flush_product_writes.apply_async') as apply_async:
+            for _ in range(3):
+                self.assertTrue(UserPrompt.schedule_flush(self.user.pk, '10'))
+
+        apply_async.assert_called_once()
+
+    def test_rate_limited_flush_is_retried(self):
+        from app.tasks import flush_product_writes
+
+        with mock.patch('app.models.UserPrompt.flush_writes') as flush_writes:
+            flush_writes.side_effect = SallaRateLimitedException()
+            flush_product_writes.apply((self.user.pk, '10'))
+
+        self.assertEqual(flush_writes.call_count, flush_product_writes.max_retries + 1)
+
+    def test_concurrent_failed_write_is_kept_pending(self):
+        title = self.create_prompt('title', 'TITLE')
+
+        async def products_update(writer, bodies):
+            return {product_id: SallaEndpointFailureException() for product_id in bodies}
+
+        with mock.patch('app.controllers.AsyncSallaWriter.products_update', products_update):
+            statuses = UserPrompt.bulk_accept(self.user, [title])
+
+        self.assertEqual(statuses[title.pk]['status'], 'failed')
+        title.refresh_from_db()
+        self.assertTrue(title.is_write_pending)
+
+
+class SallaUnauthorizedTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def get_unauthorized_response(self):
+        return mock.Mock(
+            status_code=401, text='Unauthorized', headers={},
+            request=mock.Mock(url='https://salla/oauth2/user/info'),
+        )
+
+    def test_oauth_callback_fails_once_without_saving(self):
+        with mock.patch('app.controllers.send_salla_request') as send_salla_request:
+            send_salla_request.return_value = self.get_unauthorized_response()
+            with self.assertRaises(SallaOauthFailedException):
+                Account.store({
+                    'access_token': 'rejected', 'refresh_token': 'refresh',
+                    'scope': 'offline_access', 'token_type': 'bearer',
+                })
+
+        send_salla_request.assert_called_once()
+        self.assertFalse(Account.objects.exists())
+
+    def test_saved_account_tokens_are_revoked(self):
+        from app.controllers import SallaMerchantReader
+
+        user = create_user()
+        with mock.patch('app.controllers.send_salla_request') as send_salla_request:
+            send_salla_request.return_value = self.get_unauthorized_response()
+            with self.assertRaises(SallaOauthFailedException):
+                SallaMerchantReader(user.account, use_cache=False).get_user()
+
+        user.account.refresh_from_db()
+        self.assertEqual(user.account.access_token, '')
+
+
+class CatalogSyncScheduleTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user()
+
+    def test_cold_views_queue_the_sync_once(self):
+        with mock.patch('app.tasks.sync_catalog.apply_async') as apply_async:
+            for _ in range(3):
+                SallaCatalogSync.schedule(self.user)
+
+        apply_async.assert_called_once()
+        self.assertEqual(self.user.catalog_sync.status, SallaCatalogSync.STATUS_RUNNING)
+
+    def test_broker_down_leaves_it_to_the_next_view(self):
+        with mock.patch('app.tasks.sync_catalog.apply_async') as apply_async:
+            apply_async.side_effect = ConnectionError()
+            SallaCatalogSync.schedule(self.user)
+            apply_async.side_effect = None
+            SallaCatalogSync.schedule(self.user)
+
+        self.assertEqual(apply_async.call_count, 2)
+
+
+class CatalogSyncPruneTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        SallaProduct.upsert_many(self.user, [{'id': id} for id in ('1', '2', '3')])
+        self.sync = SallaCatalogSync.objects.create(
+            user=self.user, status=SallaCatalogSync.STATUS_COMPLETED
+        )
+
+    def walk(self, pages: list, total: int) -> None:
+        with mock.patch('app.controllers.SallaMerchantReader.iter_product_pages') as iter_pages, \
+                mock.patch('app.controllers.SallaMerchantReader.get_products') as get_products:
+            iter_pages.return_value = iter(
+                (page, [{'id': id} for id in ids]) for page, ids in enumerate(pages, 1)
+            )
+            get_products.return_value = {'pagination': {'total': total}}
+            self.sync.run()
+
+    def get_mirrored_ids(self) -> list:
+        return sorted(self.user.products.values_list('salla_id', flat=True))
+
+    def test_products_not_seen_are_pruned(self):
+        self.walk([['1'], ['2']], total=2)
+
+        self.assertEqual(self.get_mirrored_ids(), ['1', '2'])
+
+    def test_shifted_walk_isnt_pruned(self):
+        # a product deleted during the walk shifted `2` to the page already read
+        self.walk([['1'], ['3']], total=3)
+
+        self.assertEqual(self.get_mirrored_ids(), ['1', '2', '3'])
+        self.assertEqual(self.sync.status, SallaCatalogSync.STATUS_COMPLETED)
+
+
+class SallaConditionalCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = create_user()
+
+    def fetch_products(self, use_cache: bool):
+        from app.controllers import SallaMerchantReader
+
+        response = mock.Mock(status_code=200, headers={'ETag': '"v1"'})
+        response.json.return_value = {'data': [{'id': 1}], 'pagination': {}}
+        with mock.patch('app.controllers.send_salla_request', return_value=response), \
+                mock.patch('app.salla_cache.store_conditional') as store_conditional:
+            SallaMerchantReader(self.user.account, use_cache=use_cache).get_products()
+        return store_conditional
+
+    def test_validators_are_kept_for_cached_reads(self):
+        self.fetch_products(use_cache=True).assert_called_once()
+
+    def test_uncached_reads_keep_nothing(self):
+        self.fetch_products(use_cache=False).assert_not_called()
+
+
+class PromptsUsageTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = create_user()
+        # 12 prompts for the default trial price
+        self.subscription = SallaUserSubscription.objects.create(
+            user=self.user, plan_type='free', plan_name='trial'
+        )
+        patcher = mock.patch('app.tasks.push_plan_balance.apply_async')
+        self.push_balance = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_answered_prompt(
+        self, reused_from: ChatGPTResponse = None, is_cache_hit: bool = False
+    ) -> UserPrompt:
+        response = ChatGPTResponse.objects.create(
+            prompt='prompt', answer='answer', reused_from=reused_from, is_cache_hit=is_cache_hit
+        )
+        return UserPrompt.objects.create(
+            user=self.user, product_id='10', prompt_type='title', chat_gpt_response=response
+        )
+
+    def refresh(self) -> SallaUserSubscription:
+        self.subscription.refresh_from_db()
+        return self.subscription
+
+    def test_unused_prompts_are_given_back(self):
+        with PromptsReservation(self.user, count=3) as reservation:
+            self.assertEqual(self.refresh().used_prompts, 3)
+            reservation.use()
+
+        subscription = self.refresh()
+        self.assertEqual(subscription.used_prompts, 1)
+        self.assertEqual(subscription.reserved_prompts, 0)
+        self.push_balance.assert_called_once()
+
+    def test_release_is_idempotent(self):
+        reservation = PromptsReservation(self.user, count=2).acquire()
+        with reservation:
+            pass
+        reservation.release()
+
+        self.assertEqual(self.refresh().used_prompts, 0)
+
+    def test_the_limit_cant_be_exceeded(self):
+        PromptsReservation(self.user, count=12).acquire()
+
+        with self.assertRaises(PermissionDenied):
+            PromptsReservation(self.user).acquire()
+        self.assertEqual(self.refresh().used_prompts, 12)
+
+    def test_reconcile_keeps_the_open_reservations(self):
+        PromptsReservation(self.user, count=4).acquire()
+        self.create_answered_prompt()
+
+        self.subscription.reconcile_used_prompts()
+
+        self.assertEqual(self.refresh().used_prompts, 4)
+        self.assertEqual(self.subscription.reserved_prompts, 4)
+
+    def test_reconcile_drops_the_abandoned_reservations(self):
+        PromptsReservation(self.user, count=4).acquire()
+        self.create_answered_prompt()
+        SallaUserSubscription.objects.filter(pk=self.subscription.pk).update(
+            reserved_at=self.subscription.created_at - SallaUserSubscription.RESERVATION_TTL
+        )
+
+        self.subscription.reconcile_used_prompts()
+
+        self.assertEqual(self.refresh().used_prompts, 1)
+        self.assertEqual(self.subscription.reserved_prompts, 0)
+
+    def test_answers_without_tokens_arent_charged(self):
+        answered = self.create_answered_prompt()
+        reused = self.create_answered_prompt(reused_from=answered.chat_gpt_response)
+        cached = self.create_answered_prompt(is_cache_hit=True)
+
+        self.assertTrue(answered.chat_gpt_response.is_charged)
+        self.assertFalse(reused.chat_gpt_response.is_charged)
+        self.assertFalse(cached.chat_gpt_response.is_charged)
+
+    def test_backfill_counts_like_count_for_user(self):
+        from importlib import import_module
+        from django.apps import apps
+
+        migration = import_module('app.migrations.0019_sallausersubscription_used_prompts')
+        answered = self.create_answered_prompt()
+        self.create_answered_prompt(reused_from=answered.chat_gpt_response)
+        self.create_answered_prompt(is_cache_hit=True)
+
+        migration.count_used_prompts(apps, None)
+
+        self.assertEqual(self.refresh().used_prompts, 1)
+        self.assertEqual(
+            UserPrompt.count_for_user(self.user, self.subscription.created_at, self.subscription.ends_at),
+            1,
+        )
+
+
+class TokensTestCase(TestCase):
+    def test_trimmed_arabic_has_no_broken_characters(self):
+        from app import tokens
+
+        class ByteEncoding:
+            """a token per byte, arabic letters take two"""
+            def encode(self, text):
+                return list(text.encode())
+
+            def decode(self, ids, errors='replace'):
+                return bytes(ids).decode(errors=errors)
+
+        text = 'فستان قطن أحمر'
+        with mock.patch('app.tokens.get_encoding', return_value=ByteEncoding()):
+            for budget in range(1, 20):
+                trimmed = tokens.trim_to_budget(text, budget, 'test-bytes')
+                self.assertTrue(text.startswith(trimmed))
+
+    def test_prompt_over_the_context_isnt_sent(self):
+        from app import tokens
+        from app.exceptions import PromptTooLongException
+
+        with mock.patch('app.tokens.count_tokens', return_value=4090):
+            with self.assertRaises(PromptTooLongException):
+                tokens.get_max_tokens('prompt', 'text-davinci-003', 512)
+
+        with mock.patch('app.tokens.count_tokens', return_value=3900):
+            self.assertEqual(tokens.get_max_tokens('prompt', 'text-davinci-003', 512), 181)
+
+
+@mock.patch('app.single_flight.POLL_INTERVAL', 0.01)
+class SingleFlightTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def run_concurrently(self, work, count: int = 5) -> list:
+        from app import single_flight
+
+        key = single_flight.get_key('user', 'product')
+        results = [None] * count
+
+        def run(index):
+            try:
+                results[index] = single_flight.run(key, work)
+            except Exception as e:
+                results[index] = e
+
+        threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_requests_share_one_generation(self):
+        calls = []
+
+        def work():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'answer': 'answer'}
+
+        results = self.run_concurrently(work)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'answer': 'answer'}] * 5)
+
+    def test_a_retry_right_after_gets_the_result(self):
+        from app import single_flight
+
+        key = single_flight.get_key('user', 'product')
+        single_flight.run(key, lambda: {'answer': 'first'})
+
+        self.assertEqual(single_flight.run(key, lambda: {'answer': 'second'}), {'answer': 'first'})
+
+    def test_the_others_do_the_work_when_the_leader_fails(self):
+        lock = threading.Lock()
+        calls = []
+
+        def work():
+            with lock:
+                calls.append(1)
+                is_first = len(calls) == 1
+            time.sleep(0.1)
+            if is_first:
+                raise ValueError('failed')
+            return {'answer': 'answer'}
+
+        results = self.run_concurrently(work, count=3)
+
+        self.assertEqual(sum(isinstance(result, ValueError) for result in results), 1)
+        self.assertEqual(results.count({'answer': 'answer'}), 2)
+
+
+class NearDuplicatesTestCase(TestCase):
+    def setUp(self):
+        from app import near_duplicates
+
+        self.user = create_user()
+        patcher = mock.patch.object(near_duplicates, '_local_store', near_duplicates.LocalIndexStore())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.accepted = self.create_prompt('10', 'Red cotton dress for summer')
+        self.accepted.is_accepted = True
+        self.accepted.save()
+        near_duplicates.index(self.accepted)
+
+    def create_prompt(self, product_id: str, product_name: str) -> UserPrompt:
+        response = ChatGPTResponse.objects.create(prompt='prompt', answer='answer')
+        return UserPrompt.objects.create(
+            user=self.user, product_id=product_id, prompt_type='title',
+            chat_gpt_response=response, meta=self.get_data(product_id, product_name),
+        )
+
+    def get_data(self, product_id: str, product_name: str) -> dict:
+        return {
+            'product_id': product_id, 'product_name': product_name,
+            'keywords': 'dress', 'prompt_type': 'title',
+        }
+
+    def test_near_duplicate_product_reuses_the_accepted_answer(self):
+        from app import near_duplicates
+
+        reusable = near_duplicates.find_reusable(
+            self.user, self.get_data('11', 'Red cotton dress for summer!')
+        )
+
+        self.assertEqual(reusable, self.accepted.chat_gpt_response)
+
+    def test_same_product_asks_for_a_new_answer(self):
+        from app import near_duplicates
+
+        reusable = near_duplicates.find_reusable(
+            self.user, self.get_data('10', 'Red cotton dress for summer')
+        )
+
+        self.assertIsNone(reusable)
+
+    def test_long_inputs_are_capped(self):
+        from app import near_duplicates
+
+        data = self.get_data('12', 'dress ' * 10000)
+        data['product_description'] = 'cotton ' * 100000
+        signatures = near_duplicates.get_signatures(data)
+
+        self.assertEqual(signatures, near_duplicates.get_signatures({
+            **data,
+            'product_name': data['product_name'][:near_duplicates.MAX_CHARS * 2],
+            'product_description': data['product_description'][:near_duplicates.MAX_CHARS * 2],
+        }))
@@ -0,0 +1,102 @@
+"""Token counting and budgeting of the prompts sent to OpenAI.
+
+Tokens are counted with the tokenizer of the model (tiktoken). When the
+tokenizer can't be loaded the count is estimated, pessimistically for non
+latin text since arabic takes about a token per character.
+"""
+import os
+import logging
+from functools import lru_cache
+
+from app.exceptions import PromptTooLongException
+
+logger = logging.getLogger('main')
+
+# prompt + completion tokens the models accept
+CONTEXT_TOKENS = {
+    'text-davinci-003': 4097,
+    'text-davinci-002': 4097,
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+}
+DEFAULT_CONTEXT_TOKENS = int(os.getenv('OPENAI_CONTEXT_TOKENS', 4096))
+# tokens left unused, the count of chat messages has a small overhead
+SAFETY_MARGIN = int(os.getenv('OPENAI_TOKENS_SAFETY_MARGIN', 16))
+FALLBACK_ENCODING = 'cl100k_base'
+# fewer completion tokens than that can't answer, the request isn't sent
+MIN_COMPLETION_TOKENS = int(os.getenv('OPENAI_MIN_COMPLETION_TOKENS', 16))
+
+
+def get_context_tokens(model: str) -> int:
+    return CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """Return the tokenizer of the model, None when it can't be loaded"""
+    try:
+        import tiktoken
+    except ImportError:
+        logger.error('[TOKENS] tiktoken is not installed, the tokens are estimated')
+        return None
+
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(FALLBACK_ENCODING)
+    except Exception as e:
+        # the encodings are downloaded on first use
+        logger.error(f'[TOKENS] loading the tokenizer of {model} failed: {e!r}')
+        return None
+
+
+def _estimate_tokens(text: str) -> int:
+    latin = sum(1 for char in text if ord(char) < 128)
+    return -(-latin // 4) + (len(text) - latin)
+
+
+@lru_cache(maxsize=int(os.getenv('OPENAI_TOKENS_CACHE_SIZE', 4096)))
+def count_tokens(text: str, model: str) -> int:
+    if not text:
+        return 0
+
+    encoding = get_encoding(model)
+    if encoding is None:
+        return _estimate_tokens(text)
+    return len(encoding.encode(text))
+
+
+def trim_to_budget(text: str, budget: int, model: str) -> str:
+    """Return the longest start of the text within `budget` tokens"""
+    if not text or count_tokens(text, model) <= budget:
+        return text
+    if budget <= 0:
+        return ''
+
+    encoding = get_encoding(model)
+    if encoding is not None:
+        # the cut may split the bytes of a multi-byte character, drop them
+        return encoding.decode(encoding.encode(text)[:budget], errors='ignore')
+
+    # binary search the longest prefix fitting the estimate
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if _estimate_tokens(text[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+
+def get_max_tokens(prompt: str, model: str, desired: int) -> int:
+    """`desired` completion tokens, lowered so the prompt and the
+    completion fit the context of the model. Raise `PromptTooLongException`
+    when the prompt leaves too few of them for an answer"""
+    available = get_context_tokens(model) - count_tokens(prompt, model) - SAFETY_MARGIN
+    if available < min(desired, MIN_COMPLETION_TOKENS):
+        raise PromptTooLongException()
+    return min(desired, available)
@@ -15,6 +15,9 @@ urlpatterns = [
     path('salla/submit/', views.SubmitToSallaAPI.as_view(), name='salla_submit'),
     path('salla/submit/manually/', views.SubmitProductEditManuallyToSallaAPI.as_view(), name='salla_submit_manually'),
     path('prompt/decline/', views.PromptDeclineAPI.as_view(), name='prompt_decline'),
+    path('prompt/bulk/', views.PromptBulkActionAPI.as_view(), name='prompt_bulk'),
+    path('bulk-generation/', views.BulkGenerationAPI.as_view(), name='bulk_generation'),
+    path('bulk-generation/<int:pk>/', views.BulkGenerationStatusAPI.as_view(), name='bulk_generation_status'),
     path('product/history/', views.ProductListHistoryAPI.as_view(), name='product_history'),
 
     # convert from custom mode to easy mode then this url shouldn't used 
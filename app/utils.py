@@ -1,10 +1,12 @@
-import time, string, random, langdetect
+import time, string, random
 from typing import Any, List
 
 from django.core.validators import validate_email
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 
+from app import language
+
 
 def next_two_weeks():
     return int(time.time()) + 60 * 60 * 24 * 12
@@ -43,16 +45,7 @@ def serialize_data_recursively(Serializer, data:dict, default:dict=None):
 
 def get_language(text: str) -> str:
     """Return the language of the text"""
-    lang = langdetect.detect(text)
-    space = ['en', 'ar']
-
-    if lang not in space:
-        # determine the language by the first character
-        garbage = string.whitespace + string.punctuation + string.digits
-        cleaned_text = text.strip(garbage) or 'Empty text'
-
-        lang = 'en' if cleaned_text[0] in string.ascii_letters else 'ar'
-    return lang
+    return language.detect(text)
 
 def list_to_choices(choices: list) -> list:
     """Convert a list to a list of choices"""
@@ -89,8 +82,3 @@ def get_static_products():
         'products': json_data['data'][:3],
         'pagination': json_data['pagination'],
     }
-
-def chars_to_token_calculator(length: int) -> int:
-    """It return a valid token number for chatgpt answer length"""
-    return int(length / 5.7)
-
@@ -1,25 +1,30 @@
 import os
+import json
 import logging
 
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
+from django.db.models import Q
 
 from rest_framework.views import APIView
-from rest_framework.generics import ListAPIView
+from rest_framework.generics import ListAPIView, RetrieveAPIView
 from rest_framework.response import Response
 from rest_framework.renderers import TemplateHTMLRenderer
-from rest_framework.exceptions import AuthenticationFailed, ValidationError
+from rest_framework.exceptions import APIException, AuthenticationFailed, ValidationError
 from rest_framework.views import exception_handler as drf_exception_handler
 from rest_framework.exceptions import MethodNotAllowed
 from rest_framework.permissions import IsAuthenticated
 
-from app.controllers import SallaOAuth, SallaMerchantReader, ChatGPT, ChatGPTProductPromptGenerator, SallaWebhook
-from app.exceptions import SallaOauthFailedException
-from app.models import Account, UserPrompt, ChatGPTResponse, SallaUser
+from app.controllers import SallaOAuth, ChatGPT, ChatGPTProductPromptGenerator, SallaWebhook
+from app.exceptions import PromptTooLongException, SallaOauthFailedException
+from app.models import Account, UserPrompt, ChatGPTResponse, SallaUser, BulkGenerationJob
 from app.utils import set_cookie, validate_email_and_password
 from app.enums import CookieKeys
 from app import serializers
 from app import permissions
+from app import near_duplicates
+from app import single_flight
 
 logger = logging.getLogger('main')
 
@@ -113,11 +118,32 @@ class ProductsListAPI(ListAPIView):
         params = request.GET
 
         account = request.user.account
-        products = SallaMerchantReader(account).get_products(params)
+        products = account.get_products(params)
 
         return Response(products)
 
 
+class ClosingIterator:
+    """Iterator calling `on_close` when the response closes it, even if it
+    was never iterated"""
+
+    def __init__(self, iterator, on_close) -> None:
+        self.iterator = iterator
+        self.on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iterator)
+
+    def close(self) -> None:
+        try:
+            self.iterator.close()
+        finally:
+            self.on_close()
+
+
 class AskGPTAboutProductAPI(APIView):
     permission_classes = [IsAuthenticated, permissions.SallaPlanLimits]
     post_body_serializer = serializers.ProductGetDescriptionPOSTBodySerializer
@@ -134,23 +160,180 @@ class AskGPTAboutProductAPI(APIView):
         prompt = prompt_generator.get_prompt()
         constraints = prompt_generator.get_constraints()
 
+        reusable = near_duplicates.find_reusable(self.request.user, data)
+        if reusable is not None:
+            return ChatGPTResponse.reuse(prompt, reusable)
+
         return ChatGPT(**constraints).ask(prompt)
 
-    def post(self, request):
-        data = self.get_data(request)
-        chat_gpt_response = self.ask_chat_gpt(data)
-        prompt = UserPrompt.objects.create(
-            user=request.user,
+    def save_prompt(self, data: dict, chat_gpt_response: ChatGPTResponse) -> UserPrompt:
+        return UserPrompt.objects.create(
+            user=self.request.user,
             chat_gpt_response=chat_gpt_response,
             meta=data,
             product_id=data['product_id'],
             prompt_type=data['prompt_type'],
         )
 
-        return Response({
+    def get_flight_key(self, data: dict) -> str:
+        """identical requests, like double clicks and retries, share one generation"""
+        return single_flight.get_key(
+            self.request.user.pk,
+            data['product_id'],
+            data.get('prompt_type'),
+            single_flight.normalize_keywords(data.get('keywords')),
+        )
+
+    def answer(self, data: dict) -> dict:
+        with permissions.PromptsReservation(self.request.user) as reservation:
+            chat_gpt_response = self.ask_chat_gpt(data)
+            prompt = self.save_prompt(data, chat_gpt_response)
+            if chat_gpt_response.is_charged:
+                reservation.use()
+
+        return {
             'prompt_id': prompt.id,
             'answer': chat_gpt_response.answer,
-        })
+        }
+
+    @staticmethod
+    def get_error_message(exception: Exception) -> str:
+        # the api exceptions, like the rate limit, are meant for the user
+        if isinstance(exception, APIException):
+            return str(exception.detail)
+        return 'Unexpected error happened.'
+
+    def iter_answers(self, data: dict, prompt_types: list, reservation: permissions.PromptsReservation):
+        """ask chatgpt about all the prompt types concurrently,
+        yield the answers as they finish"""
+        try:
+            yield from self.__iter_answers(data, prompt_types, reservation)
+        finally:
+            reservation.release()
+
+    def __iter_answers(self, data: dict, prompt_types: list, reservation: permissions.PromptsReservation):
+        requests = {}
+        for prompt_type in prompt_types:
+            prompt_data = {**data, 'prompt_type': prompt_type}
+            prompt_generator = ChatGPTProductPromptGenerator(prompt_data)
+            prompt = prompt_generator.get_prompt()
+
+            reusable = near_duplicates.find_reusable(self.request.user, prompt_data)
+            if reusable is not None:
+                chat_gpt_response = ChatGPTResponse.reuse(prompt, reusable)
+                user_prompt = self.save_prompt(prompt_data, chat_gpt_response)
+                yield {
+                    'prompt_type': prompt_type,
+                    'prompt_id': user_prompt.id,
+                    'answer': chat_gpt_response.answer,
+                }
+                continue
+
+            try:
+                requests[prompt_type] = (prompt, prompt_generator.get_constraints())
+            except PromptTooLongException as e:
+                yield {'prompt_type': prompt_type, 'error': self.get_error_message(e)}
+
+        for prompt_type, response in ChatGPT.complete_concurrently(requests):
+            if isinstance(response, Exception):
+                yield {'prompt_type': prompt_type, 'error': self.get_error_message(response)}
+                continue
+
+            prompt_data = {**data, 'prompt_type': prompt_type}
+            chat_gpt_response = ChatGPT.log_to_db(requests[prompt_type][0], response)
+            prompt = self.save_prompt(prompt_data, chat_gpt_response)
+            if chat_gpt_response.is_charged:
+                reservation.use()
+
+            yield {
+                'prompt_type': prompt_type,
+                'prompt_id': prompt.id,
+                'answer': chat_gpt_response.answer,
+            }
+
+    def post_many(self, data: dict, prompt_types: list, stream: bool):
+        prompt_types = list(dict.fromkeys(prompt_types))
+
+        # raises before the response starts when the plan hasn't enough prompts
+        reservation = permissions.PromptsReservation(self.request.user, len(prompt_types)).acquire()
+
+        answers = self.iter_answers(data, prompt_types, reservation)
+        if stream:
+            lines = ClosingIterator(
+                (json.dumps(answer) + '\n' for answer in answers),
+                # a generator closed before it started never runs its finally
+                on_close=reservation.release,
+            )
+            return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
+        order = {prompt_type: index for index, prompt_type in enumerate(prompt_types)}
+        answers = sorted(answers, key=lambda answer: order[answer['prompt_type']])
+        return Response({'answers': answers})
+
+    def iter_events(self, data: dict):
+        """server-sent events of the answer tokens as openai generates them,
+        the prompt is saved once the answer is complete"""
+        def event(name: str, payload: dict) -> str:
+            return f'event: {name}\ndata: {json.dumps(payload)}\n\n'
+
+        key = self.get_flight_key(data)
+        is_leader, result = single_flight.join(key)
+        if result is not None:
+            yield event('token', {'text': result['answer']})
+            yield event('done', result)
+            return
+
+        try:
+            # a missing template fails here, the flight must be released
+            # and the client told by an error event
+            prompt_generator = ChatGPTProductPromptGenerator(data)
+            prompt = prompt_generator.get_prompt()
+            chat_gpt = ChatGPT(**prompt_generator.get_constraints())
+
+            with permissions.PromptsReservation(self.request.user) as reservation:
+                reusable = near_duplicates.find_reusable(self.request.user, data)
+                if reusable is not None:
+                    chat_gpt_response = ChatGPTResponse.reuse(prompt, reusable)
+                    yield event('token', {'text': chat_gpt_response.answer})
+                else:
+                    for text, response in chat_gpt.stream(prompt):
+                        if response is None:
+                            yield event('token', {'text': text})
+                    chat_gpt_response = ChatGPT.log_to_db(prompt, response)
+
+                user_prompt = self.save_prompt(data, chat_gpt_response)
+                if chat_gpt_response.is_charged:
+                    reservation.use()
+            result = {'prompt_id': user_prompt.id, 'answer': chat_gpt_response.answer}
+        except Exception as e:
+            logger.error(f'ChatGPTError: {e!r}')
+            yield event('error', {'error': self.get_error_message(e)})
+            return
+        finally:
+            if is_leader:
+                single_flight.release(key, result)
+
+        yield event('done', result)
+
+    def post_stream(self, data: dict):
+        response = StreamingHttpResponse(self.iter_events(data), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # don't let nginx buffer the tokens
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def post(self, request):
+        data = self.get_data(request)
+        prompt_types = data.pop('prompt_types', None)
+        stream = data.pop('stream', False)
+        if prompt_types:
+            return self.post_many(data, prompt_types, stream)
+        if stream:
+            return self.post_stream(data)
+
+        answer = single_flight.run(self.get_flight_key(data), lambda: self.answer(data))
+
+        return Response(answer)
 
 
 class SubmitToSallaAPI(APIView):
@@ -168,10 +351,17 @@ class SubmitToSallaAPI(APIView):
         data = self.get_data(request)
 
         prompt = get_object_or_404(user.prompts.all(), pk=data['prompt_id'])
-        response = prompt.write_to_salla()
+        if data['defer']:
+            prompt.queue_write()
+            if not UserPrompt.schedule_flush(user.pk, prompt.product_id):
+                # not left pending without a flush
+                response = UserPrompt.flush_writes(user, prompt.product_id)
+        else:
+            # it writes the deferred fields of the product too
+            response = prompt.write_to_salla()
 
         # TODO make use of response
-        return Response({'new_value': prompt.chat_gpt_response.answer})
+        return Response({'new_value': prompt.salla_value, 'is_deferred': data['defer']})
 
 
 class SubmitProductEditManuallyToSallaAPI(APIView):
@@ -218,6 +408,79 @@ class PromptDeclineAPI(APIView):
         return Response(status=200)
 
 
+class PromptBulkActionAPI(APIView):
+    post_body_serializer = serializers.PromptBulkActionPOSTBodySerializer
+
+    def get_data(self, request) -> dict:
+        serializer = self.post_body_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.data
+
+        return data
+
+    def get_prompts(self, data: dict) -> list:
+        """the prompts of the user only, in one query"""
+        prompt_ids = data.get('prompt_ids') or []
+        product_ids = data.get('product_ids') or []
+
+        pending_of_products = Q(
+            product_id__in=product_ids,
+            is_accepted__isnull=True,
+            chat_gpt_response__isnull=False,
+        )
+        qs = self.request.user.prompts.filter(Q(pk__in=prompt_ids) | pending_of_products)
+
+        return list(qs.select_related('chat_gpt_response'))
+
+    def post(self, request):
+        data = self.get_data(request)
+        prompts = self.get_prompts(data)
+
+        if data['action'] == 'accept':
+            results = UserPrompt.bulk_accept(request.user, prompts)
+        else:
+            results = UserPrompt.bulk_decline(request.user, prompts)
+
+        for prompt_id in data.get('prompt_ids') or []:
+            results.setdefault(prompt_id, {'status': 'not_found'})
+
+        return Response({'results': results})
+
+
+class BulkGenerationAPI(APIView):
+    permission_classes = [IsAuthenticated, permissions.SallaPlanLimits]
+    post_body_serializer = serializers.BulkGenerationJobPOSTBodySerializer
+
+    def get_data(self, request) -> dict:
+        serializer = self.post_body_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.data
+
+        return data
+
+    def post(self, request):
+        data = self.get_data(request)
+
+        jobs = request.user.bulk_generation_jobs
+        if jobs.filter(status__in=BulkGenerationJob.ACTIVE_STATUSES).exists():
+            raise ValidationError({'error': 'A bulk generation is already running.'})
+
+        job = jobs.create(
+            prompt_types=data.get('prompt_types') or ChatGPTProductPromptGenerator.get_prompt_types(),
+            keywords=data.get('keywords') or None,
+        )
+        job.schedule()
+
+        return Response(serializers.BulkGenerationJobSerializer(job).data, status=201)
+
+
+class BulkGenerationStatusAPI(RetrieveAPIView):
+    serializer_class = serializers.BulkGenerationJobSerializer
+
+    def get_queryset(self):
+        return self.request.user.bulk_generation_jobs.all()
+
+
 class ProductListHistoryAPI(ListAPIView):
     serializer_class = serializers.UserPromptSerializer
     post_body_serializer = serializers.ProductListHistoryPOSTBodySerializer
@@ -0,0 +1,5 @@
+# load the celery app with django, so the tasks queued by the web process
+# use its broker settings
+from .celery import app as celery_app
+
+__all__ = ('celery_app',)
@@ -21,9 +21,18 @@ app.autodiscover_tasks()
 @app.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
     print('SETUP DONE')
-    from app.tasks import refresh_tokens
+    from app.tasks import refresh_tokens, refresh_catalogs, resume_bulk_generations, reconcile_prompts_usage
     # Calls test('hello') every 10 seconds.
     sender.add_periodic_task(
         crontab(hour=24), refresh_tokens.s()
         # 10, refresh_tokens.s()
     )
+    sender.add_periodic_task(
+        int(os.getenv('SALLA_CATALOG_REFRESH_CHECK_SECONDS', 60 * 5)), refresh_catalogs.s()
+    )
+    sender.add_periodic_task(
+        int(os.getenv('BULK_GENERATION_RESUME_CHECK_SECONDS', 60 * 5)), resume_bulk_generations.s()
+    )
+    sender.add_periodic_task(
+        int(os.getenv('PROMPTS_USAGE_RECONCILE_SECONDS', 60 * 60)), reconcile_prompts_usage.s()
+    )
@@ -96,6 +96,21 @@ if IS_LOCAL := os.getenv('IS_LOCAL', False) == 'True':
 else:
     STATIC_ROOT = os.path.join(BASE_DIR, "static/")
 
+# Cache, shared between the web workers and celery
+if IS_LOCAL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_CACHE_URL', 'redis://localhost:6379/1'),
+        }
+    }
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -164,3 +179,11 @@ CELERY_BROKER_URL = 'redis://localhost:6379/0'  # Replace with your Redis server
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'  # Replace with your Redis server address if needed
 CELERY_TIMEZONE = 'UTC'  # Use your preferred timezone
 
+# publishing from a request gives up after one retry when the broker is down,
+# the callers scheduling with `retry=False` log it and move on
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'max_retries': int(os.getenv('CELERY_BROKER_CONNECT_RETRIES', 1)),
+    'interval_start': 0,
+    'interval_step': 0.2,
+    'interval_max': 0.5,
+}
@@ -5,7 +5,7 @@ function getTakeOrLeaveElement(textElement, oldText, prompt_id){
 
   const elm = createElement(`
     <div class="prompt-confirmation flex justify-center space-x-2 space-x-reverse mt-2 mb-4">
-      <button type="button" class="accept w-6 h-6 text-xs text-white bg-green-500 rounded hover:bg-green-600 focus:outline-none">
+      <button type="button" class="accept w-6 h-6 text-xs text-white bg-green-500 rounded hover:bg-green-600 focus:outline-none" data-prompt-id="${prompt_id}">
         <i class="fas fa-check"></i>
       </button>
       <button type="button" class="cancelled w-6 h-6 text-xs text-white bg-red-500 rounded hover:bg-red-600 focus:outline-none">
@@ -13,19 +13,31 @@ function getTakeOrLeaveElement(textElement, oldText, prompt_id){
       </button>
     </div>
   `);
+  const markAccepted = () => {
+    const cardElement = getCardElement(textElement);
+
+    textElement.appendChild(
+      createElement(`<span title="Processed" class="cursor-default">✅</span>`)
+    );
+    textElement.parentElement.dataset.isProcessed = true;
+    setTimeout(() => 
+      cardElement.dataset.isFullyProcessed = cardElement.querySelectorAll('[data-is-processed="true"]').length === 4
+    , 500)
+  };
+  // accepted with the other prompts of the card, see `confirmOrCancelAllPromptsInCardButtons`
+  elm.addEventListener('prompt-accepted', () => {
+    markAccepted();
+    elm.remove();
+  });
+
   elm.querySelector('.accept').addEventListener('click', () => {
     const cardElement = getCardElement(textElement);
     let { sallaSubmitUrl } = cardElement.dataset;
 
     fetch(sallaSubmitUrl, postMethod({ prompt_id }))
       .then((response) => {
-        textElement.appendChild(
-          createElement(`<span title="Processed" class="cursor-default">✅</span>`)
-        );
-        textElement.parentElement.dataset.isProcessed = true;
-        setTimeout(() => 
-          cardElement.dataset.isFullyProcessed = cardElement.querySelectorAll('[data-is-processed="true"]').length === 4
-        , 500)
+        if (!response.ok) throw new Error(response.statusText);
+        markAccepted();
       })
       .catch((error) => 
         iziToast.error({ title: 'Error', message: 'Can\'t save into salla.', position: 'topRight' })
@@ -86,11 +98,33 @@ function confirmOrCancelAllPromptsInCardButtons(){
 
   elm.querySelector('.accept-all').addEventListener('click', () => {
     const cardElement = getCardElement(elm);
+    const { promptBulkUrl } = cardElement.dataset;
+    const confirmations = Array.from(cardElement.querySelectorAll('.prompt-confirmation'));
+    const prompt_ids = confirmations.map(
+      (confirmation) => Number(confirmation.querySelector('.accept').dataset.promptId)
+    );
 
-    cardElement.querySelectorAll('.accept').forEach((button, index) => {
-      setTimeout(() => button.click(), index * 500)
-    });
-    elm.remove();
+    // one request, the fields of the product are written to salla in one PUT
+    fetch(promptBulkUrl, postMethod({ action: 'accept', prompt_ids }))
+      .then((response) => {
+        if (!response.ok) throw new Error(response.statusText);
+        return response.json();
+      })
+      .then(({ results }) => {
+        let failed = 0;
+        confirmations.forEach((confirmation, index) => {
+          const { status } = results[prompt_ids[index]] || {};
+          if (status === 'accepted' || status === 'queued')
+            confirmation.dispatchEvent(new Event('prompt-accepted'));
+          else
+            failed++;
+        });
+        if (failed) throw new Error(`${failed} field(s) weren't saved.`);
+      })
+      .catch((error) => 
+        iziToast.error({ title: 'Error', message: `Can't save into salla. ${error.message}`, position: 'topRight' })
+      )
+      .finally(() => elm.remove());
   });
 
   elm.querySelector('.cancelled-all').addEventListener('click', () => {
@@ -221,6 +255,8 @@ productIcons.forEach((icon) => {
         // more data
         keywords: keywords.trim(),
         prompt_type: promptType,
+        // show the answer while it's being generated
+        stream: true,
       }
       const request = postMethod(request_body)
       const isHasConfirmationPrompt = Boolean(icon.parentElement.querySelector('.prompt-confirmation'));
@@ -240,19 +276,36 @@ productIcons.forEach((icon) => {
         keywordsElement.querySelector('input[type="text"]').classList.remove('border-red-500');
       }
 
-      fetch(askGptUrl, request)
-        .then((response) => response.json())
-        .then(({ answer, prompt_id }) => {
-          const oldText = textElement.innerText;
+      const oldText = textElement.innerText;
+      let streamedText = '';
+      let isDone = false;
 
-          textElement.innerText = answer;
-          icon.parentElement.appendChild(
-            getTakeOrLeaveElement(textElement, oldText, prompt_id)
-          );
+      fetch(askGptUrl, request)
+        .then((response) => {
+          if (!response.ok) throw new Error(response.statusText);
+
+          return readEventStream(response, (event, data) => {
+            if (event === 'token') {
+              streamedText += data.text;
+              textElement.innerText = streamedText.trim();
+            } else if (event === 'done') {
+              isDone = true;
+              textElement.innerText = data.answer;
+              icon.parentElement.appendChild(
+                getTakeOrLeaveElement(textElement, oldText, data.prompt_id)
+              );
+            } else if (event === 'error') {
+              throw new Error(data.error);
+            }
+          }).then(() => {
+            // the connection dropped before the answer was complete
+            if (!isDone) throw new Error('Unexpected error happened.');
+          });
+        })
+        .catch((error) => {
+          textElement.innerText = oldText;
+          iziToast.error({ title: 'Error', message: error.message || 'Unexpected error happened.', position: 'topRight' });
         })
-        .catch((error) => 
-          iziToast.error({ title: 'Error', message: 'Unexpected error happened.', position: 'topRight' })
-        )
         .finally(() => {
           iconUnloading();
         });
@@ -272,26 +325,46 @@ productIcons.forEach((icon) => {
         keywordsElement.querySelector('input[type="text"]').classList.remove('border-red-500');
       }
 
-      const notProcessedElements = cardElement.querySelectorAll('[data-is-processed="false"] .fa-magic');
-      notProcessedElements.forEach( magicIcon => magicIcon.click() );
-      const iconLoadingInterval = setInterval(() => {
+      // one request, the server asks about all the fields concurrently
+      const notProcessedElements = Array.from(cardElement.querySelectorAll('[data-is-processed="false"]'))
+        .filter(elm => !elm.querySelector('.prompt-confirmation'));
+      let { product, askGptUrl } = cardElement.dataset;
+      product = JSON.parse(product);
 
-        const isStillLoading = Array.from(notProcessedElements).filter(magicIcon => {
-          return magicIcon.classList.contains('fa-spinner');
-        })
+      if (notProcessedElements.length === 0) {
+        iconUnloading();
+        return;
+      }
 
-        if (isStillLoading.length > 0) return;
-        else{
-          iconUnloading();
-          clearInterval(iconLoadingInterval);
-          setTimeout(() => {
-            if(cardElement.querySelector('.prompt-confirmation')){
-              keywordsElement.appendChild(confirmOrCancelAllPromptsInCardButtons())
-            }
-          }, 200);
-        }
+      const request = postMethod({
+        product_id: product.id,
+        product_name: product.name,
+        product_description: product.description || null,
+        product_seo_title: product.metadata.title || null,
+        keywords: keywords.trim(),
+        prompt_types: notProcessedElements.map(elm => elm.dataset.promptType),
+      });
+
+      fetch(askGptUrl, request)
+        .then((response) => response.json())
+        .then(({ answers }) => {
+          answers.filter(({ error }) => !error).forEach(({ prompt_type, answer, prompt_id }) => {
+            const fieldElement = cardElement.querySelector(`[data-prompt-type="${prompt_type}"]`);
+            const textElement = fieldElement.querySelector('p');
+            const oldText = textElement.innerText;
+
+            textElement.innerText = answer;
+            fieldElement.appendChild(getTakeOrLeaveElement(textElement, oldText, prompt_id));
+          });
 
-      }, 200);
+          if (cardElement.querySelector('.prompt-confirmation')) {
+            keywordsElement.appendChild(confirmOrCancelAllPromptsInCardButtons());
+          }
+        })
+        .catch((error) => 
+          iziToast.error({ title: 'Error', message: 'Unexpected error happened.', position: 'topRight' })
+        )
+        .finally(() => iconUnloading());
     } else if (isEditAction) {
       const cardElement = getCardElement(icon);
       const textElement = icon.parentElement.querySelector('p');
@@ -31,6 +31,32 @@ function postMethod(jsonBody){
   }
 }
 
+async function readEventStream(response, onEvent) {
+  // server-sent events of a fetch response, EventSource can't POST
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+
+    buffer += decoder.decode(value, { stream: true });
+    const events = buffer.split("\n\n");
+    buffer = events.pop();
+
+    events.forEach((rawEvent) => {
+      let name = "message";
+      let data = "";
+      rawEvent.split("\n").forEach((line) => {
+        if (line.startsWith("event: ")) name = line.slice(7);
+        else if (line.startsWith("data: ")) data += line.slice(6);
+      });
+      onEvent(name, data ? JSON.parse(data) : {});
+    });
+  }
+}
+
 function getCardElement(currentElement) {
   if (currentElement.dataset.hasOwnProperty('product'))
     return currentElement;